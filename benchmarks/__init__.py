@@ -0,0 +1,4 @@
+# -*- coding: utf-8 -*-
+# Benchmarks of mapmbtiles with synthetic fixtures, see benchmarks/run.py
+# - python -m benchmarks.run --output results.json
+# - python -m benchmarks.run --compare before.json after.json
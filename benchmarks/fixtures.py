@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#----------------------------------------------------------------------------------
+# Synthetic fixtures for the benchmarks, the same for every run [seeded]
+# - rasters: GeoTIFF written with GDAL (numpy)
+#   'rgb', 'rgba', 'paletted', 'nodata' : EPSG:3857 ; 'reprojected' : EPSG:4326, warped by gdal2mbtiles
+# - mbtiles: tiles of one zoom level, jpg or png, 'text' or 'compact' schema
+#----------------------------------------------------------------------------------
+import math,os
+from io import BytesIO
+
+import numpy
+from PIL import Image
+
+from mapmbtiles.mbtiles import MbTiles
+from mapmbtiles.globalmercator import GlobalMercator
+
+""" kinds of synthetic rasters """
+RASTER_KINDS = ('rgb','rgba','paletted','nodata','reprojected')
+""" upper left corner of the synthetic data [Berlin] in EPSG:4326 """
+ORIGIN_LON_LAT = (13.0, 52.8)
+
+
+def pattern(i_width,i_height,i_seed):
+ # smooth gradients with some noise: compresses like a scanned map, not like a flat colour
+ random = numpy.random.RandomState(i_seed)
+ y, x = numpy.mgrid[0:i_height, 0:i_width].astype(numpy.float32)
+ bands = []
+ for i_band in range(3):
+  f_x, f_y = random.uniform(0.005, 0.05, 2)
+  band = 127.5 + 90.0 * numpy.sin(x * f_x + i_band) * numpy.cos(y * f_y)
+  band += random.normal(0.0, 12.0, (i_height, i_width))
+  bands.append(numpy.clip(band, 0, 255).astype(numpy.uint8))
+ return bands
+
+
+def synthetic_raster(s_path,s_kind='rgb',i_size=4096,i_zoom=15,i_seed=0):
+ # a GeoTIFF of i_size x i_size pixels, with the resolution of zoom level i_zoom
+ from osgeo import gdal, osr
+ if s_kind not in RASTER_KINDS:
+  raise ValueError("synthetic_raster: unknown kind '%s' (%s)" % (s_kind, ",".join(RASTER_KINDS)))
+ mercator = GlobalMercator()
+ f_res = mercator.Resolution(i_zoom)
+ mx, my = mercator.LatLonToMeters(ORIGIN_LON_LAT[1], ORIGIN_LON_LAT[0])
+ srs = osr.SpatialReference()
+ if s_kind == 'reprojected':
+  srs.ImportFromEPSG(4326)
+  # about the same extent, in degrees
+  f_deg = f_res * 360.0 / (2 * math.pi * 6378137)
+  geotransform = (ORIGIN_LON_LAT[0], f_deg, 0.0, ORIGIN_LON_LAT[1], 0.0, -f_deg * math.cos(math.radians(ORIGIN_LON_LAT[1])))
+ else:
+  srs.ImportFromEPSG(3857)
+  geotransform = (mx, f_res, 0.0, my, 0.0, -f_res)
+ bands = pattern(i_size, i_size, i_seed)
+ i_bands = 3
+ if s_kind == 'rgba':
+  i_bands = 4
+ elif s_kind == 'paletted':
+  i_bands = 1
+ driver = gdal.GetDriverByName('GTiff')
+ ds = driver.Create(s_path, i_size, i_size, i_bands, gdal.GDT_Byte, ['TILED=YES','COMPRESS=DEFLATE'])
+ ds.SetGeoTransform(geotransform)
+ ds.SetProjection(srs.ExportToWkt())
+ if s_kind == 'paletted':
+  image = Image.merge('RGB', [Image.fromarray(band) for band in bands]).convert('P', palette=Image.ADAPTIVE, colors=64)
+  color_table = gdal.ColorTable()
+  palette = image.getpalette()
+  for i in range(64):
+   color_table.SetColorEntry(i, tuple(palette[i*3:i*3+3]) + (255,))
+  ds.GetRasterBand(1).SetRasterColorTable(color_table)
+  ds.GetRasterBand(1).WriteArray(numpy.asarray(image))
+ else:
+  for i_band in range(3):
+   ds.GetRasterBand(i_band+1).WriteArray(bands[i_band])
+  if s_kind == 'rgba':
+   # a transparent circle in the middle
+   y, x = numpy.mgrid[0:i_size, 0:i_size]
+   alpha = numpy.where((x - i_size/2)**2 + (y - i_size/2)**2 < (i_size/4)**2, 0, 255).astype(numpy.uint8)
+   ds.GetRasterBand(4).WriteArray(alpha)
+   ds.GetRasterBand(4).SetRasterColorInterpretation(gdal.GCI_AlphaBand)
+  elif s_kind == 'nodata':
+   # a black border of 1/8 of the size
+   i_border = i_size / 8
+   for i_band in range(3):
+    band = bands[i_band]
+    band[:i_border, :] = 0
+    band[:, :i_border] = 0
+    ds.GetRasterBand(i_band+1).WriteArray(band)
+    ds.GetRasterBand(i_band+1).SetNoDataValue(0)
+ ds = None
+ return s_path
+
+
+def synthetic_tile(s_format,i_seed,i_tile_size=256):
+ image = Image.merge('RGB', [Image.fromarray(band) for band in pattern(i_tile_size, i_tile_size, i_seed)])
+ output = BytesIO()
+ if s_format == 'png':
+  image.save(output, 'PNG')
+ else:
+  image.save(output, 'JPEG', quality=75)
+ return output.getvalue()
+
+
+def synthetic_mbtiles(s_path,i_zoom=8,i_width=32,s_format='jpg',s_schema='text',i_seed=0,i_images=64):
+ # i_width x i_width tiles of zoom level i_zoom, around ORIGIN_LON_LAT
+ # - i_images distinct images are used, as with real maps where many tiles are alike
+ if os.path.exists(s_path):
+  os.remove(s_path)
+ images = [synthetic_tile(s_format, i_seed + i) for i in range(i_images)]
+ mercator = GlobalMercator()
+ mx, my = mercator.LatLonToMeters(ORIGIN_LON_LAT[1], ORIGIN_LON_LAT[0])
+ tx, ty = mercator.MetersToTile(mx, my, i_zoom)
+ mbtiles = MbTiles()
+ mbtiles.open_db(s_path, os.path.dirname(s_path), s_format, 'tms', False, 'bulk', s_schema)
+ mbtiles.insert_metadata([('name', os.path.splitext(os.path.basename(s_path))[0]), ('description', 'synthetic'),
+  ('type', 'baselayer'), ('version', '1.1'), ('format', s_format), ('tile_row_type', 'tms')])
+ i_tile = 0
+ for x in range(tx, tx + i_width):
+  for y in range(ty - i_width + 1, ty + 1):
+   mbtiles.insert_tile(i_zoom, x, y, "%d-%d-%d.tms" % (i_zoom, x, y), images[i_tile % i_images], False)
+   i_tile += 1
+ mbtiles.sqlite3_connection.commit()
+ mbtiles.save_bounds()
+ mbtiles.close_db()
+ return s_path
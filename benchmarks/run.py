@@ -0,0 +1,327 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#----------------------------------------------------------------------------------
+# Benchmarks of mapmbtiles on synthetic fixtures [benchmarks/fixtures.py]
+# - each case is run --repeat times, the fastest run is kept
+# - the results are written as json, with the git commit, to compare between commits:
+#   python -m benchmarks.run --output before.json
+#   python -m benchmarks.run --output after.json
+#   python -m benchmarks.run --compare before.json after.json
+#----------------------------------------------------------------------------------
+import json,logging,os,platform,random,shutil,socket,subprocess,sys,tempfile,threading,time
+from optparse import OptionParser
+
+from osgeo import gdal
+
+from mapmbtiles.mbtiles import MbTiles, MBTilesBuilder, ImageExporter
+from mapmbtiles.pp import pptransport
+
+from benchmarks import fixtures
+
+""" the benchmark cases, in the order they are run """
+BENCHMARK_CASES = ('base_tiling','overview_tiles','mbtiles_to_disk','mbtiles_from_disk','builder_copy','export_image','tile_reads','transport_socket','transport_pipe','cluster_tiling')
+""" a case slower by more than this ratio is shown as a regression by --compare """
+REGRESSION_RATIO = 1.10
+""" secret of the ppserver nodes of cluster_tiling """
+CLUSTER_SECRET = 'mapmbtiles-benchmark'
+
+def count_tiles(s_path):
+ mbtiles = MbTiles()
+ mbtiles.open_db(s_path, os.path.dirname(s_path), 'jpg', 'tms', False, 'read')
+ i_count = mbtiles.mbtiles_cursor.execute("SELECT count(*) FROM tiles;").fetchone()[0]
+ mbtiles.close_db()
+ return i_count
+
+
+def transport_throughput(sender, receiver, i_messages, data):
+ # seconds to send i_messages times data from sender to receiver, received in a thread
+ received = []
+ def receive():
+  for i in range(i_messages):
+   received.append(len(receiver.receive()))
+ thread = threading.Thread(target=receive)
+ f_start = time.time()
+ thread.start()
+ for i in range(i_messages):
+  sender.send(data)
+ thread.join()
+ f_time = time.time() - f_start
+ if sum(received) != i_messages * len(data):
+  raise RuntimeError("transport_throughput: %d of %d bytes received" % (sum(received), i_messages * len(data)))
+ return f_time
+
+
+def start_ppservers(i_nodes, i_port=61000):
+ # i_nodes ppserver processes with one worker on loopback, returns [(process, 'host:port')]
+ import mapmbtiles.pp
+ s_pp_dir = os.path.dirname(os.path.abspath(mapmbtiles.pp.__file__))
+ env = dict(os.environ, PYTHONPATH=os.pathsep.join([os.path.dirname(s_pp_dir), os.environ.get('PYTHONPATH', '')]))
+ nodes = []
+ for i in range(i_nodes):
+  process = subprocess.Popen([sys.executable, os.path.join(s_pp_dir, 'ppserver.py'), '-i', '127.0.0.1', '-p', str(i_port + i),
+   '-w', '1', '-s', CLUSTER_SECRET, '-n', '2'], env=env)
+  nodes.append((process, '127.0.0.1:%d' % (i_port + i)))
+ # wait until they answer
+ for process, s_node in nodes:
+  for i in range(100):
+   try:
+    transport = pptransport.SocketTransport()
+    transport._connect('127.0.0.1', int(s_node.split(':')[1]))
+    transport.authenticate(CLUSTER_SECRET)
+    transport.send("STAT")
+    transport.receive()
+    transport.close()
+    break
+   except socket.error:
+    time.sleep(0.1)
+ return nodes
+
+
+def git_commit():
+ try:
+  return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+ except Exception:
+  return None
+
+
+class Benchmarks(object):
+ # each bench_* method returns (seconds, tiles, bytes) of one run, the setup is not timed
+ # - for the transport_* cases the tiles are the messages sent
+
+ def __init__(self, s_work_dir, options):
+  self.work_dir = s_work_dir
+  self.options = options
+  self.mbtiles_path = os.path.join(s_work_dir, 'synthetic.mbtiles')
+  fixtures.synthetic_mbtiles(self.mbtiles_path, options.zoom, options.width, 'jpg', options.schema)
+
+ def fresh_dir(self, s_name):
+  s_dir = os.path.join(self.work_dir, s_name)
+  if os.path.exists(s_dir):
+   shutil.rmtree(s_dir)
+  os.makedirs(s_dir)
+  return s_dir
+
+ def gdal2mbtiles(self, s_kind, arguments=[]):
+  # a GDAL2MbTiles for a synthetic raster, writing into a new mbtiles
+  from mapmbtiles.gdal2mbtiles import GDAL2MbTiles
+  s_dir = self.fresh_dir('raster_%s' % s_kind)
+  s_raster = fixtures.synthetic_raster(os.path.join(s_dir, '%s.tif' % s_kind), s_kind, self.options.raster_size)
+  if s_kind == 'paletted':
+   # open_input only takes RGB/RGBA: expanded to RGBA by the working copy, before the timing starts
+   arguments = ['--working_copy', os.path.join(s_dir, 'working_copy')] + arguments
+  g2t = GDAL2MbTiles(['--mbtiles', '-w', 'none', '-z', '%d-%d' % (self.options.raster_zoom - 3, self.options.raster_zoom)] + arguments +
+   [s_raster, os.path.join(s_dir, 'tiles')])
+  g2t.open_input()
+  g2t.generate_metadata()
+  return g2t, os.path.join(s_dir, '%s.mbtiles' % s_kind)
+
+ def bench_base_tiling(self, s_kind):
+  g2t, s_mbtiles = self.gdal2mbtiles(s_kind)
+  f_start = time.time()
+  g2t.generate_base_tiles()
+  f_time = time.time() - f_start
+  return f_time, count_tiles(s_mbtiles), os.path.getsize(s_mbtiles)
+
+ def bench_overview_tiles(self, s_kind):
+  g2t, s_mbtiles = self.gdal2mbtiles(s_kind)
+  g2t.generate_base_tiles()
+  i_base = count_tiles(s_mbtiles)
+  f_start = time.time()
+  g2t.generate_overview_tiles()
+  f_time = time.time() - f_start
+  return f_time, count_tiles(s_mbtiles) - i_base, os.path.getsize(s_mbtiles)
+
+ def bench_cluster_tiling(self, s_kind):
+  # base tiling with --ppservers: --cluster_nodes ppserver processes on loopback
+  nodes = start_ppservers(self.options.cluster_nodes)
+  try:
+   g2t, s_mbtiles = self.gdal2mbtiles(s_kind, ['--ppservers', ','.join([s_node for process, s_node in nodes]),
+    '--ppsecret', CLUSTER_SECRET])
+   f_start = time.time()
+   g2t.generate_base_tiles()
+   f_time = time.time() - f_start
+  finally:
+   for process, s_node in nodes:
+    process.kill()
+    process.wait()
+  return f_time, count_tiles(s_mbtiles), os.path.getsize(s_mbtiles)
+
+ def bench_mbtiles_to_disk(self, s_fixture):
+  s_dir = self.fresh_dir('to_disk')
+  mbtiles = MbTiles()
+  mbtiles.open_db(self.mbtiles_path, self.work_dir, 'jpg', 'tms', False, 'read')
+  f_start = time.time()
+  mbtiles.mbtiles_to_disk(os.path.join(s_dir, 'tiles'))
+  f_time = time.time() - f_start
+  mbtiles.close_db()
+  return f_time, count_tiles(self.mbtiles_path), os.path.getsize(self.mbtiles_path)
+
+ def bench_mbtiles_from_disk(self, s_fixture):
+  s_dir = self.fresh_dir('from_disk')
+  mbtiles = MbTiles()
+  mbtiles.open_db(self.mbtiles_path, self.work_dir, 'jpg', 'tms', False, 'read')
+  mbtiles.mbtiles_to_disk(os.path.join(s_dir, 'tiles'))
+  mbtiles.close_db()
+  s_output = os.path.join(s_dir, 'from_disk.mbtiles')
+  mbtiles = MbTiles()
+  mbtiles.open_db(s_output, s_dir, 'jpg', 'tms', False, 'bulk', self.options.schema)
+  f_start = time.time()
+  mbtiles.mbtiles_from_disk(os.path.join(s_dir, 'tiles'))
+  mbtiles.close_db()
+  f_time = time.time() - f_start
+  return f_time, count_tiles(s_output), os.path.getsize(s_output)
+
+ def bench_builder_copy(self, s_fixture):
+  s_dir = self.fresh_dir('builder')
+  s_output = os.path.join(s_dir, 'copy.mbtiles')
+  builder = MBTilesBuilder(mbtiles_input=self.mbtiles_path, mbtiles_output=s_output, mbtiles_schema=self.options.schema, tmp_dir=s_dir)
+  f_start = time.time()
+  builder.run(False)
+  f_time = time.time() - f_start
+  return f_time, count_tiles(s_output), os.path.getsize(s_output)
+
+ def bench_export_image(self, s_fixture):
+  s_dir = self.fresh_dir('export')
+  s_output = os.path.join(s_dir, 'export.png')
+  exporter = ImageExporter(mbtiles_input=self.mbtiles_path)
+  west, south, east, north = map(float, exporter.reader.mbtiles_bounds.split(','))
+  # a quarter of a tile inside the bounds: the tiles around them do not exist
+  f_x, f_y = (east - west) / self.options.width / 4, (north - south) / self.options.width / 4
+  bbox = (west + f_x, south + f_y, east - f_x, north - f_y)
+  f_start = time.time()
+  exporter.export_image(bbox, self.options.zoom, s_output)
+  f_time = time.time() - f_start
+  return f_time, count_tiles(self.mbtiles_path), os.path.getsize(s_output)
+
+ def bench_tile_reads(self, s_fixture):
+  mbtiles = MbTiles()
+  mbtiles.open_db(self.mbtiles_path, self.work_dir, 'jpg', 'tms', False, 'read')
+  tiles = mbtiles.mbtiles_cursor.execute("SELECT zoom_level,tile_column,tile_row FROM tiles;").fetchall()
+  # always the same random order
+  random.Random(0).shuffle(tiles)
+  i_bytes = 0
+  f_start = time.time()
+  for z, x, y in tiles:
+   image_data = mbtiles.retrieve_image(z, x, y)
+   if image_data:
+    i_bytes += len(image_data)
+  f_time = time.time() - f_start
+  mbtiles.close_db()
+  return f_time, len(tiles), i_bytes
+
+ def transport_message(self):
+  return os.urandom(self.options.message_size * 1024)
+
+ def bench_transport_socket(self, s_fixture):
+  # pp SocketTransport over loopback tcp
+  listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+  listener.bind(('127.0.0.1', 0))
+  listener.listen(1)
+  sender = pptransport.SocketTransport()
+  sender._connect('127.0.0.1', listener.getsockname()[1])
+  receiver = pptransport.SocketTransport(listener.accept()[0])
+  listener.close()
+  data = self.transport_message()
+  try:
+   f_time = transport_throughput(sender, receiver, self.options.messages, data)
+  finally:
+   sender.close()
+   receiver.close()
+  return f_time, self.options.messages, self.options.messages * len(data)
+
+ def bench_transport_pipe(self, s_fixture):
+  # pp PipeTransport over an os.pipe, as between the server and a local ppworker
+  i_read, i_write = os.pipe()
+  transport = pptransport.PipeTransport(os.fdopen(i_read, 'rb'), os.fdopen(i_write, 'wb'))
+  data = self.transport_message()
+  try:
+   f_time = transport_throughput(transport, transport, self.options.messages, data)
+  finally:
+   transport.close()
+  return f_time, self.options.messages, self.options.messages * len(data)
+
+ def run(self, s_case):
+  # [(fixture, result)] for a case
+  if s_case in ('base_tiling', 'overview_tiles', 'cluster_tiling'):
+   fixture_list = self.options.raster_kinds.split(',')
+  elif s_case.startswith('transport_'):
+   fixture_list = ['messages_%dx%dkb' % (self.options.messages, self.options.message_size)]
+  else:
+   fixture_list = ['mbtiles_%s_z%d_w%d' % (self.options.schema, self.options.zoom, self.options.width)]
+  results = []
+  for s_fixture in fixture_list:
+   runs = [getattr(self, 'bench_%s' % s_case)(s_fixture) for i in range(self.options.repeat)]
+   f_time, i_tiles, i_bytes = min(runs)
+   results.append((s_fixture, {'seconds': f_time, 'tiles': i_tiles, 'bytes': i_bytes,
+    'tiles_per_second': i_tiles / f_time if f_time > 0 else None, 'runs': [run[0] for run in runs]}))
+  return results
+
+
+def compare(s_before, s_after):
+ # print the ratio of the times of the cases in both files
+ before = json.load(open(s_before))
+ after = json.load(open(s_after))
+ print "before: ", before.get('commit'), "\nafter:  ", after.get('commit')
+ print "%-16s %-28s %12s %12s %8s" % ("case", "fixture", "before s", "after s", "ratio")
+ i_regressions = 0
+ for s_key in sorted(after['results'].keys()):
+  result = after['results'][s_key]
+  result_before = before['results'].get(s_key)
+  if not result_before:
+   continue
+  f_ratio = result['seconds'] / result_before['seconds']
+  s_case, s_fixture = s_key.split('/', 1)
+  s_flag = ""
+  if f_ratio > REGRESSION_RATIO:
+   s_flag = " <- slower"
+   i_regressions += 1
+  print "%-16s %-28s %12.3f %12.3f %8.2f%s" % (s_case, s_fixture, result_before['seconds'], result['seconds'], f_ratio, s_flag)
+ return i_regressions
+
+
+def main(argv):
+ parser = OptionParser("Usage: %prog [options] | --compare before.json after.json")
+ parser.add_option('', '--output', dest='output', help="json file of the results - default benchmark-<commit>.json")
+ parser.add_option('', '--cases', dest='cases', default=",".join(BENCHMARK_CASES), help="cases to run (%s)" % ",".join(BENCHMARK_CASES))
+ parser.add_option('', '--repeat', dest='repeat', type='int', default=3, help="runs of each case, the fastest is kept - default 3")
+ parser.add_option('', '--zoom', dest='zoom', type='int', default=8, help="zoom level of the synthetic mbtiles - default 8")
+ parser.add_option('', '--width', dest='width', type='int', default=32, help="width x width tiles in the synthetic mbtiles - default 32")
+ parser.add_option('', '--schema', dest='schema', default='text', help="mbtiles_schema of the written mbtiles (text,compact) - default text")
+ parser.add_option('', '--raster_kinds', dest='raster_kinds', default=",".join(fixtures.RASTER_KINDS), help="synthetic rasters for base_tiling and overview_tiles - default all")
+ parser.add_option('', '--raster_size', dest='raster_size', type='int', default=2048, help="width and height of the synthetic rasters - default 2048")
+ parser.add_option('', '--raster_zoom', dest='raster_zoom', type='int', default=15, help="zoom level of the resolution of the synthetic rasters - default 15")
+ parser.add_option('', '--messages', dest='messages', type='int', default=64, help="messages sent by the transport_* cases - default 64")
+ parser.add_option('', '--message_size', dest='message_size', type='int', default=1024, help="kilobytes of each message of the transport_* cases - default 1024")
+ parser.add_option('', '--cluster_nodes', dest='cluster_nodes', type='int', default=2, help="ppserver processes started on loopback by cluster_tiling - default 2")
+ parser.add_option('', '--work_dir', dest='work_dir', help="directory of the fixtures - default a temporary directory, removed at the end")
+ parser.add_option('', '--compare', dest='compare', action='store_true', help="compare two json files of results")
+ options, args = parser.parse_args(argv)
+ if options.compare:
+  if len(args) != 2:
+   parser.error("--compare needs two json files")
+  return compare(args[0], args[1]) and 1 or 0
+ logging.basicConfig(level=logging.WARNING)
+ s_work_dir = options.work_dir or tempfile.mkdtemp(prefix='mapmbtiles-benchmark-')
+ if not os.path.exists(s_work_dir):
+  os.makedirs(s_work_dir)
+ s_commit = git_commit()
+ report = {'commit': s_commit, 'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'python': platform.python_version(),
+  'platform': platform.platform(), 'gdal': gdal.__version__, 'options': vars(options), 'results': {}}
+ try:
+  benchmarks = Benchmarks(s_work_dir, options)
+  for s_case in options.cases.split(','):
+   for s_fixture, result in benchmarks.run(s_case):
+    report['results']['%s/%s' % (s_case, s_fixture)] = result
+    print "%-16s %-28s %10.3f s %10d tiles %12.1f tiles/s" % (s_case, s_fixture, result['seconds'], result['tiles'], result['tiles_per_second'] or 0)
+ finally:
+  if not options.work_dir:
+   shutil.rmtree(s_work_dir, True)
+ s_output = options.output or 'benchmark-%s.json' % (s_commit or time.strftime('%Y%m%d%H%M%S'))[:12]
+ output_file = open(s_output, 'w')
+ json.dump(report, output_file, indent=1, sort_keys=True)
+ output_file.close()
+ print "Results: ", s_output
+ return 0
+
+if __name__ == '__main__':
+ sys.exit(main(sys.argv[1:]))
@@ -46,13 +46,17 @@ import os
 import math
 import sqlite3
 import logging
+import shutil
 
 from zipfile import ZipFile, ZIP_DEFLATED, ZIP_STORED
 
 from io import BytesIO
+from collections import OrderedDict
 
 from globalmercator import GlobalMercator,GlobalGeodetic
-from mbtiles import MbTiles
+from mbtiles import MbTiles, png8_image
+from progress import Progress, format_state
+from timing import timings, profile_start, profile_stop
 
 try:
  from PIL import Image
@@ -69,6 +73,18 @@ resampling_list = ('average','near','bilinear','cubic','cubicspline','lanczos','
 tile_formats_list = ('png', 'jpeg', 'hybrid')
 profile_list = ('mercator','geodetic','raster','gearth','garmin') #,'zoomify')
 webviewer_list = ('all','google','openlayers','none')
+# MbTiles.optimize_database: i_parm=index
+mbtiles_optimize_list = ('full','incremental','analyze')
+# mbtiles.MBTILES_PROFILES
+mbtiles_profile_list = ('bulk','append','read','default')
+# mbtiles.MBTILES_SCHEMAS
+mbtiles_schema_list = ('text','compact')
+# GDAL2MbTiles.base_tiles_order
+tile_order_list = ('auto','column','row','block','hilbert')
+# side, in tiles, of the squares traversed along a Hilbert curve [a power of 2]
+hilbert_tiles = 16
+# times the blocks that failed on a '--ppservers' node are sent again
+cluster_retries = 2
 
 format_extension = {
  "PNG" : "png",
@@ -130,11 +146,19 @@ class GDAL2MbTiles(object):
  def process(self):
   """The main processing function, runs all the main steps of processing"""
   # Opening and preprocessing of the input file
-  if self.options.mbtiles_fromdisk or self.options.mbtiles_todisk:
+  if self.options.mbtiles_fromdisk or self.options.mbtiles_todisk or self.options.mbtiles_optimize or self.options.mbtiles_convert or self.options.mbtiles_overviews or self.options.mbtiles_transcode:
    if self.options.mbtiles_fromdisk:
     i_parm=10
    if self.options.mbtiles_todisk:
     i_parm=11
+   if self.options.mbtiles_optimize:
+    i_parm=12
+   if self.options.mbtiles_convert:
+    i_parm=13
+   if self.options.mbtiles_overviews:
+    i_parm=14
+   if self.options.mbtiles_transcode:
+    i_parm=15
    print "GDAL2MbTiles :mbtiles from/to disk [",i_parm,"] mbtiles_fromdisk[",self.options.mbtiles_fromdisk,"] mbtiles_todisk[",self.options.mbtiles_todisk,"]"
    self.mbtiles_setup(i_parm)
    return
@@ -149,6 +173,11 @@ class GDAL2MbTiles(object):
    self.generate_overview_tiles()
    # Generating of KML
    self.generate_kml()
+   if self.warped_vrt:
+    gdal.Unlink(self.warped_vrt)
+   if self.options.timings:
+    timings.write(self.options.timings)
+    print timings.text()
 
  # -------------------------------------------------------------------------
  def error(self, msg, details = "" ):
@@ -172,19 +201,77 @@ class GDAL2MbTiles(object):
   else:
    gdal.TermProgress_nocb(complete)
 
+ # -------------------------------------------------------------------------
+ def progress_report(self, state):
+  """Report a throttled progress state [progress.Progress]"""
+
+  if self.is_subprocess:
+   # read back by PPGDAL2MbTiles with progress.parse_state
+   sys.stderr.write(format_state(state) + "\n")
+   sys.stderr.flush()
+  elif self.options.verbose:
+   s_eta = "-"
+   if state['eta'] is not None:
+    s_eta = "%ds" % state['eta']
+   print "Progress: %d / %d tiles ; %.1f tiles/s ; %d bytes ; eta %s" % (state['done'], state['total'], state['tiles_per_second'], state['bytes'], s_eta)
+  else:
+   self.progressbar(state['complete'])
+
+ # -------------------------------------------------------------------------
+ def input_stat(self):
+  """Return the (mtime, size) of the input files, None for inputs that are not files"""
+  stats = []
+  for s_input in self.inputs or [self.input]:
+   try:
+    stat = os.stat(s_input)
+    stats.append((stat.st_mtime, stat.st_size))
+   except (OSError, TypeError):
+    stats.append(None)
+  return stats
+
  # -------------------------------------------------------------------------
  def stop(self):
   """Stop the rendering immediately"""
   self.stopped = True
 
+ # -------------------------------------------------------------------------
+ def close(self):
+  """Close the mbtiles, the datasets and the warped VRT opened by open_input"""
+  self.keep_open = False
+  self.mbtiles_close()
+  self.image_output = None
+  self.out_ds = None
+  self.in_ds = None
+  self.mosaic = None
+  if self.warped_vrt:
+   gdal.Unlink(self.warped_vrt)
+   self.warped_vrt = None
+  if self.cluster_dir:
+   shutil.rmtree(self.cluster_dir, True)
+   self.cluster_dir = None
+
  # -------------------------------------------------------------------------
  def __init__(self, arguments, is_subprocess=False, gdalcache=None):
   """Constructor function - initialization"""
   self.mbtiles_db=None
   self.stopped = False
   self.input = None
+  # input files of '--mosaic' and their SourceMosaic [open_input]
+  self.inputs = []
+  self.mosaic = None
   self.output = None
   self.is_subprocess = is_subprocess
+  # tiles done, tiles/s, bytes and ETA, reported by progress_report
+  self.progress = Progress(self.progress_report)
+  # /vsimem/ file of the warped VRT [warp_input]
+  self.warped_vrt = None
+  # the mbtiles stays open (committed) after each generate_* [worker_context]
+  self.keep_open = False
+  # input_stat when the input was opened [worker_context]
+  self.opened_stat = None
+  # temporary tile files and BaseTilesPlan of each zoom level in a pp worker [cluster_block]
+  self.cluster_dir = None
+  self.cluster_plans = {}
 
   # Should we read bigger window of the input raster and scale it down?
   # Note: Modified leter by open_input()
@@ -202,8 +289,14 @@ class GDAL2MbTiles(object):
 
   self.optparse_init()
   self.options, self.args = self.parser.parse_args(args=arguments)
+  # sent to the pp workers of '--ppservers' [cluster_block]
+  self.arguments = arguments
   if not self.args:
    self.error("No input file specified")
+  if self.options.ppservers and not self.options.mbtiles:
+   self.error("'--ppservers' is only supported with '--mbtiles'.")
+  if self.options.timings:
+   timings.enable()
 
   # POSTPROCESSING OF PARSED ARGUMENTS:
 
@@ -235,13 +328,23 @@ class GDAL2MbTiles(object):
 
   # More files on the input not directly supported yet
 
-  if (len(self.args) > 2):
+  if self.options.mosaic:
+   # '@file': a text file with one input file for each line
+   self.inputs = []
+   for arg in self.args:
+    if arg.startswith('@'):
+     self.inputs.extend([line.strip() for line in open(arg[1:]) if line.strip()])
+    else:
+     self.inputs.append(arg)
+  elif (len(self.args) > 2):
    self.error("Processing of several input files is not supported.",
    """Please first use a tool like gdal_vrtmerge.py or gdal_merge.py on the files:
 gdal_vrtmerge.py -o merged.vrt %s""" % " ".join(self.args))
    # TODO: Call functions from gdal_vrtmerge.py directly
 
   self.input = self.args[0]
+  if self.options.mosaic:
+   self.input = self.input.lstrip('@')
 
   # Default values for not given options
 
@@ -332,6 +435,8 @@ gdal_vrtmerge.py -o merged.vrt %s""" % " ".join(self.args))
    self.options.kmz = self.options.profile == 'gearth'
 
   # GDAL Cache
+  if self.options.gdal_cachemax:
+   gdalcache = self.options.gdal_cachemax * 1024 * 1024
   if gdalcache is not None: # default gdal.GetCacheMax() == 40*1024*1024:
    gdal.SetCacheMax(gdalcache)
 
@@ -368,6 +473,34 @@ gdal_vrtmerge.py -o merged.vrt %s""" % " ".join(self.args))
         help="Colour used to initialize output, only for 'jpeg' tile format")
   p.add_option('', '--tilesize', dest="tilesize",
         help="Size of the tiles - default 256")
+  p.add_option('', '--tile_order', dest="tile_order", type='choice', choices=tile_order_list,
+        help="Order in which the base tiles are read from the input (%s) - default 'auto', from the block size of the input" % ",".join(tile_order_list))
+  p.add_option('', '--prefetch', dest="prefetch", type='int', metavar="TILES",
+        help="Read the input in windows of TILES x TILES base tiles with numpy, instead of one read for each tile - default 0 (not used)")
+  p.add_option('', '--mosaic', dest="mosaic", action="store_true",
+        help="Tile all input files as one mosaic, the first file has the highest priority where files overlap ('@list.txt': one file for each line)")
+  p.add_option('', '--mosaic_pool', dest="mosaic_pool", type='int', metavar="FILES",
+        help="Amount of input files of '--mosaic' kept open - default 64")
+  p.add_option('', '--timings', dest="timings", metavar="FILE",
+        help="Record the wall and cpu time of each stage (ReadRaster, resampling, encoding, SQLite ...) and write them as json to FILE")
+  p.add_option('', '--cprofile_zoom', dest="cprofile_zoom", type='int', metavar="ZOOM",
+        help="Profile the tiles of zoom level ZOOM with cProfile, written to [output].zZOOM.prof (read with pstats)")
+  p.add_option('', '--working_copy', dest="working_copy", metavar="DIR",
+        help="Convert the input once into a tiled, compressed GeoTIFF with overviews in DIR, reused by later runs of the same input")
+  p.add_option('', '--gdal_cachemax', dest="gdal_cachemax", type='int', metavar="MB",
+        help="Size of the GDAL block cache in MB (GDAL_CACHEMAX) - default: 128 when run as a script, otherwise GDAL default")
+  p.add_option('', '--warp_memory', dest="warp_memory", type='int', metavar="MB",
+        help="Memory used by each warping operation in MB, when the input is reprojected - default: GDAL default")
+  p.add_option('', '--warp_threads', dest="warp_threads",
+        help="Threads used when the input is reprojected (NUM_THREADS), a number or ALL_CPUS - default ALL_CPUS")
+  p.add_option('', '--ppservers', dest="ppservers", metavar="HOST:PORT,...",
+        help="Generate the base tiles with the pp workers of these ppserver nodes (with the input at the same path), written into the '--mbtiles' by this process")
+  p.add_option('', '--ppsecret', dest="ppsecret",
+        help="Secret of the ppserver nodes of '--ppservers' - default: the pp default")
+  p.add_option('', '--cluster_block', dest="cluster_block", type='int', metavar="TILES",
+        help="Base tiles of '--ppservers' are sent as blocks of TILES x TILES tiles - default 8")
+  p.add_option('', '--cluster_local', dest="cluster_local", type='int', metavar="WORKERS",
+        help="Local pp workers used together with '--ppservers' - default 0")
   p.add_option('', '--osm', dest="tms_osm", action="store_true",
         help="tms or osm numbering - default tms")
   p.add_option('', '--mbtiles', dest="mbtiles", action="store_true",
@@ -376,6 +509,22 @@ gdal_vrtmerge.py -o merged.vrt %s""" % " ".join(self.args))
         help="mbtiles tiles- write mbtiles tiles to a directory")
   p.add_option('', '--mbtiles_from_disk', dest="mbtiles_fromdisk", action="store_true",
         help="mbtiles tiles- create mbtiles file from tile directory")
+  p.add_option('', '--mbtiles_optimize', dest="mbtiles_optimize", type='choice', choices=mbtiles_optimize_list,
+        help="mbtiles - ANALYZE/VACUUM of the mbtiles file (%s) - 'incremental' only returns the free pages" % ",".join(mbtiles_optimize_list))
+  p.add_option('', '--mbtiles_schema', dest="mbtiles_schema", type='choice', choices=mbtiles_schema_list,
+        help="mbtiles - table layout of a created mbtiles file (%s) - default 'text', 'compact' uses integer keys [SQLite >= 3.8.2]" % ",".join(mbtiles_schema_list))
+  p.add_option('', '--mbtiles_convert', dest="mbtiles_convert", action="store_true",
+        help="mbtiles - copy the mbtiles [input_file] to [output] using the --mbtiles_schema table layout")
+  p.add_option('', '--mbtiles_overviews', dest="mbtiles_overviews", action="store_true",
+        help="mbtiles - build the missing lower zoom-levels of the mbtiles [input_file] from its tiles, down to the min of --zoom (default 0)")
+  p.add_option('', '--mbtiles_transcode', dest="mbtiles_transcode", action="store_true",
+        help="mbtiles - re-encode the images of the mbtiles [input_file] in the --tile-format (png,jpeg,hybrid), using --mbtiles_quality for jpeg and --png8 for png")
+  p.add_option('', '--mbtiles_quality', dest="mbtiles_quality", type='int',
+        help="mbtiles - jpeg quality used by --mbtiles_transcode - default 75")
+  p.add_option('', '--png8', dest="png8", type='int', metavar="COLORS",
+        help="png tiles with up to COLORS (max. 256) distinct colours are saved as 8-bit paletted png, when smaller - default 0 (not used)")
+  p.add_option('', '--mbtiles_profile', dest="mbtiles_profile", type='choice', choices=mbtiles_profile_list,
+        help="mbtiles - SQLite connection profile used when writing (%s) - default 'bulk', 'append' when others read the file while it is written" % ",".join(mbtiles_profile_list))
   p.add_option("-v", "--verbose", dest="verbose",action="store_true",
         help="Print status messages to stdout")
 
@@ -417,7 +566,9 @@ gdal_vrtmerge.py -o merged.vrt %s""" % " ".join(self.args))
 
   p.set_defaults(verbose=False, profile="mercator", kml=False, url=None,
   copyright='', resampling='average', resume=False, tilesize=None,mbtiles=False,tms_osm=False,
-  mbtiles_todisk=False,mbtiles_fromdisk=False,
+  mbtiles_todisk=False,mbtiles_fromdisk=False,mbtiles_optimize=None,mbtiles_profile='bulk',mbtiles_schema='text',mbtiles_convert=False,mbtiles_overviews=False,mbtiles_transcode=False,mbtiles_quality=None,png8=0,
+  gdal_cachemax=None,warp_memory=None,warp_threads='ALL_CPUS',tile_order='auto',prefetch=0,working_copy=None,mosaic=False,mosaic_pool=64,timings=None,cprofile_zoom=None,
+  ppservers=None,ppsecret=None,cluster_block=8,cluster_local=0,
   googlekey='INSERT_YOUR_KEY_HERE', yahookey='INSERT_YOUR_YAHOO_APP_ID_HERE')
 
   self.parser = p
@@ -427,15 +578,31 @@ gdal_vrtmerge.py -o merged.vrt %s""" % " ".join(self.args))
   """Initialization of the input raster, reprojection if necessary"""
   gdal.SetConfigOption("GDAL_PAM_ENABLED", "YES")
   gdal.AllRegister()
-  self.options.verbose=True
+  self.opened_stat = self.input_stat()
   if self.options.tms_osm:
    self.s_y_type="osm"
   else:
    self.s_y_type="tms"
   print "open_input :", self.input," osm[",self.options.tms_osm,",",self.s_y_type,"] mbtiles[",self.options.mbtiles,"] mbtiles_todisk[",self.options.mbtiles_todisk,"] mbtiles_fromdisk[",self.options.mbtiles_fromdisk,"]";
   # Open the input file
-  if self.input:
-   self.in_ds = gdal.Open(self.input, gdal.GA_ReadOnly)
+  if self.inputs:
+   try:
+    numpy
+    self.mosaic = SourceMosaic(self.inputs, self.options.mosaic_pool)
+   except NameError:
+    self.error("'--mosaic' is not available.", "Install numpy.")
+   except Exception, e:
+    self.error(str(e))
+   self.in_ds = self.mosaic.dataset()
+   print "open_input : mosaic[", len(self.inputs), "] files"
+  elif self.input:
+   # self.input stays the name of the source, the mbtiles and the viewers are named after it
+   s_input = self.input
+   if self.options.working_copy:
+    import gdalpreprocess
+    s_input = gdalpreprocess.workingcopy(self.input, self.options.working_copy)
+    print "open_input : working copy[", s_input, "]"
+   self.in_ds = gdal.Open(s_input, gdal.GA_ReadOnly)
   else:
    raise Exception("No input file was specified")
 
@@ -553,106 +720,114 @@ gdal2mbtiles temp.vrt""" % self.input )
 
     if (self.in_srs.ExportToProj4() != self.out_srs.ExportToProj4()) or (self.in_ds.GetGCPCount() != 0):
 
-     # Generation of VRT dataset in tile projection, default 'nearest neighbour' warping
-     self.out_ds = gdal.AutoCreateWarpedVRT( self.in_ds, self.in_srs_wkt, self.out_srs.ExportToWkt() )
+     if self.mosaic:
+      self.error("The files of '--mosaic' must be in the Spatial Reference System of the tiles.",
+      "Reproject them first (gdalwarp -t_srs EPSG:3857 for 'mercator') or use -p 'raster'.")
 
-     # TODO: HIGH PRIORITY: Correction of AutoCreateWarpedVRT according the max zoomlevel for correct direct warping!!!
+     if hasattr(gdal, 'Warp'):
+      # GDAL 2.1+: NODATA, alpha and INIT_DEST as warp options, the VRT is kept in /vsimem/
+      self.out_ds = self.warp_input(init_dest)
+     else:
+      # Generation of VRT dataset in tile projection, default 'nearest neighbour' warping
+      self.out_ds = gdal.AutoCreateWarpedVRT( self.in_ds, self.in_srs_wkt, self.out_srs.ExportToWkt() )
 
-     if self.options.verbose:
-      print "Warping of the raster by AutoCreateWarpedVRT (result saved into 'tiles.vrt')"
-      self.out_ds.GetDriver().CreateCopy("tiles.vrt", self.out_ds)
-
-     # Note: self.in_srs and self.in_srs_wkt contain still the non-warped reference system!!!
-
-     # Correction of AutoCreateWarpedVRT for NODATA values
-     if self.in_nodata != []:
-      import tempfile
-      tempfilename = tempfile.mktemp('-gdal2mbtiles.vrt')
-      self.out_ds.GetDriver().CreateCopy(tempfilename, self.out_ds)
-      # open as a text file
-      s = open(tempfilename).read()
-      # Add the warping options
-      s = s.replace("""<GDALWarpOptions>""","""<GDALWarpOptions>
-   <Option name="UNIFIED_SRC_NODATA">YES</Option>
-   <Option name="INIT_DEST">NO_DATA</Option>""")
-      # replace BandMapping tag for NODATA bands....
-      if init_dest is None:
-       dstnodata = self.in_nodata
-      else:
-       dstnodata = init_dest
-      for i in range(len(self.in_nodata)):
-       s = s.replace("""<BandMapping src="%i" dst="%i"/>""" % ((i+1),(i+1)),"""<BandMapping src="%i" dst="%i">
-       <SrcNoDataReal>%i</SrcNoDataReal>
-       <SrcNoDataImag>0</SrcNoDataImag>
-       <DstNoDataReal>%i</DstNoDataReal>
-       <DstNoDataImag>0</DstNoDataImag>
-     </BandMapping>""" % ((i+1), (i+1), self.in_nodata[i], dstnodata[i]))
-      # save the corrected VRT
-      open(tempfilename,"w").write(s)
-      # open by GDAL as self.out_ds
-      self.out_ds = gdal.Open(tempfilename) #, gdal.GA_ReadOnly)
-      # delete the temporary file
-      os.unlink(tempfilename)
-
-      # set NODATA_VALUE metadata
-      self.out_ds.SetMetadataItem('NODATA_VALUES','%s' % " ".join(str(int(f)) for f in self.in_nodata))
+      # TODO: HIGH PRIORITY: Correction of AutoCreateWarpedVRT according the max zoomlevel for correct direct warping!!!
 
       if self.options.verbose:
-       print "Modified warping result saved into 'tiles1.vrt'"
-       open("tiles1.vrt","w").write(s)
-
-     # -----------------------------------
-     # Correction of AutoCreateWarpedVRT for Mono (1 band) and RGB (3 bands) files without NODATA:
-     # equivalent of gdalwarp -dstalpha
-     elif self.in_nodata == [] and self.out_ds.RasterCount in (1,3):
-      import tempfile
-      tempfilename = tempfile.mktemp('-gdal2mbtiles.vrt')
-      self.out_ds.GetDriver().CreateCopy(tempfilename, self.out_ds)
-      # open as a text file
-      s = open(tempfilename).read()
-      # Add the warping options
-      s = s.replace("""<BlockXSize>""","""<VRTRasterBand dataType="Byte" band="%i" subClass="VRTWarpedRasterBand">
-    <ColorInterp>Alpha</ColorInterp>
-  </VRTRasterBand>
-  <BlockXSize>""" % (self.out_ds.RasterCount + 1))
-      s = s.replace("""</GDALWarpOptions>""", """<DstAlphaBand>%i</DstAlphaBand>
-  </GDALWarpOptions>""" % (self.out_ds.RasterCount + 1))
-      if init_dest is None:
-       init_dest_str = "0"
-      else:
-       init_dest_str = ",".join(str(f) for f in init_dest)
-      s = s.replace("""</WorkingDataType>""", """</WorkingDataType>
-    <Option name="INIT_DEST">%s</Option>""" % init_dest_str)
-      # save the corrected VRT
-      open(tempfilename,"w").write(s)
-      # open by GDAL as self.out_ds
-      self.out_ds = gdal.Open(tempfilename) #, gdal.GA_ReadOnly)
-      # delete the temporary file
-      os.unlink(tempfilename)
+       print "Warping of the raster by AutoCreateWarpedVRT (result saved into 'tiles.vrt')"
+       self.out_ds.GetDriver().CreateCopy("tiles.vrt", self.out_ds)
+
+      # Note: self.in_srs and self.in_srs_wkt contain still the non-warped reference system!!!
+
+      # Correction of AutoCreateWarpedVRT for NODATA values
+      if self.in_nodata != []:
+       import tempfile
+       tempfilename = tempfile.mktemp('-gdal2mbtiles.vrt')
+       self.out_ds.GetDriver().CreateCopy(tempfilename, self.out_ds)
+       # open as a text file
+       s = open(tempfilename).read()
+       # Add the warping options
+       s = s.replace("""<GDALWarpOptions>""","""<GDALWarpOptions>
+    <Option name="UNIFIED_SRC_NODATA">YES</Option>
+    <Option name="INIT_DEST">NO_DATA</Option>""")
+       # replace BandMapping tag for NODATA bands....
+       if init_dest is None:
+        dstnodata = self.in_nodata
+       else:
+        dstnodata = init_dest
+       for i in range(len(self.in_nodata)):
+        s = s.replace("""<BandMapping src="%i" dst="%i"/>""" % ((i+1),(i+1)),"""<BandMapping src="%i" dst="%i">
+        <SrcNoDataReal>%i</SrcNoDataReal>
+        <SrcNoDataImag>0</SrcNoDataImag>
+        <DstNoDataReal>%i</DstNoDataReal>
+        <DstNoDataImag>0</DstNoDataImag>
+      </BandMapping>""" % ((i+1), (i+1), self.in_nodata[i], dstnodata[i]))
+       # save the corrected VRT
+       open(tempfilename,"w").write(s)
+       # open by GDAL as self.out_ds
+       self.out_ds = gdal.Open(tempfilename) #, gdal.GA_ReadOnly)
+       # delete the temporary file
+       os.unlink(tempfilename)
+
+       # set NODATA_VALUE metadata
+       self.out_ds.SetMetadataItem('NODATA_VALUES','%s' % " ".join(str(int(f)) for f in self.in_nodata))
 
-      if self.options.verbose:
-       print "Modified -dstalpha warping result saved into 'tiles1.vrt'"
-       open("tiles1.vrt","w").write(s)
-
-     elif init_dest is not None:
-      import tempfile
-      tempfilename = tempfile.mktemp('-gdal2mbtiles.vrt')
-      self.out_ds.GetDriver().CreateCopy(tempfilename, self.out_ds)
-      # open as a text file
-      s = open(tempfilename).read()
-      # Add the warping options
-      s = s.replace("""</WorkingDataType>""", """</WorkingDataType>
-    <Option name="INIT_DEST">%s</Option>""" % ",".join(str(f) for f in init_dest))
-      # save the corrected VRT
-      open(tempfilename,"w").write(s)
-      # open by GDAL as self.out_ds
-      self.out_ds = gdal.Open(tempfilename) #, gdal.GA_ReadOnly)
-      # delete the temporary file
-      os.unlink(tempfilename)
+       if self.options.verbose:
+        print "Modified warping result saved into 'tiles1.vrt'"
+        open("tiles1.vrt","w").write(s)
+
+      # -----------------------------------
+      # Correction of AutoCreateWarpedVRT for Mono (1 band) and RGB (3 bands) files without NODATA:
+      # equivalent of gdalwarp -dstalpha
+      elif self.in_nodata == [] and self.out_ds.RasterCount in (1,3):
+       import tempfile
+       tempfilename = tempfile.mktemp('-gdal2mbtiles.vrt')
+       self.out_ds.GetDriver().CreateCopy(tempfilename, self.out_ds)
+       # open as a text file
+       s = open(tempfilename).read()
+       # Add the warping options
+       s = s.replace("""<BlockXSize>""","""<VRTRasterBand dataType="Byte" band="%i" subClass="VRTWarpedRasterBand">
+     <ColorInterp>Alpha</ColorInterp>
+   </VRTRasterBand>
+   <BlockXSize>""" % (self.out_ds.RasterCount + 1))
+       s = s.replace("""</GDALWarpOptions>""", """<DstAlphaBand>%i</DstAlphaBand>
+   </GDALWarpOptions>""" % (self.out_ds.RasterCount + 1))
+       if init_dest is None:
+        init_dest_str = "0"
+       else:
+        init_dest_str = ",".join(str(f) for f in init_dest)
+       s = s.replace("""</WorkingDataType>""", """</WorkingDataType>
+     <Option name="INIT_DEST">%s</Option>""" % init_dest_str)
+       # save the corrected VRT
+       open(tempfilename,"w").write(s)
+       # open by GDAL as self.out_ds
+       self.out_ds = gdal.Open(tempfilename) #, gdal.GA_ReadOnly)
+       # delete the temporary file
+       os.unlink(tempfilename)
 
-      if self.options.verbose:
-       print "Modified warping result saved into 'tiles1.vrt'"
-       open("tiles1.vrt","w").write(s)
+       if self.options.verbose:
+        print "Modified -dstalpha warping result saved into 'tiles1.vrt'"
+        open("tiles1.vrt","w").write(s)
+
+      elif init_dest is not None:
+       import tempfile
+       tempfilename = tempfile.mktemp('-gdal2mbtiles.vrt')
+       self.out_ds.GetDriver().CreateCopy(tempfilename, self.out_ds)
+       # open as a text file
+       s = open(tempfilename).read()
+       # Add the warping options
+       s = s.replace("""</WorkingDataType>""", """</WorkingDataType>
+     <Option name="INIT_DEST">%s</Option>""" % ",".join(str(f) for f in init_dest))
+       # save the corrected VRT
+       open(tempfilename,"w").write(s)
+       # open by GDAL as self.out_ds
+       self.out_ds = gdal.Open(tempfilename) #, gdal.GA_ReadOnly)
+       # delete the temporary file
+       os.unlink(tempfilename)
+
+       if self.options.verbose:
+        print "Modified warping result saved into 'tiles1.vrt'"
+        open("tiles1.vrt","w").write(s)
 
      # For raster with 4-bands: 4th unknown band set to alpha
      if (self.out_ds.RasterCount == 4
@@ -688,7 +863,12 @@ gdal2mbtiles temp.vrt""" % self.input )
   # Instantiate image output.
   self.image_output = ImageOutput(self.options.tile_format, self.out_ds, self.tilesize,
           self.options.resampling, init_dest, self.output,
-          self.options.verbose,self.options.mbtiles)
+          self.options.verbose,self.options.mbtiles,self.options.png8)
+  if self.mosaic:
+   self.image_output.read_stage = "read_mosaic"
+  elif self.out_ds is not self.in_ds:
+   # the reprojection is done while reading
+   self.image_output.read_stage = "read_warped"
 
   # Read the georeference
 
@@ -853,6 +1033,54 @@ gdal2mbtiles temp.vrt""" % self.input )
    else:
     self.tileswne = lambda x, y, z: (0,0,0,0)
 
+ # -------------------------------------------------------------------------
+ def warp_input(self, init_dest):
+  """Reprojection of the input raster with gdal.Warp into a VRT kept in /vsimem/ (GDAL 2.1+)"""
+
+  warp_options = ["NUM_THREADS=%s" % self.options.warp_threads]
+  src_nodata = None
+  dst_nodata = None
+  dst_alpha = False
+  if self.in_nodata != []:
+   # NODATA values of the input: NODATA (or init_dest) in the output
+   warp_options += ["UNIFIED_SRC_NODATA=YES", "INIT_DEST=NO_DATA"]
+   src_nodata = " ".join(str(f) for f in self.in_nodata)
+   if init_dest is None:
+    dst_nodata = src_nodata
+   else:
+    dst_nodata = " ".join(str(f) for f in init_dest)
+  elif self.in_ds.RasterCount in (1,3):
+   # Mono (1 band) and RGB (3 bands) files without NODATA: equivalent of gdalwarp -dstalpha
+   dst_alpha = True
+   if init_dest is None:
+    warp_options.append("INIT_DEST=0")
+   else:
+    warp_options.append("INIT_DEST=%s" % ",".join(str(f) for f in init_dest))
+  elif init_dest is not None:
+   warp_options.append("INIT_DEST=%s" % ",".join(str(f) for f in init_dest))
+
+  warp_memory = None
+  if self.options.warp_memory:
+   warp_memory = self.options.warp_memory * 1024 * 1024
+
+  self.warped_vrt = "/vsimem/%s-%d-%x-gdal2mbtiles.vrt" % (os.path.splitext(os.path.basename(self.input))[0], os.getpid(), id(self))
+  out_ds = gdal.Warp(self.warped_vrt, self.in_ds, format="VRT",
+   srcSRS=self.in_srs_wkt, dstSRS=self.out_srs.ExportToWkt(),
+   srcNodata=src_nodata, dstNodata=dst_nodata, dstAlpha=dst_alpha,
+   warpOptions=warp_options, warpMemoryLimit=warp_memory, multithread=True)
+  if out_ds is None:
+   self.error("Warping of the input file '%s' failed." % self.input)
+
+  if self.in_nodata != []:
+   # set NODATA_VALUE metadata
+   out_ds.SetMetadataItem('NODATA_VALUES','%s' % " ".join(str(int(f)) for f in self.in_nodata))
+
+  if self.options.verbose:
+   print "Warping of the raster by gdal.Warp %s (result saved into 'tiles.vrt')" % warp_options
+   out_ds.GetDriver().CreateCopy("tiles.vrt", out_ds)
+
+  return out_ds
+
  # -------------------------------------------------------------------------
  def generate_metadata(self):
   """Generation of main metadata files and HTML viewers (metadata related to particular tiles are generated during the tile processing)."""
@@ -924,6 +1152,9 @@ gdal2mbtiles temp.vrt""" % self.input )
 
   gdal.SetConfigOption("GDAL_PAM_ENABLED", "NO")
 
+  if self.options.ppservers:
+   return self.generate_base_tiles_cluster()
+
   print "Generating Base Tiles:"
   if self.options.verbose:
    #mx, my = self.out_gt[0], self.out_gt[3] # OriginX, OriginY
@@ -937,7 +1168,17 @@ gdal2mbtiles temp.vrt""" % self.input )
 
   # Set the bounds
   tminx, tminy, tmaxx, tmaxy = self.tminmax[self.tmaxz]
-  querysize = self.querysize
+
+  if self.mosaic:
+   # every read of the (empty) mosaic VRT is done by SourceMosaic
+   self.image_output.prefetch = self.mosaic
+  elif self.options.prefetch:
+   try:
+    numpy
+   except NameError:
+    self.error("'--prefetch' is not available.", "Install numpy.")
+   self.image_output.prefetch = SourcePrefetch(self.out_ds, self.image_output.data_bands_count, self.image_output.alpha_band,
+    self.options.prefetch * int(math.ceil(self.source_tilesize(self.tmaxz))), int(math.ceil(self.source_tilesize(self.tmaxz))) + 2)
 
   # Just the center tile
   #tminx = tminx+ (tmaxx - tminx)/2
@@ -950,7 +1191,6 @@ gdal2mbtiles temp.vrt""" % self.input )
   #print tcount
   ti = 0
   i_y_column_count=((tmaxy-tminy)+1)
-  ds = self.out_ds
   tz = self.tmaxz
   if self.options.verbose:
    # tx in range(tminx, tmaxx+1) tminx[ 281596 ] tmaxx[ 281744 ] ; ((tmaxx-tmaxy)+1) x_tiles[ 23393 ]
@@ -963,101 +1203,243 @@ gdal2mbtiles temp.vrt""" % self.input )
     if self.options.verbose:
      print "\tTile generation skipped because of --resume ;  x/y-tiles of z[",tz,"]  y_tiles[",tcount,"]"
     return
-  for tx in range(tminx, tmaxx+1):
-   tmaxy_work=tmaxy
-   if self.options.resume:
+  complete_columns = set()
+  if self.options.resume:
+   for tx in range(tminx, tmaxx+1):
     i_count = self.tile_exists(tx, 0, tz,3)
     if i_count == i_y_column_count:
      if self.options.verbose:
       print "\tTile generation skipped because of --resume ;  z =",tz," ; y-tiles of x[",tx,"]  y_tiles[",i_y_column_count,"]"
-     break
-    else:
-     if i_count > 0:
-      # this assums the rows are compleate, which may NOT be true
-      tmaxy_work-=i_count
-      if self.options.verbose:
-       print "\tTile generation skipped to tmaxy[",tmaxy_work,"] because of --resume ;  z =",tz," ; y-tiles of x[",tx,"]  y_tiles[",i_y_column_count,"]"
-   for ty_tms in range(tmaxy_work, tminy-1, -1): #range(tminy, tmaxy+1):
-    ty_osm=self.flip_y(tz,ty_tms)
-    ty=ty_tms
-    if self.options.tms_osm:
-     ty=ty_osm
-    if self.stopped:
-     if self.options.mbtiles:
-      if self.mbtiles_db:
-       self.mbtiles_db.close_db()
-     break
+     complete_columns.add(tx)
+  plan = self.base_tiles_plan(tminx, tminy, tmaxx, tmaxy, tz)
+  self.progress.start(tcount)
+  profiler = None
+  if self.options.cprofile_zoom == tz:
+   profiler = profile_start()
+  # the order of the tiles follows the blocks of the input, see base_tiles_order
+  for tx, ty_tms in self.base_tiles_order(tminx, tminy, tmaxx, tmaxy, tz):
+   if tx in complete_columns:
     ti += 1
+    self.progress.update()
+    continue
+   ty_osm=self.flip_y(tz,ty_tms)
+   ty=ty_tms
+   if self.options.tms_osm:
+    ty=ty_osm
+   if self.stopped:
+    self.mbtiles_close()
+    break
+   ti += 1
 
-    if self.options.resume:
-     exists = self.tile_exists(tx, ty, tz,0)
-     if exists and self.options.verbose:
-      print "\tTile generation skipped because of --resume ;  z =",tz," ; x =",tx," ; y_tms =",ty_tms, "; y_osm =",ty_osm
+   if self.options.resume:
+    exists = self.tile_exists(tx, ty, tz,0)
+    if exists and self.options.verbose:
+     print "\tTile generation skipped because of --resume ;  z =",tz," ; x =",tx," ; y_tms =",ty_tms, "; y_osm =",ty_osm
+   else:
+    exists = False
+
+   if not exists:
+    if self.options.verbose:
+     print ti, '/', tcount, self.get_verbose_tile_name(tx, ty, tz)
+    # read and write windows from the tables of base_tiles_plan
+    xyzzy = plan.xyzzy(tx, ty_tms)
+    if self.options.verbose:
+     print "\tReadRaster Extent: ", (xyzzy.rx, xyzzy.ry, xyzzy.rxsize, xyzzy.rysize), (xyzzy.wx, xyzzy.wy, xyzzy.wxsize, xyzzy.wysize)
+    try:
+     i_bytes = self.write_base_tile(tx, ty, tz, xyzzy)
+    except ImageOutputException, e:
+     self.error("'%d/%d/%d': %s" % (tz, tx, ty, e.message))
+   else:
+    i_bytes = 0
+
+   self.progress.update(1, i_bytes or 0)
+  if profiler:
+   profile_stop(profiler, "%s.z%d.prof" % (self.output.rstrip('/'), tz))
+  if not self.stopped:
+   self.progress.finish()
+  self.mbtiles_close()
+
+ # -------------------------------------------------------------------------
+ def generate_base_tiles_cluster(self):
+  """Generation of the base tiles by the pp workers of '--ppservers', written into the mbtiles by this process
+
+  The tiles are sent as blocks (cluster_block) to the nodes, which open the input once [worker_context]
+  and return the encoded images as they are finished. A block lost with the connection to its node
+  is sent again by pp ; a block that failed in a worker is sent again up to cluster_retries times.
+  """
+  import pp
+
+  tminx, tminy, tmaxx, tmaxy = self.tminmax[self.tmaxz]
+  tz = self.tmaxz
+  tcount = (1+abs(tmaxx-tminx)) * (1+abs(tmaxy-tminy))
+  print "Generating Base Tiles: ppservers[", self.options.ppservers, "]"
+  if self.options.resume:
+   if self.tile_exists(0, 0, tz, 2) == tcount:
+    if self.options.verbose:
+     print "\tTile generation skipped because of --resume ;  x/y-tiles of z[",tz,"]  y_tiles[",tcount,"]"
+    return
+  i_block = max(1, self.options.cluster_block)
+  argslist = []
+  for by in range(tmaxy, tminy-1, -i_block):
+   for bx in range(tminx, tmaxx+1, i_block):
+    argslist.append((self.arguments, (tz, bx, max(tminy, by-i_block+1), min(tmaxx, bx+i_block-1), by)))
+  job_server = pp.Server(ncpus=self.options.cluster_local, ppservers=tuple(self.options.ppservers.split(',')),
+   secret=self.options.ppsecret, proto=2, policy=pp.AffinityPolicy())
+  self.progress.start(tcount)
+  try:
+   for i_retry in range(cluster_retries+1):
+    if i_retry > 0:
+     print "\tSending again", len(argslist), "failed block(s) of base tiles to the '--ppservers' nodes"
+    blocks_done = set()
+    # neighbouring blocks go to the same node, whose GDAL block cache is still warm
+    for result in job_server.map(cluster_tiles, argslist, 1, modules=("gdal2mbtiles",), ordered=False,
+      key=lambda args: args[1][:3]):
+     if self.stopped:
+      break
+     # None: the block failed in the worker, which wrote the traceback to the output of the ppserver
+     if result is None:
+      continue
+     block, tiles = result
+     blocks_done.add(block)
+     for tx, ty, image_data in tiles:
+      i_bytes = 0
+      if image_data is not None:
+       if not self.mbtiles_db:
+        self.mbtiles_setup(1)
+       self.mbtiles_db.insert_image(tz, tx, ty, image_data)
+       i_bytes = len(image_data)
+      self.progress.update(1, i_bytes)
+    argslist = [args for args in argslist if args[1] not in blocks_done]
+    if self.stopped or not argslist:
+     break
+   if argslist and not self.stopped:
+    self.error("%d block(s) of base tiles failed on the '--ppservers' nodes, also after %d retries." %
+     (len(argslist), cluster_retries), "See the output of the ppservers.")
+  finally:
+   try:
+    if not self.stopped:
+     # once in every worker [pp Server.each]: the nodes keep their workers, but not the opened input
+     job_server.each(cluster_shutdown, (self.arguments,), modules=("gdal2mbtiles",))
+   finally:
+    job_server.destroy()
+  if not self.stopped:
+   self.progress.finish()
+  self.mbtiles_close()
+
+ # -------------------------------------------------------------------------
+ def base_tiles_order(self, tminx, tminy, tmaxx, tmaxy, tz):
+  """Generate the (tx, ty_tms) of the base tiles in the order given by --tile_order, every tile once.
+
+  'column' : x by x, each from north to south (the original order)
+  'row' : north to south, each from west to east - for inputs stored in strips
+  'block' : squares of tiles covering about one block of the input, row by row
+  'hilbert' : squares of hilbert_tiles tiles, row by row, each along a Hilbert curve
+  'auto' : 'row' for strips, 'block' when a block covers several tiles, otherwise 'hilbert'
+  """
+  tile_order = self.options.tile_order
+  block_tiles = 1
+  if tile_order in ('auto', 'block'):
+   bx, by = self.out_ds.GetRasterBand(1).GetBlockSize()
+   block_tiles = int(math.ceil(max(bx, by) / self.source_tilesize(tz)))
+   if tile_order == 'auto':
+    if by == 1 or bx >= self.out_ds.RasterXSize:
+     tile_order = 'row'
+    elif block_tiles > 1:
+     tile_order = 'block'
     else:
-     exists = False
+     tile_order = 'hilbert'
+   if self.options.verbose:
+    print "\tBase tiles order [",tile_order,"] input blocks[",bx,"x",by,"] tiles in a block[",block_tiles,"]"
 
-    if not exists:
-     if self.options.verbose:
-      print ti, '/', tcount, self.get_verbose_tile_name(tx, ty, tz)
-     # Don't scale up by nearest neighbour, better change the querysize
-     # to the native resolution (and return smaller query tile) for scaling
-     if self.options.profile in ('mercator','geodetic'):
-      if self.options.profile == 'mercator':
-       # Tile bounds in EPSG:900913
-       b = self.mercator.TileBounds(tx, ty_tms, tz)
-      elif self.options.profile == 'geodetic':
-       b = self.geodetic.TileBounds(tx, ty_tms, tz)
-
-      rb, wb = self.geo_query( ds, b[0], b[3], b[2], b[1])
-      nativesize = wb[0]+wb[2] # Pixel size in the raster covering query geo extent
-      if self.options.verbose:
-       print "\tNative Extent (querysize",nativesize,"): ", rb, wb
-
-      querysize = self.querysize
-      # Tile bounds in raster coordinates for ReadRaster query
-      rb, wb = self.geo_query( ds, b[0], b[3], b[2], b[1], querysize=querysize)
-
-      rx, ry, rxsize, rysize = rb
-      wx, wy, wxsize, wysize = wb
-     else: # 'raster' or 'gearth' or 'garmin' profile:
-      tsize = int(self.tsize[tz]) # tilesize in raster coordinates for actual zoom
-      xsize = self.out_ds.RasterXSize # size of the raster in pixels
-      ysize = self.out_ds.RasterYSize
-      if tz >= self.nativezoom:
-       querysize = self.tilesize # int(2**(self.nativezoom-tz) * self.tilesize)
-
-      rx = (tx) * tsize
-      rxsize = 0
-      if tx == tmaxx:
-       rxsize = xsize % tsize
-      if rxsize == 0:
-       rxsize = tsize
-
-      rysize = 0
-      if ty_tms == tmaxy:
-       rysize = ysize % tsize
-      if rysize == 0:
-       rysize = tsize
-      ry = ysize - (ty_tms * tsize) - rysize
-
-      wx, wy = 0, 0
-
-      wxsize, wysize = int(rxsize/float(tsize) * querysize), int(rysize/float(tsize) * querysize)
-      if wysize != querysize:
-       wy = querysize - wysize
-     xyzzy = Xyzzy(querysize, rx, ry, rxsize, rysize, wx, wy, wxsize, wysize)
-     try:
-      print ti,'/',tcount,' total ; z =',tz,' ; x =',tx,' ; y_tms =',ty_tms,' ; y_osm =',ty_osm
-      print "\tReadRaster Extent: ", (rx, ry, rxsize, rysize), (wx, wy, wxsize, wysize)
-      self.write_base_tile(tx, ty, tz, xyzzy)
-     except ImageOutputException, e:
-      self.error("'%d/%d/%d': %s" % (tz, tx, ty, e.message))
-
-    if not self.options.verbose or self.is_subprocess:
-     self.progressbar( ti / float(tcount) )
-  if self.options.mbtiles:
-   if self.mbtiles_db:
-    self.mbtiles_db.close_db()
+  if tile_order == 'column':
+   for tx in range(tminx, tmaxx+1):
+    for ty_tms in range(tmaxy, tminy-1, -1):
+     yield tx, ty_tms
+  elif tile_order == 'row':
+   for ty_tms in range(tmaxy, tminy-1, -1):
+    for tx in range(tminx, tmaxx+1):
+     yield tx, ty_tms
+  else:
+   if tile_order == 'hilbert':
+    n = hilbert_tiles
+    cells = [hilbert_xy(n, d) for d in range(n*n)]
+   else:
+    n = max(2, block_tiles)
+    cells = [(x, y) for y in range(n) for x in range(n)]
+   for sy in range(tmaxy, tminy-1, -n):
+    for sx in range(tminx, tmaxx+1, n):
+     for x, y in cells:
+      if sx+x <= tmaxx and sy-y >= tminy:
+       yield sx+x, sy-y
+
+ def base_tiles_plan(self, tminx, tminy, tmaxx, tmaxy, tz):
+  """Return a BaseTilesPlan with the read and write windows of the base tiles of zoom level tz.
+
+  The windows of a tile only depend on tx (rx, rxsize, wx, wxsize) or on ty_tms (ry, rysize,
+  wy, wysize): a table is built for each axis, with numpy in one pass (see geo_query_axis),
+  instead of two geo_query for each tile.
+  """
+  ds = self.out_ds
+  querysize = self.querysize
+  if self.options.profile in ('mercator','geodetic'):
+   if self.options.profile == 'mercator':
+    tile_bounds = self.mercator.TileBounds
+   else:
+    tile_bounds = self.geodetic.TileBounds
+   geotran = ds.GetGeoTransform()
+   try:
+    # TileBounds also works with numpy arrays of tx or ty_tms
+    b = tile_bounds(numpy.arange(tminx, tmaxx+1), tminy, tz)
+    x_table = geo_query_axis(geotran[0], geotran[1], ds.RasterXSize, b[0], b[2], querysize)
+    b = tile_bounds(tminx, numpy.arange(tminy, tmaxy+1), tz)
+    y_table = geo_query_axis(geotran[3], geotran[5], ds.RasterYSize, b[3], b[1], querysize)
+   except NameError:
+    # without numpy: one geo_query for each column and each row
+    x_table = []
+    for tx in range(tminx, tmaxx+1):
+     b = tile_bounds(tx, tminy, tz)
+     rb, wb = self.geo_query( ds, b[0], b[3], b[2], b[1], querysize=querysize)
+     x_table.append((rb[0], rb[2], wb[0], wb[2]))
+    y_table = []
+    for ty_tms in range(tminy, tmaxy+1):
+     b = tile_bounds(tminx, ty_tms, tz)
+     rb, wb = self.geo_query( ds, b[0], b[3], b[2], b[1], querysize=querysize)
+     y_table.append((rb[1], rb[3], wb[1], wb[3]))
+  else: # 'raster' or 'gearth' or 'garmin' profile:
+   tsize = int(self.tsize[tz]) # tilesize in raster coordinates for actual zoom
+   xsize = ds.RasterXSize # size of the raster in pixels
+   ysize = ds.RasterYSize
+   if tz >= self.nativezoom:
+    querysize = self.tilesize # int(2**(self.nativezoom-tz) * self.tilesize)
+   x_table = []
+   for tx in range(tminx, tmaxx+1):
+    rxsize = 0
+    if tx == tmaxx:
+     rxsize = xsize % tsize
+    if rxsize == 0:
+     rxsize = tsize
+    x_table.append((tx * tsize, rxsize, 0, int(rxsize/float(tsize) * querysize)))
+   y_table = []
+   for ty_tms in range(tminy, tmaxy+1):
+    rysize = 0
+    if ty_tms == tmaxy:
+     rysize = ysize % tsize
+    if rysize == 0:
+     rysize = tsize
+    wysize = int(rysize/float(tsize) * querysize)
+    wy = 0
+    if wysize != querysize:
+     wy = querysize - wysize
+    y_table.append((ysize - (ty_tms * tsize) - rysize, rysize, wy, wysize))
+  return BaseTilesPlan(querysize, tminx, tminy, x_table, y_table)
+
+ def source_tilesize(self, tz):
+  """Size of a tile of zoom level tz in pixels of the input raster"""
+  if self.options.profile == 'mercator':
+   return self.tilesize * self.mercator.Resolution(tz) / abs(self.out_gt[1])
+  elif self.options.profile == 'geodetic':
+   return self.tilesize * self.geodetic.Resolution(tz) / abs(self.out_gt[1])
+  return float(self.tsize[tz])
 
  # -------------------------------------------------------------------------
  # MBTiles support -begin -
@@ -1076,12 +1458,15 @@ gdal2mbtiles temp.vrt""" % self.input )
    if i_parm == 10:
     self.mbtiles_file=self.output
     self.mbtiles_dir=os.path.dirname(self.mbtiles_file)+ '/'
-   if i_parm == 11:
+   if i_parm >= 11:
     self.mbtiles_file=self.input
     self.mbtiles_dir=os.path.dirname(self.mbtiles_file)+ '/'
+   s_profile=self.options.mbtiles_profile
+   if i_parm == 11 or i_parm == 13:
+    s_profile='read'
    self.mbtiles_db=MbTiles()
    # if self.options.verbose:
-   self.mbtiles_db.open_db(self.mbtiles_file.strip(),self.mbtiles_dir,self.mbtiles_format,self.s_y_type,self.options.verbose)
+   self.mbtiles_db.open_db(self.mbtiles_file.strip(),self.mbtiles_dir,self.mbtiles_format,self.s_y_type,self.options.verbose,s_profile,self.options.mbtiles_schema)
    if i_parm == 1:
     minLat, minLon = self.mercator.MetersToLatLon(self.ominx,self.ominy)
     maxLat, maxLon = self.mercator.MetersToLatLon(self.omaxx, self.omaxy)
@@ -1112,6 +1497,40 @@ gdal2mbtiles temp.vrt""" % self.input )
     self.mbtiles_db.mbtiles_from_disk(self.input)
    if i_parm == 11:
     self.mbtiles_db.mbtiles_to_disk(self.output)
+   if i_parm == 12:
+    self.mbtiles_db.optimize_database(mbtiles_optimize_list.index(self.options.mbtiles_optimize))
+    # tiles, bytes and blank tiles as 'tile_inventory' in metadata, read when the db is opened again
+    self.mbtiles_db.tile_inventory(False,True)
+    self.mbtiles_db.close_db()
+   if i_parm == 13:
+    self.mbtiles_db.mbtiles_convert(self.output,self.options.mbtiles_schema)
+    self.mbtiles_db.close_db()
+   if i_parm == 14:
+    i_min_zoom=0
+    if self.tminz is not None:
+     i_min_zoom=self.tminz
+    self.mbtiles_db.build_overviews(i_min_zoom,None,0,self.options.resume)
+    self.mbtiles_db.close_db()
+   if i_parm == 15:
+    if self.options.png8:
+     self.mbtiles_db.png8_colors=self.options.png8
+    zoom_bytes=self.mbtiles_db.mbtiles_transcode(self.mbtiles_format,self.options.mbtiles_quality)
+    self.mbtiles_db.close_db()
+    for i_zoom in sorted(zoom_bytes.keys()):
+     i_before,i_after=zoom_bytes[i_zoom]
+     print "mbtiles_transcode : zoom_level[",i_zoom,"] bytes[",i_before,"] -> [",i_after,"] (%.1f%%)" % (100.0*i_after/max(i_before,1))
+
+ # -------------------------------------------------------------------------
+ def mbtiles_close(self):
+  """Close the mbtiles of the tiles, opened again by the next tile - only committed when keep_open is set"""
+  if self.options.mbtiles and self.mbtiles_db:
+   if self.keep_open:
+    started = timings.start()
+    self.mbtiles_db.sqlite3_connection.commit()
+    timings.stop('mbtiles_commit', started)
+   else:
+    self.mbtiles_db.close_db()
+    self.mbtiles_db = None
 
  # -------------------------------------------------------------------------
  def tile_exists(self,tx, ty, tz, i_parm):
@@ -1131,31 +1550,47 @@ gdal2mbtiles temp.vrt""" % self.input )
    if not self.mbtiles_db:
     self.mbtiles_setup(1);
    if self.mbtiles_db:
-    self.image_output.write_base_tile(tx, ty, tz, xyzzy)
-    if self.image_output.tile_exists(tx, ty, tz):
-     filename = self.image_output.get_full_path(tx, ty, tz, format_extension[self.image_output.format])
-     input_file = open(filename, 'rb')
-     if not input_file.closed:
-      self.image_data = input_file.read()
-      input_file.close()
-      self.mbtiles_db.insert_image(tz,tx,ty,self.image_data)
-      os.remove(filename)
+    self.image_data = self.encode_base_tile(tx, ty, tz, xyzzy)
+    if self.image_data is not None:
+     self.mbtiles_db.insert_image(tz,tx,ty,self.image_data)
+     return len(self.image_data)
    else:
     pass
     # print "write_base_tile: self.mbtiles_db None"
   else:
    self.image_output.write_base_tile(tx, ty, tz, xyzzy)
  # -------------------------------------------------------------------------
+ def encode_base_tile(self, tx, ty, tz, xyzzy):
+  """Return the encoded image of a base tile, None when it is not stored (hybrid: fully transparent)"""
+  self.image_output.write_base_tile(tx, ty, tz, xyzzy)
+  # hybrid: jpg or png, nothing when fully transparent
+  image_format = self.image_output.try_to_use_existing_tile(tx, ty, tz)
+  if image_format is None:
+   return None
+  filename = self.image_output.get_full_path(tx, ty, tz, format_extension[image_format])
+  started = timings.start()
+  input_file = open(filename, 'rb')
+  image_data = input_file.read()
+  input_file.close()
+  timings.stop('tile_file', started)
+  os.remove(filename)
+  return image_data
+ # -------------------------------------------------------------------------
  def write_overview_tile(self, tx, ty, tz,tms_osm):
   if self.options.mbtiles:
    if not self.mbtiles_db:
     self.mbtiles_setup(1);
    if self.mbtiles_db:
     # retrieve the 4 images and write to disk
+    started = timings.start()
     image_list=self.mbtiles_db.retrieve_zoom_images(tz,tx,ty)
+    timings.stop('mbtiles_retrieve', started)
+    started = timings.start()
     self.image_output.write_overview_tile(tx, ty, tz,tms_osm)
-    if self.image_output.tile_exists(tx, ty, tz):
-     filename = self.image_output.get_full_path(tx, ty, tz, format_extension[self.image_output.format])
+    timings.stop('overview', started)
+    image_format = self.image_output.try_to_use_existing_tile(tx, ty, tz)
+    if image_format is not None:
+     filename = self.image_output.get_full_path(tx, ty, tz, format_extension[image_format])
      input_file = open(filename, 'rb')
      if not input_file.closed:
       image_data = input_file.read()
@@ -1165,8 +1600,8 @@ gdal2mbtiles temp.vrt""" % self.input )
       os.remove(filename)
       # delete the 4 images
       for image_file in image_list:
-        print image_file
         os.remove(image_file)
+      return len(image_data)
    else:
     pass
     # print "write_overview_tile: self.mbtiles_db None"
@@ -1202,10 +1637,17 @@ gdal2mbtiles temp.vrt""" % self.input )
      print "\tTile generation skipped because of --resume ;  all-tiles [",zcount,"] zoom-levels with  tiles[",count_tiles,"]"
     return
   ti = 0
+  self.progress.start(tcount)
 
   # querysize = tilesize * 2
 
+  profiler = None
   for tz in range(self.tmaxz-1, self.tminz-1, -1):
+   if profiler:
+    profile_stop(profiler, "%s.z%d.prof" % (self.output.rstrip('/'), tz+1))
+    profiler = None
+   if self.options.cprofile_zoom == tz:
+    profiler = profile_start()
    tminx, tminy, tmaxx, tmaxy = self.tminmax[tz]
    i_x_column_count=((tmaxx-tminx)+1)
    i_y_column_count=((tmaxy-tminy)+1)
@@ -1216,7 +1658,8 @@ gdal2mbtiles temp.vrt""" % self.input )
     print "\ttz=[",tz,"] :ty_tms in range(tmaxy, tminy-1, -1) tmaxy[",tmaxy,"] tminy[",tminy,"] ; ((tmaxy-tminy)) y_tiles[",i_y_column_count,"]"
    if self.options.resume:
     i_count = self.tile_exists(0, 0, tz,2)
-    print "\tTile generation skipped because of --??? ;  x/y-tiles of z[",tz,"]  x/y_tiles[",tcount,"] i_count[",i_count,"]"
+    if self.options.verbose:
+     print "\tTile generation skipped because of --??? ;  x/y-tiles of z[",tz,"]  x/y_tiles[",tcount,"] i_count[",i_count,"]"
     if i_count == tcount:
      if self.options.verbose:
       print "\tTile generation skipped because of --resume ;  x/y-tiles of z[",tz,"]  x/y_tiles[",tcount,"]"
@@ -1225,7 +1668,8 @@ gdal2mbtiles temp.vrt""" % self.input )
     tmaxy_work=tmaxy
     if self.options.resume:
      i_count = self.tile_exists(tx, 0, tz,3)
-     print "\tTile generation skipped because of --??? ;  z =",tz," ; y-tiles of x[",tx,"]  y_tiles[",i_y_column_count,"] i_count[",i_count,"]"
+     if self.options.verbose:
+      print "\tTile generation skipped because of --??? ;  z =",tz," ; y-tiles of x[",tx,"]  y_tiles[",i_y_column_count,"] i_count[",i_count,"]"
      if i_count == i_y_column_count:
       if self.options.verbose:
        print "\tTile generation skipped because of --resume ;  z =",tz," ; y-tiles of x[",tx,"]  y_tiles[",i_y_column_count,"]"
@@ -1242,9 +1686,7 @@ gdal2mbtiles temp.vrt""" % self.input )
      if self.options.tms_osm:
       ty=ty_osm
      if self.stopped:
-      if self.options.mbtiles:
-       if self.mbtiles_db:
-        self.mbtiles_db.close_db()
+      self.mbtiles_close()
       break
 
      ti += 1
@@ -1260,15 +1702,18 @@ gdal2mbtiles temp.vrt""" % self.input )
       if self.options.verbose:
        print ti, '/', tcount, self.get_verbose_tile_name(tx, ty, tz)
       try:
-       self.write_overview_tile(tx, ty, tz,self.options.tms_osm)
+       i_bytes = self.write_overview_tile(tx, ty, tz,self.options.tms_osm)
       except ImageOutputException, e:
        self.error("'%d/%d/%d': %s" % (tz, tx, ty, e.message))
+     else:
+      i_bytes = 0
 
-     if not self.options.verbose or self.is_subprocess:
-      self.progressbar( ti / float(tcount) )
-  if self.options.mbtiles:
-   if self.mbtiles_db:
-    self.mbtiles_db.close_db()
+     self.progress.update(1, i_bytes or 0)
+  if profiler:
+   profile_stop(profiler, "%s.z%d.prof" % (self.output.rstrip('/'), tz))
+  if not self.stopped:
+   self.progress.finish()
+  self.mbtiles_close()
 
  # -------------------------------------------------------------------------
  def generate_kml(self):
@@ -2232,22 +2677,106 @@ gdal2mbtiles temp.vrt""" % self.input )
 # =============================================================================
 # =============================================================================
 
+""" GDAL2MbTiles of worker_context, by their arguments """
+worker_contexts = {}
+
+
+def worker_context(arguments, gdalcache=None):
 
-def ImageOutput(name, out_ds, tile_size, resampling, init_dest, output_dir, verbose,mbtiles):
+ """Return an opened GDAL2MbTiles for arguments, kept for the next tasks of a pp worker.
+
+ The arguments are parsed and the input (with its warped VRT) is opened only for the first task,
+ the later tasks with the same arguments reuse the dataset, the ImageOutput and the open mbtiles.
+ They stay open until worker_shutdown, or until the input files have changed.
+ """
+
+ key = (tuple(arguments), gdalcache)
+ g2t = worker_contexts.get(key)
+ if g2t is None or g2t.stopped or g2t.opened_stat != g2t.input_stat():
+  if g2t is not None:
+   g2t.close()
+  g2t = GDAL2MbTiles(arguments, is_subprocess=True, gdalcache=gdalcache)
+  g2t.keep_open = True
+  g2t.open_input()
+  worker_contexts[key] = g2t
+ return g2t
+
+
+def worker_shutdown(arguments=None, gdalcache=None):
+
+ """Close the GDAL2MbTiles of worker_context for arguments, all of them when arguments is None."""
+
+ if arguments is None:
+  keys = worker_contexts.keys()
+ else:
+  keys = [(tuple(arguments), gdalcache)]
+ for key in keys:
+  g2t = worker_contexts.pop(key, None)
+  if g2t is not None:
+   g2t.close()
+
+
+def cluster_block(arguments, block):
+
+ """Return [(tx, ty, image_data)] of the base tiles of block (tz, tminx, tminy, tmaxx, tmaxy), in a pp worker.
+
+ The input is opened once for all the blocks of a worker [worker_context], the tiles are written
+ into a temporary directory of the worker and removed once read.
+ """
+
+ g2t = worker_context(arguments)
+ if g2t.cluster_dir is None:
+  import tempfile
+  g2t.cluster_dir = tempfile.mkdtemp(prefix='gdal2mbtiles-')
+  g2t.image_output.output_dir = g2t.cluster_dir
+  if g2t.mosaic:
+   g2t.image_output.prefetch = g2t.mosaic
+ tz, tminx, tminy, tmaxx, tmaxy = block
+ plan = g2t.cluster_plans.get(tz)
+ if plan is None:
+  # the windows of the last column and row depend on the whole zoom level
+  plan = g2t.cluster_plans[tz] = g2t.base_tiles_plan(*(g2t.tminmax[tz] + (tz,)))
+ tiles = []
+ for tx, ty_tms in g2t.base_tiles_order(tminx, tminy, tmaxx, tmaxy, tz):
+  ty = ty_tms
+  if g2t.options.tms_osm:
+   ty = g2t.flip_y(tz, ty_tms)
+  tiles.append((tx, ty, g2t.encode_base_tile(tx, ty, tz, plan.xyzzy(tx, ty_tms))))
+ return tiles
+
+
+def cluster_tiles(arguments, block):
+
+ """Return (block, cluster_block), run by the pp workers of '--ppservers' where gdal2mbtiles is imported as a module."""
+
+ return (block, gdal2mbtiles.cluster_block(arguments, block))
+
+
+def cluster_shutdown(arguments):
+
+ """Close the worker_context of cluster_block, with its temporary directory, in a pp worker of '--ppservers'.
+
+ Run once in every worker by pp Server.each.
+ """
+
+ gdal2mbtiles.worker_shutdown(arguments)
+
+
+def ImageOutput(name, out_ds, tile_size, resampling, init_dest, output_dir, verbose,mbtiles,png8=0):
 
  """Return object representing tile image output implementing given parameters."""
 
  resampler = Resampler(resampling)
 
  if name == "hybrid":
-  return HybridImageOutput(out_ds, tile_size, resampler, init_dest, output_dir, verbose)
+  return HybridImageOutput(out_ds, tile_size, resampler, init_dest, output_dir, verbose, mbtiles, png8)
 
  if name == "png":
   image_format = "PNG"
  elif name == "jpeg":
   image_format = "JPEG"
 
- return SimpleImageOutput(out_ds, tile_size, resampler, init_dest, output_dir, verbose, [image_format],mbtiles)
+ return SimpleImageOutput(out_ds, tile_size, resampler, init_dest, output_dir, verbose, [image_format],mbtiles,png8)
 
 
 class ImageOutputException(Exception):
@@ -2265,9 +2794,12 @@ class BaseImageOutput(object):
 
  When this class is instantiated with only one image format, it is stored in
  a member field `format'.
+
+ With `png8', png tiles with up to that many distinct colours are rewritten
+ as 8-bit paletted png when this is smaller.
  """
 
- def __init__(self, out_ds, tile_size, resampler, init_dest, output_dir, verbose, image_formats,mbtiles):
+ def __init__(self, out_ds, tile_size, resampler, init_dest, output_dir, verbose, image_formats,mbtiles,png8=0):
   self.out_ds = out_ds
   self.tile_size = tile_size
   self.resampler = resampler
@@ -2276,12 +2808,17 @@ class BaseImageOutput(object):
   self.verbose = verbose
   self.image_formats = image_formats
   self.mbtiles=mbtiles;
+  self.png8 = png8
   if len(self.image_formats) == 1:
    self.format = self.image_formats[0]
 
   self.mem_drv = get_gdal_driver("MEM")
   self.alpha = None
   self.alpha_filler = None
+  # SourcePrefetch [--prefetch] or SourceMosaic [--mosaic], set by generate_base_tiles
+  self.prefetch = None
+  # name of the ReadRaster stage in timings, set by open_input
+  self.read_stage = "read"
 
   # Get alpha band (either directly or from NODATA value)
   self.alpha_band = self.out_ds.GetRasterBand(1).GetMaskBand()
@@ -2296,8 +2833,14 @@ class BaseImageOutput(object):
   """Create image of a base level tile and write it to disk."""
 
   data_bands = range(1, self.data_bands_count+1)
-  data = self.out_ds.ReadRaster(xyzzy.rx, xyzzy.ry, xyzzy.rxsize, xyzzy.rysize,
-           xyzzy.wxsize, xyzzy.wysize, band_list=data_bands)
+  data = None
+  started = timings.start()
+  if self.prefetch:
+   data = self.prefetch.read(xyzzy)
+  if data is None:
+   data = self.out_ds.ReadRaster(xyzzy.rx, xyzzy.ry, xyzzy.rxsize, xyzzy.rysize,
+            xyzzy.wxsize, xyzzy.wysize, band_list=data_bands)
+  timings.stop(self.read_stage, started)
 
   image_format = self.get_base_tile_format(tx, ty, tz, xyzzy)
 
@@ -2338,8 +2881,11 @@ class BaseImageOutput(object):
    if image_format == "PNG":
     dsquery.WriteRaster(xyzzy.wx, xyzzy.wy, xyzzy.wxsize, xyzzy.wysize, self.alpha,band_list=[num_bands])
 
+   started = timings.start()
    self.resampler(path, dsquery, dstile, image_format)
+   timings.stop('resample', started)
 
+  self.write_png8(path, image_format)
   self.alpha = None
 
  def write_overview_tile(self, tx, ty, tz,tms_osm):
@@ -2391,6 +2937,11 @@ class BaseImageOutput(object):
 
    dsquerytile = gdal.Open(path, gdal.GA_ReadOnly)
 
+   if dsquerytile.GetRasterBand(1).GetColorTable() is not None:
+    # 8-bit paletted png [--png8]
+    self.write_paletted_tile(dsquery, tileposx, tileposy, path, num_bands)
+    continue
+
    dsquery.WriteRaster(tileposx, tileposy, self.tile_size, self.tile_size,
     dsquerytile.ReadRaster(0, 0, self.tile_size, self.tile_size),
     band_list=range(1, dsquerytile.RasterCount+1))
@@ -2401,7 +2952,29 @@ class BaseImageOutput(object):
 
   dstile = self.mem_drv.Create('', self.tile_size, self.tile_size, num_bands)
   path = self.get_full_path(tx, ty, tz, format_extension[image_format])
+  started = timings.start()
   self.resampler(path, dsquery, dstile, image_format)
+  timings.stop('resample', started)
+  self.write_png8(path, image_format)
+
+ def write_paletted_tile(self, dsquery, tileposx, tileposy, path, num_bands):
+  """Write a paletted tile into dsquery, with its colours expanded to num_bands."""
+  band_modes = {1: 'L', 2: 'LA', 3: 'RGB', 4: 'RGBA'}
+  image = Image.open(path).convert(band_modes[num_bands])
+  for i, band in enumerate(image.split()):
+   dsquery.WriteRaster(tileposx, tileposy, self.tile_size, self.tile_size, band.tobytes(), band_list=[i+1])
+
+ def write_png8(self, path, image_format):
+  """Rewrite a png tile as 8-bit paletted png, when it has up to `png8' colours and becomes smaller."""
+  if image_format != "PNG" or not self.png8 or not os.path.exists(path):
+   return
+  image = Image.open(path)
+  image.load()
+  png8_data = png8_image(image, self.png8)
+  if png8_data and len(png8_data) < os.path.getsize(path):
+   output_file = open(path, 'wb')
+   output_file.write(png8_data)
+   output_file.close()
 
  def iter_children(self, tx, ty, tz,):
   """Generate all children of the given tile produced on the lower level."""
@@ -2413,7 +2986,13 @@ class BaseImageOutput(object):
      yield x, y, image_format
 
  def read_alpha(self, xyzzy):
-  self.alpha = self.alpha_band.ReadRaster(xyzzy.rx, xyzzy.ry, xyzzy.rxsize, xyzzy.rysize, xyzzy.wxsize, xyzzy.wysize)
+  started = timings.start()
+  self.alpha = None
+  if self.prefetch:
+   self.alpha = self.prefetch.read(xyzzy, True)
+  if self.alpha is None:
+   self.alpha = self.alpha_band.ReadRaster(xyzzy.rx, xyzzy.ry, xyzzy.rxsize, xyzzy.rysize, xyzzy.wxsize, xyzzy.wysize)
+  timings.stop('read_alpha', started)
 
  def fill_init_dest(self, image):
   if self.init_dest is not None:
@@ -2465,8 +3044,8 @@ class HybridImageOutput(BaseImageOutput):
  as JPEG and the rest as PNG.
  """
 
- def __init__(self, out_ds, tile_size, resampler, init_dest, output_dir, verbose):
-  BaseImageOutput.__init__(self, out_ds, tile_size, resampler, init_dest, output_dir, verbose, ["JPEG", "PNG"],False)
+ def __init__(self, out_ds, tile_size, resampler, init_dest, output_dir, verbose, mbtiles=False, png8=0):
+  BaseImageOutput.__init__(self, out_ds, tile_size, resampler, init_dest, output_dir, verbose, ["JPEG", "PNG"],mbtiles,png8)
 
   img = self.mem_drv.Create("", self.tile_size, self.tile_size, 1)
   rb = img.GetRasterBand(1)
@@ -2533,6 +3112,240 @@ class HybridImageOutput(BaseImageOutput):
   return transparent, opaque
 
 
+class SourcePrefetch(object):
+
+ """Windows of the input raster read with ReadAsArray, from which the base tiles are sliced.
+
+ The windows are aligned to a grid of `window_size' pixels and overlap by `margin' pixels
+ (a tile), so that every tile starting in a window is inside it. The last `windows' windows
+ are kept: tiles read one after another (see GDAL2MbTiles.base_tiles_order) share them.
+ Tiles that would be read at a lower resolution (where GDAL may use overviews) are not
+ sliced: None is returned and the caller uses ReadRaster.
+ """
+
+ def __init__(self, ds, data_bands_count, alpha_band, window_size, margin, windows=4):
+  self.ds = ds
+  self.data_bands_count = data_bands_count
+  self.alpha_band = alpha_band
+  self.window_size = window_size
+  self.margin = margin
+  self.windows = windows
+  # [(key, xoff, yoff, data, alpha)], most recently used last
+  self.cache = []
+
+ def read(self, xyzzy, alpha=False):
+  """Return the data bands (or the alpha band) of a tile as ReadRaster would, or None."""
+  if xyzzy.rxsize > xyzzy.wxsize or xyzzy.rysize > xyzzy.wysize:
+   return None
+  window = self.get_window(xyzzy.rx, xyzzy.ry)
+  xoff, yoff, data, alpha_data = window[1:]
+  x, y = xyzzy.rx - xoff, xyzzy.ry - yoff
+  if x + xyzzy.rxsize > data.shape[2] or y + xyzzy.rysize > data.shape[1]:
+   return None
+  if alpha:
+   array = alpha_data[y:y+xyzzy.rysize, x:x+xyzzy.rxsize]
+  else:
+   array = data[:, y:y+xyzzy.rysize, x:x+xyzzy.rxsize]
+  if (xyzzy.rxsize, xyzzy.rysize) != (xyzzy.wxsize, xyzzy.wysize):
+   # nearest neighbour, from the centre of the pixels as GDAL does
+   xs = ((numpy.arange(xyzzy.wxsize) + 0.5) * xyzzy.rxsize / float(xyzzy.wxsize)).astype(int)
+   ys = ((numpy.arange(xyzzy.wysize) + 0.5) * xyzzy.rysize / float(xyzzy.wysize)).astype(int)
+   array = array[..., ys, :][..., xs]
+  return numpy.ascontiguousarray(array).tostring()
+
+ def get_window(self, rx, ry):
+  key = (rx / self.window_size, ry / self.window_size)
+  for i, window in enumerate(self.cache):
+   if window[0] == key:
+    del self.cache[i]
+    self.cache.append(window)
+    return window
+  xoff, yoff = key[0] * self.window_size, key[1] * self.window_size
+  xsize = min(self.window_size + self.margin, self.ds.RasterXSize - xoff)
+  ysize = min(self.window_size + self.margin, self.ds.RasterYSize - yoff)
+  data = self.ds.ReadAsArray(xoff, yoff, xsize, ysize)
+  if data.ndim == 2:
+   data = data.reshape((1, ysize, xsize))
+  data = data[:self.data_bands_count]
+  alpha = self.alpha_band.ReadAsArray(xoff, yoff, xsize, ysize)
+  window = (key, xoff, yoff, data, alpha)
+  self.cache.append(window)
+  if len(self.cache) > self.windows:
+   del self.cache[0]
+  return window
+
+
+class SourceMosaic(object):
+
+ """Several input files read as one raster, without building a VRT [--mosaic].
+
+ The footprints of the files are kept in a packed R-tree (see str_tree), so that for each
+ tile only the files that intersect it are read. The last `pool_size' opened datasets are
+ kept open, the least recently used is closed. Where files overlap, the pixels of the first
+ file in the list are used: a later file only fills the pixels that are still transparent.
+ All files must have the same Spatial Reference System and be north up.
+ """
+
+ def __init__(self, filenames, pool_size=64):
+  self.filenames = filenames
+  self.pool_size = pool_size
+  # {index: dataset}, most recently used last
+  self.pool = OrderedDict()
+  # (index, geotransform, xsize, ysize, bands)
+  self.sources = []
+  self.projection = None
+  srs = None
+  footprints = []
+  for index, filename in enumerate(filenames):
+   ds = gdal.Open(filename, gdal.GA_ReadOnly)
+   if not ds:
+    raise Exception("It is not possible to open the input file '%s'." % filename)
+   gt = ds.GetGeoTransform()
+   if gt[2] != 0.0 or gt[4] != 0.0:
+    raise Exception("The input file '%s' is rotated, only north up files can be used in a mosaic." % filename)
+   if ds.GetRasterBand(1).GetRasterColorTable():
+    raise Exception("The input file '%s' is paletted, please convert it to RGB/RGBA." % filename)
+   if self.projection is None:
+    self.projection = ds.GetProjection()
+    srs = osr.SpatialReference()
+    srs.ImportFromWkt(self.projection)
+   else:
+    ds_srs = osr.SpatialReference()
+    ds_srs.ImportFromWkt(ds.GetProjection())
+    if ds_srs.ExportToProj4() != srs.ExportToProj4():
+     raise Exception("The input file '%s' has another Spatial Reference System than '%s'." % (filename, filenames[0]))
+   self.sources.append((index, gt, ds.RasterXSize, ds.RasterYSize, ds.RasterCount))
+   footprints.append((gt[0], gt[3] + ds.RasterYSize * gt[5], gt[0] + ds.RasterXSize * gt[1], gt[3], index))
+   ds = None
+  self.tree = str_tree(footprints)
+  # the highest resolution of the files, over the extent of all files
+  minx = min([f[0] for f in footprints])
+  miny = min([f[1] for f in footprints])
+  maxx = max([f[2] for f in footprints])
+  maxy = max([f[3] for f in footprints])
+  res = min([min(abs(source[1][1]), abs(source[1][5])) for source in self.sources])
+  self.geotransform = (minx, res, 0.0, maxy, 0.0, -res)
+  self.xsize = int(math.ceil((maxx - minx) / res - 0.001))
+  self.ysize = int(math.ceil((maxy - miny) / res - 0.001))
+  # (key, data, alpha) of the last tile
+  self.last = None
+
+ def dataset(self):
+  """Return a VRT without sources with the geotransform, size and RGBA bands of the mosaic."""
+  ds = gdal.GetDriverByName('VRT').Create('', self.xsize, self.ysize, 4, gdal.GDT_Byte)
+  ds.SetGeoTransform(self.geotransform)
+  ds.SetProjection(self.projection)
+  for i, color in enumerate((gdal.GCI_RedBand, gdal.GCI_GreenBand, gdal.GCI_BlueBand, gdal.GCI_AlphaBand)):
+   ds.GetRasterBand(i+1).SetRasterColorInterpretation(color)
+  return ds
+
+ def get_dataset(self, index):
+  ds = self.pool.pop(index, None)
+  if ds is None:
+   ds = gdal.Open(self.filenames[index], gdal.GA_ReadOnly)
+   if len(self.pool) >= self.pool_size:
+    self.pool.popitem(last=False)
+  self.pool[index] = ds
+  return ds
+
+ def read(self, xyzzy, alpha=False):
+  """Return the RGB bands (or the alpha band) of a tile as ReadRaster would."""
+  key = (xyzzy.rx, xyzzy.ry, xyzzy.rxsize, xyzzy.rysize, xyzzy.wxsize, xyzzy.wysize)
+  if self.last is None or self.last[0] != key:
+   self.last = (key,) + self.compose(xyzzy)
+  if alpha:
+   return self.last[2].tostring()
+  return self.last[1].tostring()
+
+ def compose(self, xyzzy):
+  gt = self.geotransform
+  # the georeference of the read window, the scale from the window to the tile
+  minx = gt[0] + xyzzy.rx * gt[1]
+  maxy = gt[3] + xyzzy.ry * gt[5]
+  maxx = minx + xyzzy.rxsize * gt[1]
+  miny = maxy + xyzzy.rysize * gt[5]
+  xscale = xyzzy.wxsize / float(maxx - minx)
+  yscale = xyzzy.wysize / float(maxy - miny)
+  data = numpy.zeros((3, xyzzy.wysize, xyzzy.wxsize), numpy.uint8)
+  alpha = numpy.zeros((xyzzy.wysize, xyzzy.wxsize), numpy.uint8)
+  for index in sorted(str_tree_query(self.tree, (minx, miny, maxx, maxy))):
+   sgt, sxsize, sysize, sbands = self.sources[index][1:]
+   # the part of the tile covered by the file, in tile pixels
+   wx0 = max(0, int(round((sgt[0] - minx) * xscale)))
+   wx1 = min(xyzzy.wxsize, int(round((sgt[0] + sxsize * sgt[1] - minx) * xscale)))
+   wy0 = max(0, int(round((maxy - sgt[3]) * yscale)))
+   wy1 = min(xyzzy.wysize, int(round((maxy - sgt[3] - sysize * sgt[5]) * yscale)))
+   if wx1 <= wx0 or wy1 <= wy0:
+    continue
+   if alpha[wy0:wy1, wx0:wx1].all():
+    # covered by a file with a higher priority
+    continue
+   # the same part in file pixels
+   sx0 = max(0, int(round((minx + wx0 / xscale - sgt[0]) / sgt[1])))
+   sx1 = min(sxsize, max(sx0 + 1, int(round((minx + wx1 / xscale - sgt[0]) / sgt[1]))))
+   sy0 = max(0, int(round((maxy - wy0 / yscale - sgt[3]) / sgt[5])))
+   sy1 = min(sysize, max(sy0 + 1, int(round((maxy - wy1 / yscale - sgt[3]) / sgt[5]))))
+   ds = self.get_dataset(index)
+   if sbands >= 3:
+    band_list = [1, 2, 3]
+   else:
+    band_list = [1, 1, 1]
+   wxsize, wysize = wx1 - wx0, wy1 - wy0
+   sdata = numpy.frombuffer(ds.ReadRaster(sx0, sy0, sx1 - sx0, sy1 - sy0, wxsize, wysize, band_list=band_list),
+    numpy.uint8).reshape((3, wysize, wxsize))
+   salpha = numpy.frombuffer(ds.GetRasterBand(1).GetMaskBand().ReadRaster(sx0, sy0, sx1 - sx0, sy1 - sy0, wxsize, wysize),
+    numpy.uint8).reshape((wysize, wxsize))
+   # only the pixels that are still transparent
+   fill = (alpha[wy0:wy1, wx0:wx1] == 0) & (salpha != 0)
+   data[:, wy0:wy1, wx0:wx1][:, fill] = sdata[:, fill]
+   alpha[wy0:wy1, wx0:wx1][fill] = salpha[fill]
+  return data, alpha
+
+
+def str_tree(items, node_size=16):
+
+ """Return a packed R-tree of (minx, miny, maxx, maxy, value) items, built with Sort-Tile-Recursive.
+
+ A node is (minx, miny, maxx, maxy, children), a leaf is an item.
+ """
+
+ nodes = list(items)
+ while True:
+  nodes = [(min([n[0] for n in group]), min([n[1] for n in group]),
+   max([n[2] for n in group]), max([n[3] for n in group]), group) for group in str_groups(nodes, node_size)]
+  if len(nodes) <= 1:
+   return nodes
+
+
+def str_groups(nodes, node_size):
+ """Groups of node_size nodes, in vertical slices sorted by x then by y."""
+ count = int(math.ceil(len(nodes) / float(node_size)))
+ slice_size = int(math.ceil(math.sqrt(count))) * node_size
+ nodes = sorted(nodes, key=lambda n: n[0] + n[2])
+ groups = []
+ for i in range(0, len(nodes), slice_size):
+  column = sorted(nodes[i:i+slice_size], key=lambda n: n[1] + n[3])
+  for j in range(0, len(column), node_size):
+   groups.append(column[j:j+node_size])
+ return groups
+
+
+def str_tree_query(tree, bounds):
+ """Return the values of the items of a str_tree that intersect bounds (minx, miny, maxx, maxy)."""
+ minx, miny, maxx, maxy = bounds
+ values = []
+ stack = list(tree)
+ while stack:
+  node = stack.pop()
+  if node[0] >= maxx or node[2] <= minx or node[1] >= maxy or node[3] <= miny:
+   continue
+  if isinstance(node[4], list):
+   stack.extend(node[4])
+  else:
+   values.append(node[4])
+ return values
+
+
 def Resampler(name):
 
  """Return a function performing given resampling algorithm."""
@@ -2556,15 +3369,17 @@ def Resampler(name):
   im1 = im.resize((tilesize,tilesize), Image.ANTIALIAS)
 
   if os.path.exists(path):
-   im0 = Image.open(path)
+   im0 = Image.open(path).convert(im1.mode)
    im1 = Image.composite(im1, im0, im1)
 
   ensure_dir_exists(path)
 
+  started = timings.start()
   if image_format == "JPEG":
    im1.save(path, image_format, quality=jpeg_quality)
   else:
    im1.save(path, image_format)
+  timings.stop('encode', started)
 
 
  if name == "average":
@@ -2602,10 +3417,13 @@ def gdal_write(path, dstile, image_format):
  ensure_dir_exists(path)
  driver = get_gdal_driver(image_format)
 
+ # encoding and writing of the tile file
+ started = timings.start()
  if image_format == "JPEG":
   driver.CreateCopy(path, dstile, strict=0, options=jpeg_gdal_options)
  else:
   driver.CreateCopy(path, dstile, strict=0)
+ timings.stop('encode', started)
 
 
 def get_gdal_driver(name):
@@ -2629,6 +3447,25 @@ def ensure_dir_exists(path):
   os.makedirs(dirname)
 
 
+def hilbert_xy(n, d):
+ """Position (x, y) of the d-th cell of a Hilbert curve filling a n x n square, n a power of 2."""
+ x = y = 0
+ s = 1
+ while s < n:
+  rx = 1 & (d / 2)
+  ry = 1 & (d ^ rx)
+  if ry == 0:
+   if rx == 1:
+    x = s-1 - x
+    y = s-1 - y
+   x, y = y, x
+  x += s * rx
+  y += s * ry
+  d /= 4
+  s *= 2
+ return x, y
+
+
 class Xyzzy(object):
 
  """Collection of coordinates describing what to read where for the given tile at the base level."""
@@ -2644,6 +3481,56 @@ class Xyzzy(object):
   self.wxsize = wxsize
   self.wysize = wysize
 
+
+class BaseTilesPlan(object):
+
+ """Read and write windows of the base tiles of a zoom level [GDAL2MbTiles.base_tiles_plan].
+
+ x_table[tx-tminx] is (rx, rxsize, wx, wxsize), y_table[ty_tms-tminy] is (ry, rysize, wy, wysize).
+ Only lists of ints are kept, so that a plan can be pickled and handed to other processes.
+ """
+
+ def __init__(self, querysize, tminx, tminy, x_table, y_table):
+  self.querysize = querysize
+  self.tminx = tminx
+  self.tminy = tminy
+  self.x_table = [tuple(row) for row in x_table]
+  self.y_table = [tuple(row) for row in y_table]
+
+ def xyzzy(self, tx, ty_tms):
+  """Return the Xyzzy of a base tile."""
+  rx, rxsize, wx, wxsize = self.x_table[tx - self.tminx]
+  ry, rysize, wy, wysize = self.y_table[ty_tms - self.tminy]
+  return Xyzzy(self.querysize, rx, ry, rxsize, rysize, wx, wy, wxsize, wysize)
+
+
+def geo_query_axis(origin, res, raster_size, ul, lr, querysize=0):
+
+ """GDAL2MbTiles.geo_query for one axis of numpy arrays of tile coordinates.
+
+ origin and res are taken from the geotransform (0, 1 for x ; 3, 5 for y), ul and lr are the
+ upper-left and lower-right coordinates of the tiles. The same clipping at the borders of the
+ raster is done, with the same integer truncations. Return the rows (r, rsize, w, wsize).
+ """
+
+ r = ((ul - origin) / res + 0.001).astype(int)
+ rsize = ((lr - ul) / res + 0.5).astype(int)
+ if not querysize:
+  wsize = rsize.copy()
+ else:
+  wsize = numpy.zeros_like(rsize) + querysize
+ with numpy.errstate(divide='ignore', invalid='ignore'):
+  # Coordinates should not go out of the bounds of the raster
+  ratio = numpy.where(r < 0, -r, 0) / rsize.astype(float)
+  w = numpy.where(r < 0, (wsize * ratio).astype(int), 0)
+  wsize = wsize - w
+  rsize = numpy.where(r < 0, rsize - (rsize * ratio).astype(int), rsize)
+  r = numpy.maximum(r, 0)
+  over = r + rsize > raster_size
+  wsize = numpy.where(over, (wsize * ((raster_size - r) / rsize.astype(float))).astype(int), wsize)
+  rsize = numpy.where(over, raster_size - r, rsize)
+ return zip(r.tolist(), rsize.tolist(), w.tolist(), wsize.tolist())
+
 # ------------------------------------------------
 # Functions for calculating KML <LookAt> tag:
 
@@ -3,6 +3,7 @@
 from osgeo import gdal
 from osgeo import osr
 import tempfile
+import hashlib
 import os
 import preprocess
 
@@ -11,8 +12,13 @@ from config import _
 
 gdal.AllRegister()
 vrt_drv = gdal.GetDriverByName( 'VRT' )
+tiff_drv = gdal.GetDriverByName( 'GTiff' )
 
 palettecolors = ['Red','Green','Blue','Alpha']
+# Creation options of the working copy: NUM_THREADS compresses the blocks in parallel [GDAL >= 2.1]
+workingcopy_options = ['TILED=YES','BLOCKXSIZE=256','BLOCKYSIZE=256','COMPRESS=DEFLATE','PREDICTOR=2','BIGTIFF=IF_SAFER','NUM_THREADS=ALL_CPUS']
+# Part of the name of a cached working copy: to be raised when workingcopy writes a different file
+workingcopy_version = 1
 reference = osr.SpatialReference()
 
 
@@ -94,6 +100,93 @@ def singlefile(filename, bbox = None):
 	srs = reference.ExportToPrettyWkt()
 	return filename, georeference, realfilename, geotransform, xsize, ysize, srs
 
+def checksum(filename, blocksize = 1048576):
+	"Returns a md5 checksum of the files of a raster: size, first and last block of each file, mtime of a file not read whole"
+	
+	md5 = hashlib.md5()
+	in_ds = gdal.Open( filename, gdal.GA_ReadOnly)
+	if in_ds:
+		filelist = in_ds.GetFileList() or [filename]
+	else:
+		filelist = [filename]
+	in_ds = None
+	for name in filelist:
+		if not os.path.isfile(name):
+			continue
+		# The name is not used: a VRT from singlefile has a new temporary name for each run
+		size = os.path.getsize(name)
+		md5.update(str(size))
+		if size > 2*blocksize:
+			# Read only in part: the mtime shows a change in the middle [a file read whole, as that VRT, needs none]
+			md5.update(repr(os.path.getmtime(name)))
+		f = open(name, 'rb')
+		try:
+			md5.update(f.read(blocksize))
+			if size > 2*blocksize:
+				f.seek(-blocksize, os.SEEK_END)
+				md5.update(f.read(blocksize))
+			elif size > blocksize:
+				md5.update(f.read())
+		finally:
+			f.close()
+	return md5.hexdigest()
+
+def workingcopy(filename, cachedir = None, options = workingcopy_options):
+	"Returns the filename of a tiled, compressed GeoTIFF of filename with internal overviews, paletted files are expanded to RGBA"
+	
+	if not cachedir:
+		cachedir = os.path.join(tempfile.gettempdir(), 'mapmbtiles')
+	if not os.path.exists(cachedir):
+		os.makedirs(cachedir)
+	# The same input written with other options or by another version is another working copy
+	md5 = hashlib.md5(checksum(filename))
+	md5.update(str(workingcopy_version))
+	md5.update(repr(list(options)))
+	copyfilename = os.path.join(cachedir, md5.hexdigest()+'.tif')
+	if os.path.exists(copyfilename):
+		# Converted by an earlier run
+		return copyfilename
+	
+	in_ds = gdal.Open( filename, gdal.GA_ReadOnly)
+	if not in_ds:
+		raise PreprocessError(_("It is not possible to open the input file '%s'.") % filename)
+	vrtfilename = None
+	if in_ds.GetRasterBand(1).GetRasterColorTable() and in_ds.RasterCount==1:
+		# Expand rasters with palette into RGBA
+		vrtfilename = str(tempfile.mktemp(os.path.basename(filename)+'.vrt'))
+		preprocess.Preprocess(['','-o',vrtfilename,filename])
+		in_ds = gdal.Open( vrtfilename, gdal.GA_ReadOnly)
+	
+	# Written to a temporary name, a file with the checksum name is always complete
+	tmpfilename = copyfilename+'.%d.tmp' % os.getpid()
+	# Decoding drivers (JPEG2000, ...) also use all cpus
+	threads = gdal.GetConfigOption('GDAL_NUM_THREADS', None)
+	gdal.SetConfigOption('GDAL_NUM_THREADS', 'ALL_CPUS')
+	try:
+		out_ds = tiff_drv.CreateCopy(tmpfilename, in_ds, 0, options)
+		if not out_ds:
+			raise PreprocessError(_("It is not possible to create the working copy '%s'.") % tmpfilename)
+		# Internal overviews, halved until the raster fits in one block
+		levels = []
+		level = 2
+		while max(out_ds.RasterXSize, out_ds.RasterYSize) / (level / 2) > 256:
+			levels.append(level)
+			level *= 2
+		if levels:
+			gdal.SetConfigOption('COMPRESS_OVERVIEW', 'DEFLATE')
+			out_ds.BuildOverviews('AVERAGE', levels)
+			gdal.SetConfigOption('COMPRESS_OVERVIEW', None)
+		out_ds = None
+		in_ds = None
+		os.rename(tmpfilename, copyfilename)
+	finally:
+		gdal.SetConfigOption('GDAL_NUM_THREADS', threads)
+		if os.path.exists(tmpfilename):
+			os.remove(tmpfilename)
+		if vrtfilename and os.path.exists(vrtfilename):
+			os.remove(vrtfilename)
+	return copyfilename
+
 def SRSInput(srs):
 	osr.UseExceptions()
 	reference.SetFromUserInput(srs)
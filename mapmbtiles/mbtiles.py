@@ -41,16 +41,19 @@
 from osgeo import gdal,osr
 
 import collections
+import hashlib
 import json
 import logging
 import mimetypes
 import math
+import multiprocessing
 import operator
 import os
 from pkg_resources import parse_version
 import re
 import shutil
 import sqlite3
+import struct
 import sys
 import tempfile
 import urllib
@@ -63,11 +66,12 @@ from zipfile import ZipFile, ZIP_DEFLATED, ZIP_STORED
 from io import BytesIO
 
 from globalmercator import GlobalMercator
+from timing import timings
 
 has_pil = False
 
 try:
- from PIL import Image, ImageEnhance
+ from PIL import Image, ImageChops, ImageEnhance, ImageStat
  has_pil = True
  import numpy
  from xml.etree import ElementTree
@@ -93,9 +97,174 @@ DEFAULT_TILE_FORMAT = 'image/jpeg'
 DOWNLOAD_RETRIES = 10
 """ Path to fonts for Mapnik rendering """
 TRUETYPE_FONTS_PATH = '/usr/share/fonts/truetype/'
+""" SQLite connection profiles: PRAGMAs set by MbTiles.optimize_connection [page_size only when the db is created] """
+MBTILES_PROFILES = {
+ # one writer building a file: nothing is synced and the file is locked until close_db
+ 'bulk': [('page_size',4096),('cache_size',-262144),('synchronous','OFF'),('locking_mode','EXCLUSIVE'),('journal_mode','DELETE'),('temp_store','MEMORY')],
+ # adding to a file that others may be reading: WAL with a commit per tile without a sync
+ 'append': [('page_size',4096),('cache_size',-65536),('synchronous','NORMAL'),('journal_mode','WAL'),('temp_store','MEMORY')],
+ # many readers [MBTilesReader, tile servers]: memory mapped, no writing possible
+ # - journal_mode is not changed, since this would write to the file [files written with 'append' are WAL while open]
+ 'read': [('cache_size',-65536),('mmap_size',268435456),('query_only',1)],
+ # sqlite3 defaults
+ 'default': []
+}
+""" Table layouts: 'text' - 'z-x-y.tms' tile_id strings ; 'compact' - integer content-hash keys, map WITHOUT ROWID [SQLite >= 3.8.2] """
+MBTILES_SCHEMAS = ('text','compact')
+""" Default connection profile for MbTiles.open_db (see samples/MBTiles_Profiles_Benchmark.py) """
+DEFAULT_MBTILES_PROFILE = 'append'
+""" 8-bit paletted png: max. mean difference [0-255] of a band to the original image """
+PNG8_MAX_ERROR = 1.0
 
 logger = logging.getLogger(__name__)
 
+# =============================================================================
+# used by MbTiles.build_overviews, at module level so that it can be run by multiprocessing
+# =============================================================================
+def overview_tiles(job):
+ """
+ Build the parent tiles of one tile_column from their (up to 4) children.
+ job -- (tz,tx,children,pil_format,jpg_quality,s_y_type) ; children: {ty: [(child_x,child_y,tile_data),...]}
+ pil_format -- None for 'hybrid' : see hybrid_format
+ returns a list of (tz,tx,ty,s_tile_id,tile_data) as used by MbTiles.insert_tile
+ """
+ tz,tx,children,pil_format,jpg_quality,s_y_type=job
+ tiles_list=[]
+ for ty in sorted(children):
+  parent_image=None
+  for child_x,child_y,tile_data in children[ty]:
+   child_image=Image.open(BytesIO(tile_data))
+   if parent_image is None:
+    i_tilesize=child_image.size[0]
+    if pil_format == 'JPEG':
+     # as retrieve_blank_image(0,0,0) for missing tiles
+     parent_image=Image.new('RGB',(2*i_tilesize,2*i_tilesize),(0,0,0))
+    else:
+     parent_image=Image.new('RGBA',(2*i_tilesize,2*i_tilesize),(0,0,0,0))
+   if child_image.mode != parent_image.mode:
+    child_image=child_image.convert(parent_image.mode)
+   if child_image.size != (i_tilesize,i_tilesize):
+    child_image=child_image.resize((i_tilesize,i_tilesize),Image.ANTIALIAS)
+   i_left=(child_x-2*tx)*i_tilesize
+   if s_y_type == 'osm':
+    # osm: tile_row grows to the south
+    i_top=(child_y-2*ty)*i_tilesize
+   else:
+    i_top=(2*ty+1-child_y)*i_tilesize
+   parent_image.paste(child_image,(i_left,i_top))
+  parent_image=parent_image.resize((i_tilesize,i_tilesize),Image.ANTIALIAS)
+  s_save_format=pil_format
+  if s_save_format is None:
+   s_save_format=hybrid_format(parent_image)
+   if s_save_format is None:
+    continue
+   if s_save_format == 'JPEG':
+    parent_image=parent_image.convert('RGB')
+  output_data=BytesIO()
+  if s_save_format == 'JPEG':
+   parent_image.save(output_data,format="JPEG", quality=jpg_quality, optimize=True, progressive=False)
+  else:
+   parent_image.save(output_data,format="PNG",optimize=True)
+  # as check_image
+  colors = parent_image.getcolors(1)
+  if colors:
+   rgb_values=colors[0][1]
+   s_tile_id = "%2x-%2x-%2x.rgb"%(int(rgb_values[0]),int(rgb_values[1]),int(rgb_values[2]))
+  else:
+   s_tile_id="{0}-{1}-{2}.{3}".format(str(tz),str(tx),str(ty),s_y_type)
+  tiles_list.append((tz,tx,ty,s_tile_id,output_data.getvalue()))
+ return tiles_list
+
+# =============================================================================
+# 'hybrid' mbtiles: jpg for opaque tiles, png for (partially) transparent tiles
+# =============================================================================
+def sniff_format(tile_data):
+ """
+ Return the format of encoded image data from its first bytes: 'png', 'jpg', 'webp' or None.
+ """
+ s_header=bytes(tile_data[:12])
+ if s_header.startswith('\x89PNG'):
+  return 'png'
+ if s_header.startswith('\xff\xd8'):
+  return 'jpg'
+ if s_header.startswith('RIFF') and s_header[8:12] == 'WEBP':
+  return 'webp'
+ return None
+
+def hybrid_format(input_image):
+ """
+ The PIL format of an image in a 'hybrid' mbtiles: 'JPEG' when opaque, 'PNG' when partially transparent.
+ returns None when fully transparent [not stored]
+ """
+ if input_image.mode == 'P' and 'transparency' in input_image.info:
+  input_image=input_image.convert('RGBA')
+ if input_image.mode == 'RGBA' or input_image.mode == 'LA':
+  i_alpha_min,i_alpha_max=input_image.getextrema()[-1]
+  if i_alpha_max == 0:
+   return None
+  if i_alpha_min < 255:
+   return 'PNG'
+ return 'JPEG'
+
+# =============================================================================
+# used by MbTiles.check_image and gdal2mbtiles [--png8]
+# =============================================================================
+def png8_image(input_image,i_max_colors=256,f_max_error=PNG8_MAX_ERROR):
+ """
+ Encode an image with not more than i_max_colors distinct colours as 8-bit paletted png.
+ returns the png data or None [more colours, or a band differs more than f_max_error from the original]
+ """
+ if input_image.mode != 'RGB' and input_image.mode != 'RGBA':
+  input_image=input_image.convert('RGBA')
+ colors=input_image.getcolors(min(i_max_colors,256))
+ if not colors:
+  return None
+ if input_image.mode == 'RGBA' and min([rgb_values[3] for i_count,rgb_values in colors]) == 255:
+  # fully opaque: no transparency in the palette
+  input_image=input_image.convert('RGB')
+ if input_image.mode == 'RGBA':
+  paletted_image=input_image.quantize(len(colors),Image.FASTOCTREE)
+ else:
+  paletted_image=input_image.quantize(len(colors))
+ difference=ImageChops.difference(input_image,paletted_image.convert(input_image.mode))
+ if max(ImageStat.Stat(difference).mean) > f_max_error:
+  return None
+ output_data=BytesIO()
+ paletted_image.save(output_data,format="PNG",optimize=True)
+ return output_data.getvalue()
+
+# =============================================================================
+# used by MbTiles.mbtiles_transcode, at module level so that it can be run by multiprocessing
+# =============================================================================
+def transcode_image(job):
+ """
+ Encode one image in another format or quality.
+ job -- (key,tile_data,pil_format,jpg_quality,png8_colors) ; key: tile_hash or rowid of images
+ pil_format -- None for 'hybrid' : see hybrid_format [fully transparent images are stored as png]
+ png8_colors -- png images with up to png8_colors colours become 8-bit paletted png when smaller [0: not used]
+ returns (key,tile_data) ; tile_data is None when the image could not be read
+ """
+ key,tile_data,pil_format,jpg_quality,png8_colors=job
+ try:
+  input_image=Image.open(BytesIO(tile_data))
+  input_image.load()
+ except IOError:
+  return (key,None)
+ if pil_format is None:
+  pil_format=hybrid_format(input_image) or 'PNG'
+ output_data=BytesIO()
+ if pil_format == 'JPEG':
+  if input_image.mode != 'RGB':
+   input_image=input_image.convert('RGB')
+  input_image.save(output_data,format="JPEG", quality=jpg_quality, optimize=True, progressive=False)
+ else:
+  input_image.save(output_data,format="PNG",optimize=True)
+  if png8_colors:
+   png8_data=png8_image(input_image,png8_colors)
+   if png8_data and len(png8_data) < output_data.tell():
+    return (key,png8_data)
+ return (key,output_data.getvalue())
+
 # =============================================================================
 # UPDATE map SET tile_id = replace(tile_id, '.None', '.tms');
 # UPDATE images SET tile_id = replace(tile_id, '.None', '.tms');
@@ -130,9 +299,31 @@ class MbTiles(object):
   self.center_x=(self.bounds_east+self.bounds_west)/2
   self.center_y=(self.bounds_north+self.bounds_south)/2
   self.mbtiles_center="%f,%f,%s"%(self.center_x,self.center_y,self.default_zoom)
-
- def open_db(self,s_path_db,mbtiles_dir,mbtiles_format,s_y_type,verbose=False):
+  # per zoom_level: [min(tile_column),min(tile_row),max(tile_column),max(tile_row)] of the tiles inserted
+  self.zoom_bounds={}
+  # bounds and min/max zoom_levels of an existing db, before anything was inserted
+  self.bounds_db=None
+  self.db_existed=False
+  self.s_profile=DEFAULT_MBTILES_PROFILE
+  self.s_schema='text'
+  # result of tile_inventory, kept up to date by insert_image
+  self.inventory=None
+  # the inventory is the 'tile_inventory' of metadata [loaded by open_db or saved by tile_inventory]
+  self.inventory_saved=False
+  # tile_hash of a blank image in a 'compact' db -> '.rgb' tile_id, see blank_tile_id
+  self.blank_ids={}
+  # png images with up to png8_colors distinct colours are stored as 8-bit paletted png when smaller [0: not used]
+  self.png8_colors=0
+  # journal_mode of the db before optimize_connection, restored in close_db
+  self.s_journal_mode_db=None
+
+ def open_db(self,s_path_db,mbtiles_dir,mbtiles_format,s_y_type,verbose=False,s_profile=None,s_schema=None):
   self.s_path_db = s_path_db
+  if s_profile:
+   self.s_profile=s_profile
+  if s_schema:
+   # only used when the db is created, otherwise read from the db
+   self.s_schema=s_schema
   self.mbtiles_dir=mbtiles_dir.strip()
   if self.mbtiles_dir == "":
    self.mbtiles_dir=os.path.dirname(self.mbtiles_file)+ '/'
@@ -146,6 +337,10 @@ class MbTiles(object):
   if mbtiles_format == "png":
    self.mbtiles_format=mbtiles_format
    self.pil_format='PNG'
+  if mbtiles_format == "hybrid":
+   # jpg and png: images are stored in the format they have
+   self.mbtiles_format=mbtiles_format
+   self.pil_format=None
   self.verbose=verbose
   # self.verbose=True
   # setting a default value
@@ -155,15 +350,22 @@ class MbTiles(object):
   db_create=os.path.exists(self.s_path_db)
   self.sqlite3_connection=self.mbtiles_connect(s_path_db)
   self.mbtiles_cursor = self.sqlite3_connection.cursor()
-  # self.optimize_connection()
   if not db_create:
    if self.verbose:
     logger.info(_("MbTiles : [open_db] : creating: [%s]") % self.s_path_db)
+   self.optimize_connection(self.s_profile,True)
    self.mbtiles_create()
+   self.sqlite3_connection.commit()
   else:
+   self.optimize_connection(self.s_profile)
    if self.verbose:
     logger.info(_("MbTiles : [open_db] : opening: [%s]") % self.s_path_db)
+   self.s_schema=self.fetch_schema()
    self.fetch_metadata()
+   self.inventory_load()
+   self.db_existed=True
+   if 'bounds' in self.metadata and 'minzoom' in self.metadata and 'maxzoom' in self.metadata:
+    self.bounds_db=(self.bounds_west,self.bounds_south,self.bounds_east,self.bounds_north,int(self.mbtiles_minzoom),int(self.mbtiles_maxzoom))
 
  def close_db(self):
   if self.verbose:
@@ -171,6 +373,15 @@ class MbTiles(object):
   if self.mbtiles_cursor:
    self.mbtiles_cursor.close()
   if self.sqlite3_connection:
+   self.sqlite3_connection.commit()
+   if self.s_journal_mode_db and self.s_journal_mode_db != 'wal':
+    # WAL is persistent, older readers [Android] can only read files with a rollback journal
+    try:
+     self.sqlite3_connection.execute("""PRAGMA query_only=0;""")
+     self.sqlite3_connection.execute("""PRAGMA journal_mode=%s;""" % self.s_journal_mode_db).fetchall()
+    except sqlite3.Error, e:
+     # still in use by another connection, the last one will checkpoint the WAL
+     logger.debug(_("MbTiles : [close_db] : journal_mode not restored: Error %s:") % e.args[0])
    self.sqlite3_connection.close()
    if os.path.exists("%s-journal" % self.s_path_db):
     os.remove("%s-journal" % self.s_path_db)
@@ -181,22 +392,44 @@ class MbTiles(object):
   return (2**zoom-1) - y
 
  def mbtiles_create(self):
+  if not self.s_schema in MBTILES_SCHEMAS:
+   raise InvalidFormatError(_("MbTiles : mbtiles_create: unknown schema [%s] %s") % (self.s_schema,MBTILES_SCHEMAS))
   self.mbtiles_cursor.execute("""CREATE TABLE android_metadata (locale text);""")
   self.mbtiles_cursor.execute("""CREATE TABLE metadata (name text, value text);""")
   self.mbtiles_cursor.execute("""CREATE TABLE grid_key (grid_id TEXT,key_name TEXT);""")
   self.mbtiles_cursor.execute("""CREATE TABLE grid_utfgrid (grid_id TEXT,grid_utfgrid BLOB);""")
   self.mbtiles_cursor.execute("""CREATE TABLE keymap (key_name TEXT,key_json TEXT);""")
-  self.mbtiles_cursor.execute("""CREATE TABLE images (tile_data blob,tile_id text);""")
-  self.mbtiles_cursor.execute("""CREATE TABLE map (zoom_level INTEGER,tile_column INTEGER,tile_row INTEGER,tile_id TEXT,grid_id TEXT);""")
-  self.mbtiles_cursor.execute("""CREATE VIEW tiles AS SELECT map.zoom_level AS zoom_level,map.tile_column AS tile_column,map.tile_row AS tile_row,images.tile_data AS tile_data FROM map JOIN images ON images.tile_id = map.tile_id ORDER BY zoom_level,tile_column,tile_row;""")
+  if self.s_schema == 'compact':
+   # tile_hash [see tile_hash()] is the rowid of images, map is stored in the order of its primary key
+   # - no further indexes are needed ; grid_id is NULL when not used
+   self.mbtiles_cursor.execute("""CREATE TABLE images (tile_hash INTEGER PRIMARY KEY,tile_data BLOB);""")
+   self.mbtiles_cursor.execute("""CREATE TABLE map (zoom_level INTEGER,tile_column INTEGER,tile_row INTEGER,tile_hash INTEGER,grid_id TEXT,PRIMARY KEY (zoom_level,tile_column,tile_row)) WITHOUT ROWID;""")
+   self.mbtiles_cursor.execute("""CREATE VIEW tiles AS SELECT map.zoom_level AS zoom_level,map.tile_column AS tile_column,map.tile_row AS tile_row,images.tile_data AS tile_data FROM map JOIN images ON images.tile_hash = map.tile_hash ORDER BY zoom_level,tile_column,tile_row;""")
+  else:
+   self.mbtiles_cursor.execute("""CREATE TABLE images (tile_data blob,tile_id text);""")
+   self.mbtiles_cursor.execute("""CREATE TABLE map (zoom_level INTEGER,tile_column INTEGER,tile_row INTEGER,tile_id TEXT,grid_id TEXT);""")
+   self.mbtiles_cursor.execute("""CREATE VIEW tiles AS SELECT map.zoom_level AS zoom_level,map.tile_column AS tile_column,map.tile_row AS tile_row,images.tile_data AS tile_data FROM map JOIN images ON images.tile_id = map.tile_id ORDER BY zoom_level,tile_column,tile_row;""")
   self.mbtiles_cursor.execute("""CREATE VIEW grids AS SELECT map.zoom_level AS zoom_level,map.tile_column AS tile_column,map.tile_row AS tile_row,grid_utfgrid.grid_utfgrid AS grid FROM map JOIN grid_utfgrid ON grid_utfgrid.grid_id = map.grid_id;""")
   self.mbtiles_cursor.execute("""CREATE VIEW grid_data AS SELECT map.zoom_level AS zoom_level,map.tile_column AS tile_column,map.tile_row AS tile_row,keymap.key_name AS key_name,keymap.key_json AS key_json FROM map JOIN grid_key ON map.grid_id = grid_key.grid_id JOIN keymap ON grid_key.key_name = keymap.key_name;""")
   self.mbtiles_cursor.execute("""CREATE UNIQUE INDEX name ON metadata (name);""")
   self.mbtiles_cursor.execute("""CREATE UNIQUE INDEX grid_key_lookup ON grid_key (grid_id,key_name);""")
   self.mbtiles_cursor.execute("""CREATE UNIQUE INDEX grid_utfgrid_lookup ON grid_utfgrid (grid_id);""")
   self.mbtiles_cursor.execute("""CREATE UNIQUE INDEX keymap_lookup ON keymap (key_name);""")
-  self.mbtiles_cursor.execute("""CREATE UNIQUE INDEX images_id ON images (tile_id);""")
-  self.mbtiles_cursor.execute("""CREATE UNIQUE INDEX map_index ON map (zoom_level, tile_column, tile_row);""")
+  if self.s_schema == 'text':
+   self.mbtiles_cursor.execute("""CREATE UNIQUE INDEX images_id ON images (tile_id);""")
+   self.mbtiles_cursor.execute("""CREATE UNIQUE INDEX map_index ON map (zoom_level, tile_column, tile_row);""")
+
+ def fetch_schema(self):
+  # 'compact' when images has a tile_hash column, otherwise 'text'
+  # - also for mbtiles where 'tiles' is a table, these are only read
+  for row in self.mbtiles_cursor.execute("""PRAGMA table_info(images);""").fetchall():
+   if row[1] == 'tile_hash':
+    return 'compact'
+  return 'text'
+
+ def tile_hash(self,data):
+  # first 8 bytes of the md5 as a signed 64-bit integer [a SQLite INTEGER]
+  return struct.unpack('<q',hashlib.md5(data).digest()[:8])[0]
 
  def mbtiles_connect(self,mbtiles_file):
   try:
@@ -217,6 +450,15 @@ class MbTiles(object):
    self.mbtiles_version=self.metadata.get('version',self.mbtiles_version)
    self.s_y_type = self.metadata.get('tile_row_type',self.s_y_type)
    self.mbtiles_format=self.metadata.get('format',self.mbtiles_format)
+   # the images are written (build_overviews) in the format of the db, not the one given to open_db
+   if self.mbtiles_format == 'jpeg':
+    self.mbtiles_format='jpg'
+   if self.mbtiles_format == 'hybrid':
+    self.pil_format=None
+   elif self.mbtiles_format == 'png':
+    self.pil_format='PNG'
+   elif self.mbtiles_format == 'jpg':
+    self.pil_format='JPEG'
    self.mbtiles_bounds=self.metadata.get('bounds',self.mbtiles_bounds)
    sa_bounds=self.mbtiles_bounds.split(",")
    if len(sa_bounds) == 4:
@@ -237,22 +479,57 @@ class MbTiles(object):
     self.default_zoom=int(sa_center[2])
   return self.metadata_return
 
- def optimize_connection(self):
-  self.mbtiles_cursor.execute("""PRAGMA synchronous=0""")
-  self.mbtiles_cursor.execute("""PRAGMA locking_mode=EXCLUSIVE""")
-  self.mbtiles_cursor.execute("""PRAGMA journal_mode=DELETE""")
+ def optimize_connection(self,s_profile='bulk',b_create=False):
+  # s_profile: a key of MBTILES_PROFILES ; b_create: the tables have not been created yet
+  if not s_profile in MBTILES_PROFILES:
+   logger.warn(_("MbTiles : optimize_connection: unknown profile [%s], using [%s]") % (s_profile,DEFAULT_MBTILES_PROFILE))
+   s_profile=DEFAULT_MBTILES_PROFILE
+  self.s_profile=s_profile
+  self.s_journal_mode_db=None
+  profile_pragmas=dict(MBTILES_PROFILES[s_profile])
+  if b_create:
+   # only possible before the first table is created [and before journal_mode=WAL]
+   if 'page_size' in profile_pragmas:
+    self.mbtiles_cursor.execute("""PRAGMA page_size=%d;""" % profile_pragmas['page_size'])
+   # allows 'PRAGMA incremental_vacuum' in optimize_database
+   self.mbtiles_cursor.execute("""PRAGMA auto_vacuum=INCREMENTAL;""")
+  for s_pragma,value in MBTILES_PROFILES[s_profile]:
+   if s_pragma == 'page_size':
+    # can only be changed with a VACUUM
+    continue
+   if s_pragma == 'journal_mode':
+    self.s_journal_mode_db=str(self.mbtiles_cursor.execute("""PRAGMA journal_mode;""").fetchone()[0]).lower()
+   self.mbtiles_cursor.execute("""PRAGMA %s=%s;""" % (s_pragma,value)).fetchall()
+  if self.verbose:
+   logger.info(_("MbTiles : optimize_connection: profile[%s] [%s]") % (s_profile,self.s_path_db))
 
- def optimize_database(self):
+ def optimize_database(self,i_parm=0):
+  # i_parm=0: ANALYZE and VACUUM [rewrites the whole file]
+  # i_parm=1: ANALYZE and incremental VACUUM [only returns the free pages, when created with auto_vacuum=INCREMENTAL]
+  # i_parm=2: ANALYZE only
+  # - this is never called during a build, since a VACUUM of a large file takes very long
   if self.verbose:
    logger.info(_("MbTiles : optimize_database: analyzing db [%s]") % "ANALYZE;")
   self.mbtiles_cursor.execute("""ANALYZE;""")
-  if self.verbose:
-   logger.info(_("MbTiles : optimize_database: cleaning db [%s]") % "VACUUM;")
-  self.mbtiles_cursor.execute("""VACUUM;""")
+  if i_parm == 1:
+   i_auto_vacuum = self.mbtiles_cursor.execute("""PRAGMA auto_vacuum;""").fetchone()[0]
+   if i_auto_vacuum == 2:
+    if self.verbose:
+     logger.info(_("MbTiles : optimize_database: cleaning db [%s]") % "PRAGMA incremental_vacuum;")
+    self.mbtiles_cursor.execute("""PRAGMA incremental_vacuum;""").fetchall()
+   else:
+    # the db was not created with auto_vacuum=INCREMENTAL, a full VACUUM is needed to change this
+    logger.warn(_("MbTiles : optimize_database: incremental VACUUM not possible, auto_vacuum[%d] ; use i_parm=0 [%s]") % (i_auto_vacuum,self.s_path_db))
+  elif i_parm == 0:
+   if self.verbose:
+    logger.info(_("MbTiles : optimize_database: cleaning db [%s]") % "VACUUM;")
+   self.mbtiles_cursor.execute("""VACUUM;""")
   if self.verbose:
    logger.info(_("MbTiles : optimize_database: [%s]") % self.s_path_db)
 
  def insert_metadata(self,metadata_list):
+  # 'tile_inventory' is only written by tile_inventory: the one of another db [copied metadata] does not match the tiles
+  metadata_list=[metadata for metadata in metadata_list or [] if str(metadata[0]).lower() != 'tile_inventory']
   if metadata_list:
    if self.verbose:
     # logger.info(_("MbTiles : insert_metadata:: [%s]") % metadata_list)
@@ -290,31 +567,103 @@ class MbTiles(object):
   if not self.mbtiles_cursor:
    self.mbtiles_cursor = self.sqlite3_connection.cursor()
   s_tile_id="{0}-{1}-{2}.{3}".format(str(tz),str(tx),str(ty),self.s_y_type)
+  started = timings.start()
   s_tile_id,output_image=self.check_image(s_tile_id,image_data)
+  timings.stop('mbtiles_check_image', started)
   if output_image:
    image_data=output_image
+  if self.pil_format is None and s_tile_id.endswith('.rgb') and hybrid_format(Image.open(BytesIO(image_data))) is None:
+   # 'hybrid': fully transparent tiles are not stored
+   return
+  started = timings.start()
+  self.insert_tile(tz,tx,ty,s_tile_id,image_data)
+  timings.stop('mbtiles_insert', started)
+
+ def insert_tile(self,tz,tx,ty,s_tile_id,image_data,b_commit=True):
+  # image_data in the format of the db, s_tile_id as returned by check_image
+  # b_commit=False: the caller commits [a batch of tiles in one transaction]
+  if self.s_schema == 'compact':
+   if s_tile_id.endswith('.rgb'):
+    # all blank images of the same colour use the first one stored
+    self.insert_compact(tz,tx,ty,self.tile_hash(s_tile_id),image_data,False,b_commit)
+   else:
+    self.insert_compact(tz,tx,ty,self.tile_hash(image_data),image_data,True,b_commit)
+   return
+  b_new_tile=self.inventory_is_new(tz,tx,ty)
   sql_insert_map="INSERT OR REPLACE INTO map (tile_id,zoom_level,tile_column,tile_row,grid_id) VALUES(?,?,?,?,?);";
   map_values = [(s_tile_id,tz,tx,ty,'')]
   sql_insert_image="INSERT OR REPLACE INTO images (tile_id,tile_data) VALUES(?,?);"
   image_values = [(s_tile_id,buffer(image_data))]
   # sqlite3.Binary(image_data)
   if self.verbose:
-   logger.info(_("MbTiles : insert_image: %d,%d,%d id[%s]") % (tz,tx,ty,s_tile_id))
+   logger.info(_("MbTiles : insert_tile: %d,%d,%d id[%s]") % (tz,tx,ty,s_tile_id))
   try:
    self.mbtiles_cursor.executemany(sql_insert_map,map_values)
    self.mbtiles_cursor.executemany(sql_insert_image,image_values)
-   self.sqlite3_connection.commit()
+   if b_commit:
+    started = timings.start()
+    self.sqlite3_connection.commit()
+    timings.stop('mbtiles_commit', started)
+   self.track_bounds(tz,tx,ty)
+   self.inventory_add(tz,tx,len(image_data),s_tile_id.endswith('.rgb'),b_new_tile)
   except sqlite3.Error, e:
    self.sqlite3_connection.rollback()
-   logger.error(_("MbTiles : insert_image: Error %s:") % e.args[0])
+   logger.error(_("MbTiles : insert_tile: Error %s:") % e.args[0])
+
+ def insert_compact(self,tz,tx,ty,i_tile_hash,image_data,b_compare=True,b_commit=True,s_grid_id=None):
+  # identical images are stored once ; b_compare: check an existing image with the same hash
+  # - on a hash collision the next free value is used
+  if self.verbose:
+   logger.info(_("MbTiles : insert_compact: %d,%d,%d hash[%d]") % (tz,tx,ty,i_tile_hash))
+  b_new_tile=self.inventory_is_new(tz,tx,ty)
+  try:
+   while True:
+    self.mbtiles_cursor.execute("INSERT OR IGNORE INTO images (tile_hash,tile_data) VALUES(?,?);",(i_tile_hash,buffer(image_data)))
+    if self.mbtiles_cursor.rowcount == 1 or not b_compare:
+     break
+    stored_data=self.mbtiles_cursor.execute("SELECT tile_data FROM images WHERE tile_hash = ?;",(i_tile_hash,)).fetchone()
+    if bytes(stored_data[0]) == bytes(image_data):
+     break
+    i_tile_hash+=1
+   self.mbtiles_cursor.execute("INSERT OR REPLACE INTO map (zoom_level,tile_column,tile_row,tile_hash,grid_id) VALUES(?,?,?,?,?);",(tz,tx,ty,i_tile_hash,s_grid_id))
+   if b_commit:
+    started = timings.start()
+    self.sqlite3_connection.commit()
+    timings.stop('mbtiles_commit', started)
+   self.track_bounds(tz,tx,ty)
+   # compact: a blank image is one not stored under the hash of its data
+   self.inventory_add(tz,tx,len(image_data),not b_compare,b_new_tile)
+  except sqlite3.Error, e:
+   self.sqlite3_connection.rollback()
+   logger.error(_("MbTiles : insert_compact: Error %s:") % e.args[0])
+  return i_tile_hash
+
+ def track_bounds(self,tz,tx,ty):
+  # called for each inserted tile, replaces the full scan of retrieve_bounds
+  zoom_bounds=self.zoom_bounds.get(tz)
+  if zoom_bounds is None:
+   self.zoom_bounds[tz]=[tx,ty,tx,ty]
+   return
+  if tx < zoom_bounds[0]:
+   zoom_bounds[0]=tx
+  elif tx > zoom_bounds[2]:
+   zoom_bounds[2]=tx
+  if ty < zoom_bounds[1]:
+   zoom_bounds[1]=ty
+  elif ty > zoom_bounds[3]:
+   zoom_bounds[3]=ty
 
  def check_image(self,s_tile_id,image_data):
   # a list of (count, color) tuples or None, max amount [we only want information about a blank image]
   output_data=None
   input_image = Image.open(BytesIO(image_data))
   colors = input_image.getcolors(1)
-  if self.pil_format != input_image.format:
-   if self.pil_format == "JPEG":
+  pil_format=self.pil_format
+  if pil_format is None:
+   # 'hybrid': jpg when opaque, png when transparent [fully transparent: not stored by insert_image]
+   pil_format=hybrid_format(input_image) or input_image.format
+  if pil_format != input_image.format:
+   if pil_format == "JPEG":
     if input_image.mode != "RGB":
      input_image=input_image.convert('RGB')
     # http://effbot.org/imagingbook/pil-index.htm#appendixes
@@ -328,6 +677,10 @@ class MbTiles(object):
    input_image = Image.open(BytesIO(output_data))
    colors = input_image.getcolors(1)
    # TypeError: 'buffer' does not have the buffer interface
+  if self.png8_colors and input_image.format == "PNG":
+   png8_data=png8_image(input_image,self.png8_colors)
+   if png8_data and len(png8_data) < len(output_data or image_data):
+    output_data=png8_data
   if colors:
    # MbTiles : check_image: tile_id[ 18-140789-176144.tms ] colors[ [(65536, (255, 255, 255, 255))] ]
    # color_values[ (65536, (255, 255, 255, 255)) ]
@@ -347,8 +700,11 @@ class MbTiles(object):
 
  def retrieve_blank_image(self,r,g,b):
   s_tile_id="{0}-{1}-{2}.{3}".format(str(r), str(g),str(b),"rgb")
-  tile_id = (s_tile_id,)
-  self.mbtiles_cursor.execute("SELECT tile_data FROM images WHERE tile_id = ?",tile_id)
+  if self.s_schema == 'compact':
+   self.mbtiles_cursor.execute("SELECT tile_data FROM images WHERE tile_hash = ?",(self.tile_hash(s_tile_id),))
+  else:
+   tile_id = (s_tile_id,)
+   self.mbtiles_cursor.execute("SELECT tile_data FROM images WHERE tile_id = ?",tile_id)
   image_data = self.mbtiles_cursor.fetchone()
   if image_data is None:
    image = Image.new("RGB", (self.tilesize, self.tilesize), (r, g, b))
@@ -403,7 +759,49 @@ class MbTiles(object):
   self.mbtiles_minzoom=min_zoom
   self.mbtiles_maxzoom=max_zoom
   self.save_metadata()
-  self.optimize_database()
+
+ def save_bounds(self):
+  # calculate the min/max zoom_levels and bounds from the tiles collected by insert_image
+  # - only the metadata is written, no scan of the map table is done
+  if not self.zoom_bounds:
+   return
+  if self.db_existed and self.bounds_db is None:
+   # existing db without bounds metadata: what was there before is unknown
+   self.retrieve_bounds()
+   return
+  if self.bounds_db:
+   bounds_west,bounds_south,bounds_east,bounds_north,min_zoom,max_zoom=self.bounds_db
+  else:
+   min_zoom=22
+   max_zoom=0
+   bounds_west=180.0
+   bounds_east=-180.0
+   bounds_north=-85.05113
+   bounds_south=85.05113
+  mercator = GlobalMercator(self.tms_osm)
+  for i_zoom in self.zoom_bounds:
+   if i_zoom > max_zoom:
+    max_zoom=i_zoom
+   if i_zoom < min_zoom:
+    min_zoom=i_zoom
+   i_x_min,i_y_min,i_x_max,i_y_max=self.zoom_bounds[i_zoom]
+   tile_bounds= mercator.TileLatLonBounds(i_x_min,i_y_min,i_zoom)
+   if tile_bounds[0] < bounds_south:
+    bounds_south=tile_bounds[0]
+   if tile_bounds[1] < bounds_west:
+    bounds_west=tile_bounds[1]
+   tile_bounds= mercator.TileLatLonBounds(i_x_max,i_y_max,i_zoom)
+   if tile_bounds[2] > bounds_north:
+    bounds_north=tile_bounds[2]
+   if tile_bounds[3] > bounds_east:
+    bounds_east=tile_bounds[3]
+  self.mbtiles_bounds="%f,%f,%f,%f"% (bounds_west,bounds_south,bounds_east,bounds_north)
+  mbtiles_center_x=(bounds_east+bounds_west)/2
+  mbtiles_center_y=(bounds_north+bounds_south)/2
+  self.mbtiles_center="%f,%f,%s"%(mbtiles_center_x,mbtiles_center_y,min_zoom)
+  self.mbtiles_minzoom=min_zoom
+  self.mbtiles_maxzoom=max_zoom
+  self.save_metadata()
 
  def retrieve_image(self,tz,tx,ty):
   if not self.s_y_type:
@@ -418,6 +816,43 @@ class MbTiles(object):
    return  None
   return bytes(image_data[0])
 
+ def retrieve_image_key(self,tz,tx,ty):
+  # (tile_data,key) : key joins map and images [tile_id: 'text' ; tile_hash: 'compact' ; None: 'tiles' is a table]
+  tile_zxy = (tz,tx,ty)
+  try:
+   if self.s_schema == 'compact':
+    self.mbtiles_cursor.execute("SELECT images.tile_data,map.tile_hash FROM map JOIN images ON images.tile_hash = map.tile_hash WHERE map.zoom_level = ? AND map.tile_column = ? AND map.tile_row = ?",tile_zxy)
+   else:
+    self.mbtiles_cursor.execute("SELECT images.tile_data,map.tile_id FROM map JOIN images ON images.tile_id = map.tile_id WHERE map.zoom_level = ? AND map.tile_column = ? AND map.tile_row = ?",tile_zxy)
+  except sqlite3.OperationalError:
+   self.mbtiles_cursor.execute("SELECT tile_data,NULL FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?",tile_zxy)
+  image_key = self.mbtiles_cursor.fetchone()
+  if image_key is None:
+   return None
+  return (bytes(image_key[0]),image_key[1])
+
+ def blank_tile_id(self,key,image_data,s_schema=None):
+  # the '.rgb' tile_id of a blank image returned by retrieve_image_key, otherwise None
+  # - 'text': read from the tile_id
+  # - 'compact': a blank image is not stored under the hash of its data, only these are decoded [once]
+  # - s_schema: of the db the key is from [default: this db]
+  if key is None:
+   return None
+  if (s_schema or self.s_schema) != 'compact':
+   if key.endswith('.rgb'):
+    return str(key)
+   return None
+  if self.tile_hash(image_data) == key:
+   return None
+  if not key in self.blank_ids:
+   s_tile_id=None
+   colors = Image.open(BytesIO(image_data)).getcolors(1)
+   if colors:
+    rgb_values=colors[0][1]
+    s_tile_id = "%2x-%2x-%2x.rgb"%(int(rgb_values[0]),int(rgb_values[1]),int(rgb_values[2]))
+   self.blank_ids[key]=s_tile_id
+  return self.blank_ids[key]
+
  def retrieve_zoom_images(self,tz,tx,ty):
   if not self.s_y_type:
    self.s_y_type="tms"
@@ -428,14 +863,23 @@ class MbTiles(object):
   image_list = list() # empty list
   for y in range(2*ty,2*ty + 2):
    for x in range(2*tx, 2*tx + 2):
+    if self.mbtiles_format == 'hybrid' and self.count_tiles(tz,x,y,0) == 0:
+     # missing tiles are transparent, not blank
+     continue
     s_tile_id="{0}-{1}-{2}.{3}".format(str(tz), str(x),str(y),self.s_y_type)
     s_file_id="{0}{1}-{2}-{3}.{4}".format(self.mbtiles_dir,str(tz), str(x),str(y),self.mbtiles_format)
-    tile_id = (s_tile_id,)
-    self.mbtiles_cursor.execute("SELECT tile_data FROM images WHERE tile_id = ?",tile_id)
+    if self.s_schema == 'compact':
+     self.mbtiles_cursor.execute("SELECT tile_data FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?",(tz,x,y))
+    else:
+     tile_id = (s_tile_id,)
+     self.mbtiles_cursor.execute("SELECT tile_data FROM images WHERE tile_id = ?",tile_id)
     image_data = self.mbtiles_cursor.fetchone()
     if self.verbose:
      logger.info(_("MbTiles : retrieve_zoom_images: source[%s] : fetching[%s]") % s_tile_source,s_tile_id)
-    if image_data is None:
+    if image_data is None and self.s_schema == 'compact':
+     # not in the db
+     image_data = self.retrieve_blank_image(0,0,0)
+    elif image_data is None:
      # 1 / 8051 /media/gb_1500/maps/geo_tiff/rd_Berlin_Schmettau/18-140798-176204.jpg
      # [19-281597-352408.jpg] istilie_id '0-0-0.rgb'
      s_tile_id_orig=s_tile_id
@@ -449,6 +893,8 @@ class MbTiles(object):
       # retireve an blank image fromdatabase, if does not exist, create it
       image_data = self.retrieve_blank_image(0,0,0)
     if image_data:
+     if self.mbtiles_format == 'hybrid':
+      s_file_id="{0}{1}-{2}-{3}.{4}".format(self.mbtiles_dir,str(tz), str(x),str(y),sniff_format(image_data[0]))
      output_file = open(s_file_id, 'wb')
      if not output_file.closed:
       output_file.write(image_data[0])
@@ -458,32 +904,32 @@ class MbTiles(object):
 
  def count_tiles(self,tz,tx,ty,i_parm):
   # even when empty, 0 will be returned
+  # i_parm=0: tile tz,tx,ty ; 1: all tiles ; 2: tiles of tz ; 3: tiles of column tx of tz [from tile_inventory]
+  # i_parm=10: tile_id [tile_hash for 'compact'] of tz,tx,ty
   if not self.s_y_type:
    self.s_y_type="tms"
   if not self.mbtiles_cursor:
    self.mbtiles_cursor = self.sqlite3_connection.cursor()
-  if i_parm == 10:
-   s_sql_command="SELECT tile_id FROM map WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?"
-   tile_id = (str(tz),str(tx),str(ty))
-  if i_parm == 0:
-   s_tile_id="{0}-{1}-{2}.{3}".format(str(tz), str(tx),str(ty),self.s_y_type)
-   s_sql_command="SELECT count(tile_id) FROM map WHERE tile_id = ?"
-   tile_id = (s_tile_id,)
-  elif i_parm < 4:
+  if i_parm in (1,2,3):
+   inventory=self.tile_inventory()
    if i_parm == 1:
-    # '%-%-%.%' : all tiles
-    s_tile_id="%-%-%.%"
-    s_sql_command="SELECT count(tile_id) FROM map WHERE tile_id LIKE ?"
+    return inventory['tiles']
+   zoom_inventory=inventory['zoom'].get(tz)
+   if zoom_inventory is None:
+    return 0
    if i_parm == 2:
-    # '15-%-%.%' all tiles of z ; Note: there may be .rgb entries
-    s_tile_id="{0}".format(str(tz))
-    s_sql_command="SELECT count(tile_id)  FROM map WHERE zoom_level = ?"
-   if i_parm == 3:
-    # '%-17600-%.%' all tiles of x ; Note: there may be .rgb entries
-    s_tile_id="{0}".format(str(tx))
-    s_sql_command="SELECT count(tile_id)  FROM map WHERE tile_column = ?"
-   tile_id = (s_tile_id,)
-  self.mbtiles_cursor.execute(s_sql_command,tile_id)
+    return zoom_inventory['tiles']
+   return zoom_inventory['columns'].get(tx,0)
+  tile_zxy = (tz,tx,ty)
+  if i_parm == 10:
+   if self.s_schema == 'compact':
+    s_sql_command="SELECT tile_hash FROM map WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?"
+   else:
+    s_sql_command="SELECT tile_id FROM map WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?"
+  else:
+   # uses the (zoom_level,tile_column,tile_row) index, also finds .rgb tiles
+   s_sql_command="SELECT count(*) FROM map WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?"
+  self.mbtiles_cursor.execute(s_sql_command,tile_zxy)
   i_count = self.mbtiles_cursor.fetchone()
   if i_count is None:
    if i_parm == 10:
@@ -493,6 +939,422 @@ class MbTiles(object):
     i_count = (0,)
   return i_count[0]
 
+ def tile_inventory(self,b_refresh=False,b_save=False):
+  # tiles, bytes and solid [blank] tiles: in total, per zoom_level and tiles per tile_column of a zoom_level
+  # - one pass over the map index, the result is kept and updated by insert_image
+  # - b_save: store it as 'tile_inventory' in metadata, read by open_db instead of this pass
+  if self.inventory is None or b_refresh:
+   # a saved inventory is replaced by the new one [not with the 'read' profile]
+   b_save=b_save or (self.inventory_saved and self.s_profile != 'read')
+   self.inventory_saved=False
+   if self.s_schema == 'compact':
+    # a blank image is one not stored under the hash of its data, as counted by insert_compact [see blank_tile_id]
+    # - looked up in a function, the pass also works with the 'read' profile [query_only]
+    blank_keys=set([key for key,tile_data in self.sqlite3_connection.execute("SELECT tile_hash,tile_data FROM images;") if self.blank_tile_id(key,bytes(tile_data))])
+    self.sqlite3_connection.create_function("inventory_blank",1,lambda key: key in blank_keys)
+    s_sql_command="""SELECT map.zoom_level,map.tile_column,count(*),sum(length(images.tile_data)),sum(inventory_blank(map.tile_hash))
+     FROM map JOIN images ON images.tile_hash = map.tile_hash
+     GROUP BY map.zoom_level,map.tile_column;"""
+   else:
+    s_sql_command="""SELECT map.zoom_level,map.tile_column,count(*),sum(length(images.tile_data)),sum(substr(map.tile_id,-4) = '.rgb')
+     FROM map JOIN images ON images.tile_id = map.tile_id
+     GROUP BY map.zoom_level,map.tile_column;"""
+   self.inventory={'tiles': 0, 'bytes': 0, 'solid': 0, 'zoom': {}}
+   for i_zoom,i_column,i_tiles,i_bytes,i_solid in self.mbtiles_cursor.execute(s_sql_command).fetchall():
+    zoom_inventory=self.inventory['zoom'].setdefault(int(i_zoom),{'tiles': 0, 'bytes': 0, 'solid': 0, 'columns': {}})
+    zoom_inventory['columns'][int(i_column)]=i_tiles
+    for s_key,i_value in (('tiles',i_tiles),('bytes',i_bytes or 0),('solid',i_solid or 0)):
+     zoom_inventory[s_key]+=i_value
+     self.inventory[s_key]+=i_value
+   if self.verbose:
+    logger.info(_("MbTiles : tile_inventory: tiles[%d] bytes[%d] solid[%d] zoom_levels[%d]") % (self.inventory['tiles'],self.inventory['bytes'],self.inventory['solid'],len(self.inventory['zoom'])))
+  if b_save and not self.inventory_saved:
+   self.mbtiles_cursor.execute("INSERT OR REPLACE INTO metadata VALUES(?,?)",('tile_inventory',json.dumps(self.inventory,sort_keys=True)))
+   self.sqlite3_connection.commit()
+   self.inventory_saved=True
+  return self.inventory
+
+ def inventory_load(self):
+  # the inventory saved by tile_inventory(b_save=True), if any
+  s_inventory=self.metadata.get('tile_inventory')
+  if not s_inventory:
+   return
+  try:
+   inventory=json.loads(s_inventory)
+   zoom_inventories={}
+   for s_zoom,zoom_inventory in inventory['zoom'].items():
+    zoom_inventories[int(s_zoom)]={'tiles': zoom_inventory['tiles'], 'bytes': zoom_inventory['bytes'], 'solid': zoom_inventory['solid'],
+     'columns': dict([(int(s_column),i_tiles) for s_column,i_tiles in zoom_inventory['columns'].items()])}
+   self.inventory={'tiles': inventory['tiles'], 'bytes': inventory['bytes'], 'solid': inventory['solid'], 'zoom': zoom_inventories}
+   self.inventory_saved=True
+  except (ValueError,KeyError,TypeError,AttributeError):
+   # written by an older version [without the columns]: built again when needed
+   logger.warn(_("MbTiles : inventory_load: 'tile_inventory' in metadata is not used [%s]") % self.s_path_db)
+
+ def inventory_changed(self):
+  # the tiles will change: the saved 'tile_inventory' no longer matches [committed with the tiles]
+  if self.inventory_saved:
+   self.inventory_saved=False
+   self.mbtiles_cursor.execute("DELETE FROM metadata WHERE name = 'tile_inventory';")
+
+ def inventory_is_new(self,tz,tx,ty):
+  # only needed to keep the inventory correct when a tile is replaced
+  if self.inventory is None:
+   return True
+  return self.count_tiles(tz,tx,ty,0) == 0
+
+ def inventory_add(self,tz,tx,i_bytes,b_solid,b_new_tile):
+  self.inventory_changed()
+  if self.inventory is None:
+   return
+  if not b_new_tile:
+   # the values of the replaced tile are not known
+   self.inventory=None
+   return
+  zoom_inventory=self.inventory['zoom'].setdefault(tz,{'tiles': 0, 'bytes': 0, 'solid': 0, 'columns': {}})
+  zoom_inventory['columns'][tx]=zoom_inventory['columns'].get(tx,0)+1
+  for inventory in (self.inventory,zoom_inventory):
+   inventory['tiles']+=1
+   inventory['bytes']+=i_bytes
+   if b_solid:
+    inventory['solid']+=1
+
+ def mbtiles_convert(self,s_path_output,s_schema):
+  # copy all tiles, grids and metadata into a new mbtiles with the given schema
+  # - each image is read once [ordered by its key] and written once
+  if os.path.exists(s_path_output):
+   raise InvalidFormatError(_("MbTiles : mbtiles_convert: output exists [%s]") % s_path_output)
+  mbtiles_output=MbTiles()
+  mbtiles_output.open_db(s_path_output,os.path.dirname(s_path_output)+ '/',self.mbtiles_format,self.s_y_type,self.verbose,'bulk',s_schema)
+  output_cursor=mbtiles_output.mbtiles_cursor
+  i_tiles=0
+  source_tables=[row[0] for row in self.mbtiles_cursor.execute("SELECT name FROM sqlite_master WHERE type='table';").fetchall()]
+  if self.s_schema == 'compact':
+   tiles = self.mbtiles_cursor.execute("SELECT map.zoom_level,map.tile_column,map.tile_row,map.tile_hash,map.grid_id,images.tile_data FROM map JOIN images ON images.tile_hash = map.tile_hash ORDER BY map.tile_hash;")
+  elif not 'map' in source_tables:
+   # 'tiles' is a table: each tile is its own image
+   tiles = self.mbtiles_cursor.execute("SELECT zoom_level,tile_column,tile_row,zoom_level||'-'||tile_column||'-'||tile_row,NULL,tile_data FROM tiles;")
+  else:
+   s_grid_id='map.grid_id'
+   if not 'grid_id' in [row[1] for row in self.mbtiles_cursor.execute("PRAGMA table_info(map);").fetchall()]:
+    # older mbtiles without grids
+    s_grid_id='NULL'
+   tiles = self.mbtiles_cursor.execute("SELECT map.zoom_level,map.tile_column,map.tile_row,map.tile_id,%s,images.tile_data FROM map JOIN images ON images.tile_id = map.tile_id ORDER BY map.tile_id;" % s_grid_id)
+  source_key=None
+  t = tiles.fetchone()
+  while t:
+   z,x,y,key,grid_id,tile_data=t
+   if key != source_key:
+    # blank images keep their '.rgb' id [text] or are stored under its hash [compact], see retrieve_blank_image
+    s_blank_id=self.blank_tile_id(key,bytes(tile_data))
+   if mbtiles_output.s_schema == 'compact':
+    if key != source_key:
+     if s_blank_id:
+      output_key=mbtiles_output.insert_compact(z,x,y,mbtiles_output.tile_hash(s_blank_id),tile_data,False,False,grid_id or None)
+     else:
+      output_key=mbtiles_output.insert_compact(z,x,y,mbtiles_output.tile_hash(tile_data),tile_data,True,False,grid_id or None)
+    else:
+     output_cursor.execute("INSERT OR REPLACE INTO map (zoom_level,tile_column,tile_row,tile_hash,grid_id) VALUES(?,?,?,?,?);",(z,x,y,output_key,grid_id or None))
+     mbtiles_output.track_bounds(z,x,y)
+   else:
+    if key != source_key:
+     # the first tile using this image gives its id to all others
+     output_key=s_blank_id or "{0}-{1}-{2}.{3}".format(str(z),str(x),str(y),self.s_y_type)
+     output_cursor.execute("INSERT OR REPLACE INTO images (tile_id,tile_data) VALUES(?,?);",(output_key,tile_data))
+    output_cursor.execute("INSERT OR REPLACE INTO map (tile_id,zoom_level,tile_column,tile_row,grid_id) VALUES(?,?,?,?,?);",(output_key,z,x,y,grid_id or ''))
+    mbtiles_output.track_bounds(z,x,y)
+   source_key=key
+   i_tiles+=1
+   if i_tiles % 1000 == 0:
+    mbtiles_output.sqlite3_connection.commit()
+   t = tiles.fetchone()
+  mbtiles_output.sqlite3_connection.commit()
+  # the tables that do not depend on the schema [small, ATTACH would need a lock on the input]
+  for s_table,s_columns in (('metadata','name,value'),('grid_key','grid_id,key_name'),('grid_utfgrid','grid_id,grid_utfgrid'),('keymap','key_name,key_json')):
+   if not s_table in source_tables:
+    continue
+   # by position, some older files have columns without a name
+   rows=self.mbtiles_cursor.execute("SELECT * FROM %s;" % s_table).fetchall()
+   if s_table == 'metadata':
+    # built again for the output when needed
+    rows=[row for row in rows if str(row[0]).lower() != 'tile_inventory']
+   output_cursor.executemany("INSERT OR REPLACE INTO %s (%s) VALUES(?,?);" % (s_table,s_columns),rows)
+  mbtiles_output.sqlite3_connection.commit()
+  if self.verbose:
+   logger.info(_("MbTiles : mbtiles_convert: [%s] schema[%s] -> [%s] schema[%s] tiles[%d]") % (self.s_path_db,self.s_schema,s_path_output,s_schema,i_tiles))
+  mbtiles_output.close_db()
+  return i_tiles
+
+ def mbtiles_merge(self,source_list,s_policy='first'):
+  # copies the tiles of other mbtiles into this db with INSERT ... SELECT, the images are not decoded
+  # source_list: file names, for s_policy='priority' (file name,priority) pairs
+  # s_policy: when a tile exists in more than one file
+  #  'first'    : the tile already in the db, then the first in source_list is kept
+  #  'newest'   : the tile of the most recently modified source is kept
+  #  'priority' : the tile of the source with the highest priority is kept
+  #  - with 'newest' and 'priority' tiles already in the db are replaced
+  # - the sources may be 'text', 'compact' or have a 'tiles' table ; tms/osm tile_rows are converted
+  # - 'compact': an image already stored under the same hash is used without comparing the data
+  if not s_policy in ('first','newest','priority'):
+   raise InvalidFormatError(_("MbTiles : mbtiles_merge: unknown policy [%s]") % s_policy)
+  if s_policy == 'priority':
+   source_list=[s_source for s_source,i_priority in sorted(source_list,key=operator.itemgetter(1))]
+  elif s_policy == 'newest':
+   source_list=sorted(source_list,key=os.path.getmtime)
+  if s_policy == 'first':
+   s_conflict='IGNORE'
+  else:
+   # the last source wins
+   s_conflict='REPLACE'
+  if self.s_schema == 'compact':
+   self.sqlite3_connection.create_function("tile_hash",1,lambda data: self.tile_hash(str(data)))
+   s_key_column='tile_hash'
+   s_images_conflict='IGNORE'
+  else:
+   # the '.rgb' tile_id of a blank image of a 'compact' source, NULL for other images
+   self.sqlite3_connection.create_function("blank_tile_id",2,lambda key,data: self.blank_tile_id(key,str(data),'compact'))
+   s_key_column='tile_id'
+   s_images_conflict='REPLACE'
+  s_format=None
+  if self.db_existed:
+   s_format=self.metadata.get('format')
+  i_changes=self.sqlite3_connection.total_changes
+  i_tiles=0
+  self.inventory_changed()
+  for i_source in range(len(source_list)):
+   s_source=source_list[i_source]
+   self.sqlite3_connection.commit()
+   self.mbtiles_cursor.execute("ATTACH DATABASE ? AS source;",(s_source,))
+   source_tables=[row[0] for row in self.mbtiles_cursor.execute("SELECT name FROM source.sqlite_master WHERE type='table';").fetchall()]
+   source_metadata=dict(self.mbtiles_cursor.execute("SELECT LOWER(name),value FROM source.metadata;").fetchall())
+   s_source_format=source_metadata.get('format','').replace('jpeg','jpg')
+   if s_format and s_source_format and s_format.replace('jpeg','jpg') != s_source_format:
+    self.mbtiles_cursor.execute("DETACH DATABASE source;")
+    raise InvalidFormatError(_("MbTiles : mbtiles_merge: format[%s] of [%s] is not format[%s]") % (s_source_format,s_source,s_format))
+   if not s_format:
+    s_format=s_source_format
+   s_tile_row="map.tile_row"
+   if source_metadata.get('tile_row_type','tms') != self.s_y_type:
+    s_tile_row="((1 << map.zoom_level) - 1 - map.tile_row)"
+   s_y_type=self.s_y_type
+   # (zoom_level,tile_column,tile_row,key,grid_id,tile_data) of the source, with the key used in this db
+   if not 'map' in source_tables:
+    s_tile_row=s_tile_row.replace("map.","")
+    if self.s_schema == 'compact':
+     s_key="tile_hash(tile_data)"
+    else:
+     s_key="zoom_level||'-'||tile_column||'-'||%s||'.%s'" % (s_tile_row,s_y_type)
+    s_select="SELECT zoom_level,tile_column,%s AS tile_row,%s AS tile_key,%s AS grid_id,tile_data FROM source.tiles" % (s_tile_row,s_key,"NULL")
+   else:
+    source_map=[row[1] for row in self.mbtiles_cursor.execute("PRAGMA source.table_info(map);").fetchall()]
+    s_grid_id="NULL"
+    if 'grid_id' in source_map:
+     s_grid_id="map.grid_id"
+    if 'tile_hash' in source_map:
+     s_join="source.images AS images ON images.tile_hash = map.tile_hash"
+     if self.s_schema == 'compact':
+      s_key="map.tile_hash"
+     else:
+      # blank images keep their '.rgb' id, as mbtiles_convert does
+      s_key="COALESCE(blank_tile_id(map.tile_hash,images.tile_data),map.zoom_level||'-'||map.tile_column||'-'||%s||'.%s')" % (s_tile_row,s_y_type)
+    else:
+     s_join="source.images AS images ON images.tile_id = map.tile_id"
+     if self.s_schema == 'compact':
+      # blank images are stored under the hash of their id, as insert_image does
+      s_key="CASE WHEN substr(map.tile_id,-4) = '.rgb' THEN tile_hash(map.tile_id) ELSE tile_hash(images.tile_data) END"
+     else:
+      s_key="CASE WHEN substr(map.tile_id,-4) = '.rgb' THEN map.tile_id ELSE map.zoom_level||'-'||map.tile_column||'-'||%s||'.%s' END" % (s_tile_row,s_y_type)
+    s_select="SELECT map.zoom_level AS zoom_level,map.tile_column AS tile_column,%s AS tile_row,%s AS tile_key,%s AS grid_id,images.tile_data AS tile_data FROM source.map AS map JOIN %s" % (s_tile_row,s_key,s_grid_id,s_join)
+   s_missing=""
+   if s_conflict == 'IGNORE':
+    # only the images of tiles that will be added
+    s_missing=" WHERE NOT EXISTS (SELECT 1 FROM main.map AS target WHERE target.zoom_level = source_tiles.zoom_level AND target.tile_column = source_tiles.tile_column AND target.tile_row = source_tiles.tile_row)"
+   self.mbtiles_cursor.execute("INSERT OR %s INTO main.images (%s,tile_data) SELECT tile_key,tile_data FROM (%s) AS source_tiles%s;" % (s_images_conflict,s_key_column,s_select,s_missing))
+   i_map_changes=self.sqlite3_connection.total_changes
+   self.mbtiles_cursor.execute("INSERT OR %s INTO main.map (zoom_level,tile_column,tile_row,%s,grid_id) SELECT zoom_level,tile_column,tile_row,tile_key,grid_id FROM (%s) AS source_tiles;" % (s_conflict,s_key_column,s_select))
+   i_tiles+=self.sqlite3_connection.total_changes-i_map_changes
+   for s_table in ('grid_key','grid_utfgrid','keymap'):
+    if s_table in source_tables:
+     self.mbtiles_cursor.execute("INSERT OR IGNORE INTO main.%s SELECT * FROM source.%s;" % (s_table,s_table))
+   if i_source == 0 and not self.db_existed:
+    # a new db: name, description etc. of the first source
+    self.mbtiles_cursor.execute("INSERT OR IGNORE INTO main.metadata SELECT LOWER(name),value FROM source.metadata WHERE LOWER(name) != 'tile_inventory';")
+   self.sqlite3_connection.commit()
+   self.mbtiles_cursor.execute("DETACH DATABASE source;")
+   if self.verbose:
+    logger.info(_("MbTiles : mbtiles_merge: [%s] policy[%s] tiles[%d] [%s]") % (s_source,s_policy,i_tiles,self.s_path_db))
+  if s_conflict == 'REPLACE':
+   # images no longer used by a replaced tile
+   self.mbtiles_cursor.execute("DELETE FROM images WHERE %s NOT IN (SELECT %s FROM map);" % (s_key_column,s_key_column))
+   self.sqlite3_connection.commit()
+  self.inventory=None
+  self.fetch_metadata()
+  if s_format:
+   self.mbtiles_format=s_format
+  self.retrieve_bounds()
+  if self.verbose:
+   logger.info(_("MbTiles : mbtiles_merge: sources[%d] changes[%d] [%s]") % (len(source_list),self.sqlite3_connection.total_changes-i_changes,self.s_path_db))
+  return i_tiles
+
+ def build_overviews(self,i_min_zoom,i_max_zoom=None,i_processes=0,b_resume=False,i_batch=1000):
+  # builds the zoom_levels i_max_zoom-1 down to i_min_zoom from the tiles of the zoom_level above
+  # i_max_zoom: the zoom_level with the source tiles [default: the highest in the db]
+  # i_processes: 0 = one per cpu ; 1 = no extra processes
+  # b_resume: existing tiles are not built again
+  # i_batch: tiles written in one transaction
+  inventory=self.tile_inventory()
+  if not inventory['zoom']:
+   raise EmptyCoverageError(_("MbTiles : build_overviews: no tiles in [%s]") % self.s_path_db)
+  if i_max_zoom is None:
+   i_max_zoom=max(inventory['zoom'])
+  if i_processes < 1:
+   i_processes=multiprocessing.cpu_count()
+  pool=None
+  if i_processes > 1:
+   pool=multiprocessing.Pool(i_processes)
+  # columns given to the processes at one time, limits the tiles held in memory
+  i_block=i_processes*4
+  i_tiles=0
+  try:
+   for tz in range(i_max_zoom-1,i_min_zoom-1,-1):
+    zoom_inventory=self.tile_inventory()['zoom'].get(tz+1)
+    if zoom_inventory is None:
+     logger.warn(_("MbTiles : build_overviews: no tiles for zoom_level[%d] in [%s]") % (tz+1,self.s_path_db))
+     break
+    parent_columns=sorted(set([i_column/2 for i_column in zoom_inventory['columns']]))
+    i_zoom_tiles=0
+    for i_start in range(0,len(parent_columns),i_block):
+     jobs=[self.overview_job(tz,tx,b_resume) for tx in parent_columns[i_start:i_start+i_block]]
+     jobs=[job for job in jobs if job[2]]
+     if pool:
+      results=pool.map(overview_tiles,jobs)
+     else:
+      results=map(overview_tiles,jobs)
+     for tiles_list in results:
+      for tile_z,tile_x,tile_y,s_tile_id,tile_data in tiles_list:
+       self.insert_tile(tile_z,tile_x,tile_y,s_tile_id,tile_data,False)
+       i_zoom_tiles+=1
+       if i_zoom_tiles % i_batch == 0:
+        self.sqlite3_connection.commit()
+    self.sqlite3_connection.commit()
+    i_tiles+=i_zoom_tiles
+    if self.verbose:
+     logger.info(_("MbTiles : build_overviews: zoom_level[%d] tiles[%d] [%s]") % (tz,i_zoom_tiles,self.s_path_db))
+  finally:
+   if pool:
+    pool.close()
+    pool.join()
+  self.save_bounds()
+  return i_tiles
+
+ def overview_job(self,tz,tx,b_resume):
+  # the children of the tiles of column tx in tz, read with one range query on the index
+  children={}
+  rows=self.mbtiles_cursor.execute("SELECT tile_column,tile_row,tile_data FROM tiles WHERE zoom_level = ? AND tile_column BETWEEN ? AND ?;",(tz+1,2*tx,2*tx+1))
+  for child_x,child_y,tile_data in rows.fetchall():
+   children.setdefault(child_y/2,[]).append((child_x,child_y,bytes(tile_data)))
+  if b_resume:
+   for ty in children.keys():
+    if self.count_tiles(tz,tx,ty,0):
+     del children[ty]
+  return (tz,tx,children,self.pil_format,self.jpg_quality,self.s_y_type)
+
+ def mbtiles_transcode(self,s_format,i_quality=None,i_processes=0,i_batch=1000):
+  # re-encodes all images of the db as s_format ['jpg','png','hybrid'], i_quality: jpg quality [default: jpg_quality]
+  # - png images become 8-bit paletted png when png8_colors is set [see png8_image]
+  # - i_batch images are read, encoded by the processes and written back in one transaction
+  # - i_processes: 0 = one per cpu ; 1 = no extra processes
+  # - 'compact': images are stored again under the hash of their new data, blank images keep their key
+  # returns {zoom_level: (bytes before,bytes after)} ; the file only shrinks after optimize_database
+  if s_format == 'jpeg':
+   s_format='jpg'
+  if s_format == 'jpg':
+   pil_format='JPEG'
+  elif s_format == 'png':
+   pil_format='PNG'
+  elif s_format == 'hybrid':
+   pil_format=None
+  else:
+   raise InvalidFormatError(_("MbTiles : mbtiles_transcode: format[%s] is not supported, use jpg, png or hybrid") % s_format)
+  if i_quality is not None:
+   self.jpg_quality=int(i_quality)
+  zoom_bytes={}
+  for i_zoom,zoom_inventory in self.tile_inventory(True)['zoom'].items():
+   zoom_bytes[i_zoom]=zoom_inventory['bytes']
+  self.inventory_changed()
+  if self.s_schema == 'compact':
+   s_key='tile_hash'
+   self.mbtiles_cursor.execute("DROP TABLE IF EXISTS images_transcode;")
+   self.mbtiles_cursor.execute("CREATE TABLE images_transcode (tile_hash INTEGER PRIMARY KEY,tile_data BLOB);")
+   self.mbtiles_cursor.execute("CREATE TEMP TABLE transcode_keys (old_hash INTEGER PRIMARY KEY,new_hash INTEGER);")
+  else:
+   # the tile_id of 'text' does not depend on the data: updated in place
+   s_key='rowid'
+  keys=[row[0] for row in self.mbtiles_cursor.execute("SELECT %s FROM images;" % s_key).fetchall()]
+  if i_processes < 1:
+   i_processes=multiprocessing.cpu_count()
+  pool=None
+  if i_processes > 1:
+   pool=multiprocessing.Pool(i_processes)
+  i_failed=0
+  try:
+   for i_start in range(0,len(keys),i_batch):
+    jobs=[]
+    for key in keys[i_start:i_start+i_batch]:
+     tile_data=self.mbtiles_cursor.execute("SELECT tile_data FROM images WHERE %s = ?;" % s_key,(key,)).fetchone()[0]
+     jobs.append((key,bytes(tile_data),pil_format,self.jpg_quality,self.png8_colors))
+    if pool:
+     results=pool.map(transcode_image,jobs)
+    else:
+     results=map(transcode_image,jobs)
+    for i_job in range(len(jobs)):
+     key,tile_data=results[i_job]
+     if tile_data is None:
+      # not an image: kept as it is
+      i_failed+=1
+      tile_data=jobs[i_job][1]
+     if s_key == 'rowid':
+      self.mbtiles_cursor.execute("UPDATE images SET tile_data = ? WHERE rowid = ?;",(buffer(tile_data),key))
+      continue
+     i_tile_hash=key
+     if self.tile_hash(jobs[i_job][1]) == key:
+      i_tile_hash=self.tile_hash(tile_data)
+     # as insert_compact
+     while True:
+      self.mbtiles_cursor.execute("INSERT OR IGNORE INTO images_transcode (tile_hash,tile_data) VALUES(?,?);",(i_tile_hash,buffer(tile_data)))
+      if self.mbtiles_cursor.rowcount == 1:
+       break
+      stored_data=self.mbtiles_cursor.execute("SELECT tile_data FROM images_transcode WHERE tile_hash = ?;",(i_tile_hash,)).fetchone()
+      if bytes(stored_data[0]) == bytes(tile_data):
+       break
+      i_tile_hash+=1
+     self.mbtiles_cursor.execute("INSERT INTO transcode_keys (old_hash,new_hash) VALUES(?,?);",(key,i_tile_hash))
+    self.sqlite3_connection.commit()
+    if self.verbose:
+     logger.info(_("MbTiles : mbtiles_transcode: images[%d/%d] [%s]") % (min(i_start+i_batch,len(keys)),len(keys),self.s_path_db))
+  finally:
+   if pool:
+    pool.close()
+    pool.join()
+  if s_key == 'tile_hash':
+   # the map is updated in one pass, when all old keys are known
+   self.mbtiles_cursor.execute("UPDATE map SET tile_hash = (SELECT new_hash FROM transcode_keys WHERE old_hash = map.tile_hash) WHERE tile_hash IN (SELECT old_hash FROM transcode_keys);")
+   self.mbtiles_cursor.execute("DELETE FROM images;")
+   self.mbtiles_cursor.execute("INSERT INTO images (tile_hash,tile_data) SELECT tile_hash,tile_data FROM images_transcode;")
+   self.mbtiles_cursor.execute("DROP TABLE images_transcode;")
+   self.mbtiles_cursor.execute("DROP TABLE transcode_keys;")
+   self.sqlite3_connection.commit()
+   self.blank_ids={}
+  if i_failed:
+   logger.warn(_("MbTiles : mbtiles_transcode: %d images could not be read and were not changed [%s]") % (i_failed,self.s_path_db))
+  self.pil_format=pil_format
+  self.insert_metadata([('format',s_format)])
+  for i_zoom,zoom_inventory in self.tile_inventory(True)['zoom'].items():
+   zoom_bytes[i_zoom]=(zoom_bytes.get(i_zoom,0),zoom_inventory['bytes'])
+   i_before,i_after=zoom_bytes[i_zoom]
+   logger.info(_("MbTiles : mbtiles_transcode: zoom_level[%d] bytes[%d] -> [%d] (%.1f%%) [%s]") % (i_zoom,i_before,i_after,100.0*i_after/max(i_before,1),s_format))
+  return zoom_bytes
+
  def get_tile_dirs(self,path):
   return [name for name in os.listdir(path) if os.path.isdir(os.path.join(path, name))]
 
@@ -503,13 +1365,6 @@ class MbTiles(object):
   if self.verbose:
    logger.info(_("MbTiles : mbtiles_from_disk: fetching[%s] ") % directory_path)
   image_format = ""
-  min_zoom=22
-  max_zoom=0
-  bounds_west=180.0
-  bounds_east=-180.0
-  bounds_north=-85.05113
-  bounds_south=85.05113
-  mercator = GlobalMercator(self.tms_osm)
   if self.mbtiles_description == '':
    self.mbtiles_description=os.path.splitext(os.path.basename(directory_path))[0]
    if self.mbtiles_name == '':
@@ -517,40 +1372,24 @@ class MbTiles(object):
     self.mbtiles_name=self.mbtiles_name.replace("_"," ")
   for zoomDir in self.get_tile_dirs(directory_path):
    z = int(zoomDir)
-   if z > max_zoom:
-    max_zoom=z
-   if z < min_zoom:
-    min_zoom=z
    for rowDir in self.get_tile_dirs(os.path.join(directory_path, zoomDir)):
     x = int(rowDir)
     for current_file in os.listdir(os.path.join(directory_path, zoomDir, rowDir)):
      file_name, ext = current_file.split('.', 1)
      if image_format == "":
       image_format=ext
+     elif image_format != ext:
+      # jpg and png tiles
+      image_format='hybrid'
      f = open(os.path.join(directory_path, zoomDir, rowDir, current_file), 'rb')
      image_data = f.read()
      f.close()
      y = int(file_name)
      self.insert_image(z,x,y,image_data)
-     tile_bounds= mercator.TileLatLonBounds(x,y,z)
-     if tile_bounds[0] < bounds_south:
-      bounds_south=tile_bounds[0]
-     if tile_bounds[1] < bounds_west:
-      bounds_west=tile_bounds[1]
-     if tile_bounds[2] > bounds_north:
-      bounds_north=tile_bounds[2]
-     if tile_bounds[3] > bounds_east:
-      bounds_east=tile_bounds[3]
 
   self.mbtiles_format=image_format
-  self.mbtiles_bounds="%f,%f,%f,%f"% (bounds_west,bounds_south,bounds_east,bounds_north)
-  mbtiles_center_x=(bounds_east+bounds_west)/2
-  mbtiles_center_y=(bounds_north+bounds_south)/2
-  self.mbtiles_center="%f,%f,%s"%(mbtiles_center_x,mbtiles_center_y,min_zoom)
-  self.mbtiles_minzoom=min_zoom
-  self.mbtiles_maxzoom=max_zoom
-  self.save_metadata()
-  self.optimize_database()
+  # bounds and min/max zoom_levels were collected by insert_image
+  self.save_bounds()
   if not  os.path.exists(os.path.join(directory_path, "tilemapresource.xml")):
    s_xml=self.mbtiles_create_tilemapresource();
    f = open(os.path.join(directory_path, "tilemapresource.xml"), 'w')
@@ -574,7 +1413,10 @@ class MbTiles(object):
    tile_dir = os.path.join(directory_path, str(z), str(x))
    if not os.path.isdir(tile_dir):
     os.makedirs(tile_dir)
-   tile = os.path.join(tile_dir,'%s.%s' % (y, self.mbtiles_format))
+   s_extension=self.mbtiles_format
+   if s_extension == 'hybrid':
+    s_extension=sniff_format(t[3])
+   tile = os.path.join(tile_dir,'%s.%s' % (y, s_extension))
    f = open(tile, 'wb')
    f.write(t[3])
    f.close()
@@ -837,13 +1679,14 @@ class TileSource(object):
 # from Landez project
 # https://github.com/makinacorpus/landez
 class MBTilesReader(TileSource):
- def __init__(self, mbtiles_input, tilesize=None):
+ def __init__(self, mbtiles_input, tilesize=None, mbtiles_profile='read'):
   super(MBTilesReader, self).__init__(tilesize)
+  self.mbtiles_profile=mbtiles_profile
   self.mbtiles_input = mbtiles_input.strip()
   self.basename = os.path.basename(self.mbtiles_input)
   self.mbtiles_input_dir=os.path.dirname(self.mbtiles_input)+ '/'
   self.mbtiles_db_input=MbTiles()
-  self.mbtiles_db_input.open_db(self.mbtiles_input,self.mbtiles_input_dir,self.mbtiles_format,self.s_y_type,self.mbtiles_verbose)
+  self.mbtiles_db_input.open_db(self.mbtiles_input,self.mbtiles_input_dir,self.mbtiles_format,self.s_y_type,self.mbtiles_verbose,self.mbtiles_profile)
   self.metadata_input=self.mbtiles_db_input.fetch_metadata()
   self.tms_osm=self.mbtiles_db_input.tms_osm
   self.mbtiles_format=self.mbtiles_db_input.mbtiles_format
@@ -892,6 +1735,7 @@ class TilesManager(object):
   stylefile -- mapnik stylesheet file (*to render tiles locally*)
 
   mbtiles_file -- A MBTiles file providing tiles (*to extract its tiles*)
+  mbtiles_input_profile -- SQLite connection profile of mbtiles_file (see MBTILES_PROFILES, default 'read')
 
   wms_server -- A WMS server url (*to request tiles*)
   wms_layers -- The list of layers to be requested
@@ -917,7 +1761,7 @@ class TilesManager(object):
   self.wms_layers = kwargs.get('wms_layers', [])
   self.wms_options = kwargs.get('wms_options', {})
   if self.mbtiles_input:
-   self.reader = MBTilesReader(self.mbtiles_input, self.tile_size)
+   self.reader = MBTilesReader(self.mbtiles_input, self.tile_size, kwargs.get('mbtiles_input_profile', 'read'))
   elif self.wms_server:
    assert self.wms_layers, _("Requires at least one layer (see ``wms_layers`` parameter)")
    self.reader = WMSReader(self.wms_server, self.wms_layers,self.tile_size, **self.wms_options)
@@ -1056,9 +1900,15 @@ class MBTilesBuilder(TilesManager):
   A MBTiles builder for a list of bounding boxes and zoom levels.
   mbtiles_output -- output MBTiles file (default DEFAULT_MBTILES_OUTPUT)
   tmp_dir -- temporary folder for gathering tiles (default DEFAULT_TMP_DIR/mbtiles_output)
+  mbtiles_profile -- SQLite connection profile of mbtiles_output (see MBTILES_PROFILES, default 'bulk')
+  mbtiles_schema -- table layout of a new mbtiles_output (see MBTILES_SCHEMAS, default 'text')
+  png8 -- png tiles with up to png8 distinct colours are stored as 8-bit paletted png when smaller (default 0, not used)
   """
   super(MBTilesBuilder, self).__init__(**kwargs)
   self.mbtiles_output = kwargs.get('mbtiles_output', DEFAULT_MBTILES_OUTPUT)
+  self.mbtiles_profile = kwargs.get('mbtiles_profile', 'bulk')
+  self.mbtiles_schema = kwargs.get('mbtiles_schema', 'text')
+  self.png8 = kwargs.get('png8', 0)
   # Gather tiles for mbutil
   basename, ext = os.path.splitext(os.path.basename(self.mbtiles_output))
   self.tmp_dir = kwargs.get('tmp_dir', DEFAULT_TMP_DIR)
@@ -1095,6 +1945,14 @@ class MBTilesBuilder(TilesManager):
   """
   return self._bboxes[0][0]  #TODO: merge all coverages
 
+ def passthrough(self):
+  """
+  True when the images of the MBTilesReader can be stored as they are [same format, nothing to blend, filter or quantise].
+  """
+  if not isinstance(self.reader, MBTilesReader) or len(self._layers) > 0 or len(self._filters) > 0 or self.png8:
+   return False
+  return self.reader.mbtiles_format.replace('jpeg','jpg') == self.mbtiles_db_output.mbtiles_format.replace('jpeg','jpg')
+
  def run(self, add=False, i_parm=0):
   """
   Build a MBTile file.
@@ -1131,18 +1989,38 @@ class MBTilesBuilder(TilesManager):
   self.mbtiles_output=self.mbtiles_output.strip()
   self.mbtiles_output_dir=os.path.dirname(self.mbtiles_output)+ '/'
   self.mbtiles_db_output=MbTiles()
-  self.mbtiles_db_output.open_db(self.mbtiles_output,self.mbtiles_output_dir,self.reader.mbtiles_format,self.reader.s_y_type,self.reader.mbtiles_verbose)
+  self.mbtiles_db_output.open_db(self.mbtiles_output,self.mbtiles_output_dir,self.reader.mbtiles_format,self.reader.s_y_type,self.reader.mbtiles_verbose,self.mbtiles_profile,self.mbtiles_schema)
+  self.mbtiles_db_output.png8_colors=self.png8
   if self.reader.metadata_input:
    self.mbtiles_db_output.insert_metadata(self.reader.metadata_input)
   # Go through whole list of tiles and read from input_db and store in output_db
   self.rendered = 0
+  b_passthrough=self.passthrough()
+  if b_passthrough:
+   logger.info(_("MBTilesBuilder.run: format[%s] of input and output are the same, images will be copied without decoding.") % self.reader.mbtiles_format)
+  i_copied=0
   # something is 'unsorting' this
   for (z, x, y) in sorted(tileslist,key=operator.itemgetter(0,1,2)):
-   image_data=self.tile((z,x,y))
-   if not image_data is None:
-    self.mbtiles_db_output.insert_image(z,x,y,image_data)
-  # calculate the min/max zoom_levels and bounds
-  self.mbtiles_db_output.retrieve_bounds()
+   if b_passthrough:
+    image_key=self.reader.mbtiles_db_input.retrieve_image_key(z,x,y)
+    if image_key is None:
+     self.rendered+=1
+     continue
+    image_data,key=image_key
+    s_tile_id=self.reader.mbtiles_db_input.blank_tile_id(key,image_data)
+    if s_tile_id is None:
+     s_tile_id="{0}-{1}-{2}.{3}".format(str(z),str(x),str(y),self.mbtiles_db_output.s_y_type)
+    self.mbtiles_db_output.insert_tile(z,x,y,s_tile_id,image_data,False)
+    i_copied+=1
+    if i_copied % 1000 == 0:
+     self.mbtiles_db_output.sqlite3_connection.commit()
+   else:
+    image_data=self.tile((z,x,y))
+    if not image_data is None:
+     self.mbtiles_db_output.insert_image(z,x,y,image_data)
+  self.mbtiles_db_output.sqlite3_connection.commit()
+  # calculate the min/max zoom_levels and bounds [from what was inserted, no scan of the db]
+  self.mbtiles_db_output.save_bounds()
   logger.debug(_("MBTilesBuilder.run: %s tiles were missing.") % self.rendered)
   # Package it!
   logger.info(_("Build MBTiles output file '%s'.") % self.mbtiles_output)
@@ -44,6 +44,7 @@ import cPickle as pickle
 import pptransport
 import ppauto
 import Queue
+import collections
 
 copyright = "Copyright (c) 2005-2009 Vitalii Vanovschi. All rights reserved"
 version = "1.5.7"
@@ -70,8 +71,14 @@ class _Task(object):
     """
 
     def __init__(self, server, tid, callback=None,
-            callbackargs=(), group='default'):
-        """Initializes the task"""
+            callbackargs=(), group='default', chunk=False, done_queue=None,
+            key=None):
+        """Initializes the task
+
+           chunk - the task runs func for a list of argument tuples
+                   (Server.map), the result is the list of the results
+           done_queue - Queue.Queue the task is put into when finished
+           key - affinity key of the task, used by the scheduling policy"""
         self.lock = thread.allocate_lock()
         self.lock.acquire()
         self.tid = tid
@@ -79,6 +86,9 @@ class _Task(object):
         self.callback = callback
         self.callbackargs = callbackargs
         self.group = group
+        self.chunk = chunk
+        self.done_queue = done_queue
+        self.key = key
         self.finished = False
         self.unpickled = False
 
@@ -91,6 +101,8 @@ class _Task(object):
             self.__unpickle()
         self.lock.release()
         self.finished = True
+        if self.done_queue is not None:
+            self.done_queue.put(self)
 
     def __call__(self, waitflag=1, raw_result=False):
         """Retrieves result of the task"""
@@ -131,8 +143,41 @@ class _Task(object):
         if len(sout) > 0:
             print sout,
         if self.callback:
-            args = self.callbackargs + (self.result, )
-            self.callback(*args)
+            if self.chunk:
+                # one call for each result of the chunk
+                for result in self.result or ():
+                    self.callback(*(self.callbackargs + (result, )))
+            else:
+                args = self.callbackargs + (self.result, )
+                self.callback(*args)
+
+
+class _Dispatcher(object):
+    """Thread running the jobs of one worker, one after the other
+    """
+
+    def __init__(self):
+        """Starts the dispatcher thread"""
+        self.jobs = Queue.Queue()
+        thread.start_new_thread(self.__run, ())
+
+    def put(self, function, args):
+        """Runs function(*args) in the dispatcher thread"""
+        self.jobs.put((function, args))
+
+    def stop(self):
+        """Ends the dispatcher thread after the queued jobs"""
+        self.jobs.put(None)
+
+    def __run(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                break
+            try:
+                job[0](*job[1])
+            except:
+                sys.excepthook(*sys.exc_info())
 
 
 class _Worker(object):
@@ -158,6 +203,8 @@ class _Worker(object):
         """Initializes local worker"""
         self.restart_on_free = restart_on_free
         self.pickle_proto = pickle_proto
+        # jobs for this worker only (Server.insert_each), run before the queue
+        self.pinned = collections.deque()
         self.start()
 
     def start(self):
@@ -199,9 +246,14 @@ class _RWorker(pptransport.CSocketTransport):
     """Remote worker class
     """
 
-    def __init__(self, host, port, secret, message=None, persistent=True):
-        """Initializes remote worker"""
+    def __init__(self, host, port, secret, message=None, persistent=True,
+            compression=True):
+        """Initializes remote worker
+
+           compression - offer the compressions of pptransport for the
+                   messages of the connection"""
         self.persistent = persistent
+        self.compression_enabled = compression
         self.host = host
         self.port = port
         self.secret = secret
@@ -226,6 +278,9 @@ class _RWorker(pptransport.CSocketTransport):
                     logging.error("Authentication failed for host=%s, port=%s"
                             % (self.host, self.port))
                     return False
+                if self.compression_enabled:
+                    # without it the protocol is the one of older ppservers
+                    self.negotiate_compression()
                 if message:
                     self.send(message)
                 self.is_free = True
@@ -252,6 +307,107 @@ class _Statistics(object):
         self.time = 0.0
         self.njobs = 0
         self.rworker = rworker
+        # wall time of the finished jobs, measured by this server
+        # (with the transfer to and from a remote node)
+        self.jobtime = 0.0
+        self.jobsdone = 0
+        # bytes sent and received over the connections with a remote node
+        # (updated by Server.get_stats)
+        self.transfer = None
+
+    def expected_time(self):
+        """Mean wall time of a job on the node, 0.0 while unknown"""
+        if self.jobsdone:
+            return self.jobtime / self.jobsdone
+        return 0.0
+
+
+class FIFOPolicy(object):
+    """Scheduling policy: the oldest job to the first free worker
+
+       The candidates are the free local worker (while fewer than ncpus
+       tasks are active), then the free remote workers and, when more jobs
+       than ncpus are waiting, the reserved remote workers. All workers take
+       their jobs from one queue: a worker that is free takes the next job,
+       so that no node waits while another one has a backlog.
+    """
+
+    def select_worker(self, candidates, stats):
+        """Returns the (worker, node) of candidates to run the next job"""
+        return candidates[0]
+
+    def select_job(self, queue, worker):
+        """Returns the index in queue of the job for worker"""
+        return 0
+
+
+class AffinityPolicy(FIFOPolicy):
+    """Scheduling policy: a worker takes the job with the key nearest to the
+       key of its last job
+
+       Keys are given with submit(key=) or map(key=), for tiling the
+       (zoom, x, y) of a metatile: neighbouring tiles go to the same worker,
+       whose GDAL block cache and open dataset are still warm. Tuples of
+       numbers are compared by the sum of their differences, other keys by
+       equality. Only the first 'window' jobs of the queue are searched;
+       without a job within 'distance', the worker takes (steals) the oldest
+       job.
+    """
+
+    def __init__(self, window=64, distance=None):
+        self.window = window
+        self.distance = distance
+
+    def key_distance(self, key1, key2):
+        """Returns the distance between two job keys"""
+        if key1 == key2:
+            return 0
+        if isinstance(key1, tuple) and isinstance(key2, tuple) \
+                and len(key1) == len(key2):
+            try:
+                return sum([abs(a - b) for a, b in zip(key1, key2)])
+            except TypeError:
+                pass
+        return None
+
+    def select_job(self, queue, worker):
+        last_key = getattr(worker, "last_key", None)
+        if last_key is None:
+            return 0
+        best, best_distance = 0, None
+        for i in xrange(min(len(queue), self.window)):
+            key = queue[i][0].key
+            if key is None:
+                continue
+            distance = self.key_distance(last_key, key)
+            if distance is None:
+                continue
+            if best_distance is None or distance < best_distance:
+                best, best_distance = i, distance
+                if distance == 0:
+                    break
+        if best_distance is None or (self.distance is not None
+                and best_distance > self.distance):
+            return 0
+        return best
+
+
+class ShortestTimePolicy(FIFOPolicy):
+    """Scheduling policy: the next job to the free node with the shortest
+       mean job time (_Statistics.expected_time)
+
+       Nodes without finished jobs are tried first; on equal times the
+       order of FIFOPolicy is kept (local workers first).
+    """
+
+    def select_worker(self, candidates, stats):
+        best = candidates[0]
+        best_time = stats[best[1]].expected_time()
+        for candidate in candidates[1:]:
+            expected_time = stats[candidate[1]].expected_time()
+            if expected_time < best_time:
+                best, best_time = candidate, expected_time
+        return best
 
 
 class Template(object):
@@ -300,7 +456,7 @@ class Server(object):
 
     def __init__(self, ncpus="autodetect", ppservers=(), secret=None,
             loglevel=logging.WARNING, logstream=sys.stderr,
-            restart=False, proto=0):
+            restart=False, proto=0, policy=None, compression=True):
         """Creates Server instance
 
            ncpus - the number of worker processes to start on the local
@@ -315,6 +471,11 @@ class Server(object):
            logstream - log stream destination
            restart - wheather to restart worker process after each task completion
            proto - protocol number for pickle module
+           policy - scheduling policy (FIFOPolicy, AffinityPolicy,
+                   ShortestTimePolicy), if omitted FIFOPolicy
+           compression - compress the large messages to and from ppservers
+                   with lz4 (when installed) or zlib, if the ppserver also
+                   supports it
 
            With ncpus = 1 all tasks are executed consequently
            For the best performance either use the default "autodetect" value
@@ -329,7 +490,7 @@ class Server(object):
         self.__tid = 0
         self.__active_tasks = 0
         self.__active_tasks_lock = thread.allocate_lock()
-        self.__queue = []
+        self.__queue = collections.deque()
         self.__queue_lock = thread.allocate_lock()
         self.__workers = []
         self.__rworkers = []
@@ -345,6 +506,8 @@ class Server(object):
         self.__active_rworkers_list_lock = thread.allocate_lock()
         self.__restart_on_free = restart
         self.__pickle_proto = proto
+        self.set_policy(policy)
+        self.__compression = compression
 
         # queue of messages from working processes
         self.msg_que = Queue.Queue()
@@ -397,7 +560,8 @@ class Server(object):
                 % (self.__ncpus, ))
 
     def submit(self, func, args=(), depfuncs=(), modules=(),
-            callback=None, callbackargs=(), group='default', globals=None):
+            callback=None, callbackargs=(), group='default', globals=None,
+            key=None):
         """Submits function to the execution queue
 
             func - function to be executed
@@ -412,67 +576,24 @@ class Server(object):
             jobs in a given group to finish
             globals - dictionary from which all modules, functions and classes
             will be imported, for instance: globals=globals()
+            key - affinity key of the job for the scheduling policy,
+            for instance the (zoom, x, y) of a metatile
         """
 
-        # perform some checks for frequent mistakes
-        if self.__exiting:
-            raise RuntimeError("Cannot submit jobs: server"\
-                    " instance has been destroyed")
-
         if not isinstance(args, tuple):
             raise TypeError("args argument must be a tuple")
-
-        if not isinstance(depfuncs, tuple):
-            raise TypeError("depfuncs argument must be a tuple")
-
-        if not isinstance(modules, tuple):
-            raise TypeError("modules argument must be a tuple")
-
-        if not isinstance(callbackargs, tuple):
-            raise TypeError("callbackargs argument must be a tuple")
-
-        for module in modules:
-            if not isinstance(module, types.StringType):
-                raise TypeError("modules argument must be a list of strings")
+        self.__check_submit(depfuncs, modules, callbackargs)
 
         tid = self.__gentid()
-
-        if globals:
-            modules += tuple(self.__find_modules("", globals))
-            modules = tuple(set(modules))
-            self.__logger.debug("Task %i will autoimport next modules: %s" %
-                    (tid, str(modules)))
-            for object1 in globals.values():
-                if isinstance(object1, types.FunctionType) \
-                        or isinstance(object1, types.ClassType):
-                    depfuncs += (object1, )
-
-        task = _Task(self, tid, callback, callbackargs, group)
+        task = _Task(self, tid, callback, callbackargs, group, key=key)
 
         self.__waittasks_lock.acquire()
         self.__waittasks.append(task)
         self.__waittasks_lock.release()
 
-        # if the function is a method of a class add self to the arguments list
-        if isinstance(func, types.MethodType) and func.im_self is not None:
-            args = (func.im_self, ) + args
-
-        # if there is an instance of a user deined class in the arguments add
-        # whole class to dependancies
-        for arg in args:
-            # Checks for both classic or new class instances
-            if isinstance(arg, types.InstanceType) \
-                    or str(type(arg))[:6] == "<class":
-                depfuncs += (arg.__class__, )
-
-        # if there is a function in the arguments add this
-        # function to dependancies
-        for arg in args:
-            if isinstance(arg, types.FunctionType):
-                depfuncs += (arg, )
-
-        sfunc = self.__dumpsfunc((func, ) + depfuncs, modules)
-        sargs = pickle.dumps(args, self.__pickle_proto)
+        sfunc, argslist = self.__dumpsjob(func, [args], depfuncs, modules,
+                globals)
+        sargs = pickle.dumps(argslist[0], self.__pickle_proto)
 
         self.__queue_lock.acquire()
         self.__queue.append((task, sfunc, sargs))
@@ -483,6 +604,101 @@ class Server(object):
         self.__scheduler()
         return task
 
+    def map(self, func, argslist, chunksize=None, depfuncs=(), modules=(),
+            callback=None, callbackargs=(), group='default', globals=None,
+            ordered=True, key=None):
+        """Submits func for each argument tuple of argslist, in chunks
+
+            func - function to be executed
+            argslist - iterable of tuples with arguments of the 'func'
+            chunksize - number of calls of 'func' in one job, if omitted
+                    it is chosen to give each worker about 4 jobs
+                    (64 when argslist has no len)
+            depfuncs, modules, callback, callbackargs, group, globals -
+                    as in submit, the callback is called for each result
+            ordered - yield the results in the order of argslist, otherwise
+                    as the chunks are finished
+            key - function returning the affinity key of a chunk for the
+                    scheduling policy, called with the first argument tuple
+                    of the chunk
+
+            Returns an iterator over the results, which are yielded as soon
+            as their chunk is finished. The function is sent once for each
+            chunk; 'func' must not write "EXIT" to stderr itself.
+        """
+        self.__check_submit(depfuncs, modules, callbackargs)
+        if chunksize is None:
+            chunksize = 64
+            if hasattr(argslist, "__len__"):
+                nworkers = max(1, self.__ncpus + len(self.__rworkers))
+                chunksize = max(1, -(-len(argslist) // (nworkers * 4)))
+        if chunksize < 1:
+            raise ValueError("chunksize must be an integer > 0")
+
+        done_queue = Queue.Queue()
+        tasks = []
+        chunk = []
+        for args in argslist:
+            if not isinstance(args, tuple):
+                raise TypeError("argslist must contain tuples")
+            chunk.append(args)
+            if len(chunk) == chunksize:
+                tasks.append(self.__submit_chunk(func, chunk, depfuncs,
+                        modules, callback, callbackargs, group, globals,
+                        done_queue, key))
+                chunk = []
+        if chunk:
+            tasks.append(self.__submit_chunk(func, chunk, depfuncs,
+                    modules, callback, callbackargs, group, globals,
+                    done_queue, key))
+        return self.__map_results(tasks, done_queue, ordered)
+
+    def each(self, func, args=(), depfuncs=(), modules=(), globals=None):
+        """Runs func(*args) once in every worker process: in each local
+           worker and in each worker of the connected ppservers
+
+            func, args, depfuncs, modules, globals - as in submit
+
+            Meant for the state a function keeps in its worker between the
+            jobs, for instance to close it. Waits for the jobs running in
+            the workers, then for func. Returns the list of the results, one
+            for each worker that was reached; a ppserver which can not be
+            reached or does not support it is left out.
+        """
+        if not isinstance(args, tuple):
+            raise TypeError("args argument must be a tuple")
+        self.__check_submit(depfuncs, modules, ())
+
+        sfunc, argslist = self.__dumpsjob(func, [args], depfuncs, modules,
+                globals)
+        # a chunk of one job, ppworker writes "EXIT" for it
+        sargs = pickle.dumps(argslist, self.__pickle_proto)
+
+        sresults = [task(raw_result=True)
+                for task in self.insert_each(sfunc, sargs)]
+        nodes = {}
+        for rworker in self.__rworkers:
+            nodes[rworker.id] = rworker.address
+        for node, address in nodes.items():
+            try:
+                rworker = _RWorker(address[0], address[1], self.secret,
+                        "EACH", False, self.__compression)
+                rworker.send(sfunc)
+                rworker.send(sargs)
+                sresults += pickle.loads(rworker.receive())
+                rworker.close()
+            except:
+                self.__logger.debug("Node %s did not run the job of each"
+                        % (node, ))
+
+        results = []
+        for sresult in sresults:
+            result, sout = pickle.loads(sresult)
+            if len(sout) > 0:
+                print sout,
+            results += result or []
+        return results
+
     def wait(self, group=None):
         """Waits for all jobs in a given group to finish.
            If group is omitted waits for all jobs to finish
@@ -520,6 +736,20 @@ class Server(object):
         self.__stats["local"].ncpus = ncpus
         self.__ncpus = ncpus
 
+    def get_policy(self):
+        """Returns the scheduling policy"""
+        return self.__policy
+
+    def set_policy(self, policy=None):
+        """Sets the scheduling policy
+
+        policy - FIFOPolicy, AffinityPolicy or ShortestTimePolicy (or an
+                object with their select_worker and select_job methods),
+                if omitted FIFOPolicy"""
+        if policy is None:
+            policy = FIFOPolicy()
+        self.__policy = policy
+
     def get_active_nodes(self):
         """Returns active nodes as a dictionary
         [keys - nodes, values - ncpus]"""
@@ -540,6 +770,7 @@ class Server(object):
                 except:
                     self.__accurate_stats = False
                     stat.time = 0.0
+                stat.transfer = self.__transfer(node)
         return self.__stats
 
     def print_stats(self):
@@ -561,6 +792,16 @@ class Server(object):
                         stat.time/stat.njobs, ppserver, )
         print "Time elapsed since server creation", walltime
 
+        for ppserver, stat in statistics:
+            if stat.transfer:
+                print "Transfer %s (%s): sent %i bytes (%i on the wire), " \
+                        "received %i bytes (%i on the wire), ratio %.2f" \
+                        % (ppserver, stat.transfer["compression"],
+                        stat.transfer["sent"], stat.transfer["sent_wire"],
+                        stat.transfer["received"],
+                        stat.transfer["received_wire"],
+                        stat.transfer["ratio"])
+
         if not self.__accurate_stats:
             print "WARNING: statistics provided above is not accurate" \
                   " due to job rescheduling"
@@ -583,27 +824,51 @@ class Server(object):
         self.__scheduler()
         return task
 
+    def insert_each(self, sfunc, sargs):
+        """Inserts function once for each local worker, returns the tasks.
+           It's intended for internal use only (each, ppserver.py).
+        """
+        tasks = []
+        for worker in self.__workers:
+            task = _Task(self, self.__gentid(), chunk=True)
+            self.__waittasks_lock.acquire()
+            self.__waittasks.append(task)
+            self.__waittasks_lock.release()
+            self.__queue_lock.acquire()
+            worker.pinned.append((task, sfunc, sargs))
+            self.__queue_lock.release()
+            tasks.append(task)
+
+        self.__logger.debug("%i tasks inserted, one for each worker"
+                % (len(tasks), ))
+        self.__scheduler()
+        return tasks
+
     def connect1(self, host, port, persistent=True):
         """Conects to a remote ppserver specified by host and port"""
         try:
-            rworker = _RWorker(host, port, self.secret, "STAT", persistent)
+            rworker = _RWorker(host, port, self.secret, "STAT", persistent,
+                    self.__compression)
             ncpus = int(rworker.receive())
             hostid = host+":"+str(port)
             self.__stats[hostid] = _Statistics(ncpus, rworker)
 
             for x in range(ncpus):
-                rworker = _RWorker(host, port, self.secret, "EXEC", persistent)
+                rworker = _RWorker(host, port, self.secret, "EXEC", persistent,
+                        self.__compression)
                 self.__update_active_rworkers(rworker.id, 1)
                 # append is atomic - no need to lock self.__rworkers
                 self.__rworkers.append(rworker)
             #creating reserved rworkers
             for x in range(ncpus):
-                rworker = _RWorker(host, port, self.secret, "EXEC", persistent)
+                rworker = _RWorker(host, port, self.secret, "EXEC", persistent,
+                        self.__compression)
                 self.__update_active_rworkers(rworker.id, 1)
                 self.__rworkers_reserved.append(rworker)
             #creating reserved4 rworkers
             for x in range(ncpus*0):
-                rworker = _RWorker(host, port, self.secret, "EXEC", persistent)
+                rworker = _RWorker(host, port, self.secret, "EXEC", persistent,
+                        self.__compression)
 #                    self.__update_active_rworkers(rworker.id, 1)
                 self.__rworkers_reserved4.append(rworker)
             logging.debug("Connected to ppserver (host=%s, port=%i) \
@@ -613,6 +878,25 @@ class Server(object):
             pass
 #            sys.excepthook(*sys.exc_info())
 
+    def __transfer(self, node):
+        """Sums the transfer counters of the connections with a node"""
+        transfer = {"sent": 0, "sent_wire": 0, "received": 0,
+                "received_wire": 0, "compression": "none"}
+        rworkers = [self.__stats[node].rworker] + self.__rworkers \
+                + self.__rworkers_reserved
+        for rworker in rworkers:
+            if rworker.id == node:
+                for key in ("sent", "sent_wire", "received", "received_wire"):
+                    transfer[key] += rworker.transfer[key]
+                if rworker.compression:
+                    transfer["compression"] = rworker.compression[0]
+        # bytes of the messages for each byte on the wire
+        transfer["ratio"] = 1.0
+        if transfer["sent_wire"] + transfer["received_wire"]:
+            transfer["ratio"] = float(transfer["sent"] + transfer["received"]) \
+                    / (transfer["sent_wire"] + transfer["received_wire"])
+        return transfer
+
     def __connect(self):
         """Connects to all remote ppservers"""
         for ppserver in self.ppservers:
@@ -674,62 +958,159 @@ class Server(object):
                             object.__name__+".", object.__dict__))
         return modules
 
+    def __check_submit(self, depfuncs, modules, callbackargs):
+        """Checks the arguments of submit and map for frequent mistakes"""
+        if self.__exiting:
+            raise RuntimeError("Cannot submit jobs: server"\
+                    " instance has been destroyed")
+
+        if not isinstance(depfuncs, tuple):
+            raise TypeError("depfuncs argument must be a tuple")
+
+        if not isinstance(modules, tuple):
+            raise TypeError("modules argument must be a tuple")
+
+        if not isinstance(callbackargs, tuple):
+            raise TypeError("callbackargs argument must be a tuple")
+
+        for module in modules:
+            if not isinstance(module, types.StringType):
+                raise TypeError("modules argument must be a list of strings")
+
+    def __dumpsjob(self, func, argslist, depfuncs, modules, globals):
+        """Serializes func with its dependancies for the argument tuples of
+           argslist, returns the serialized function and the argslist"""
+        if globals:
+            modules += tuple(self.__find_modules("", globals))
+            modules = tuple(set(modules))
+            self.__logger.debug("Function '%s' will autoimport next "\
+                    "modules: %s" % (func.func_name, str(modules)))
+            for object1 in globals.values():
+                if isinstance(object1, types.FunctionType) \
+                        or isinstance(object1, types.ClassType):
+                    depfuncs += (object1, )
+
+        # if the function is a method of a class add self to the arguments list
+        if isinstance(func, types.MethodType) and func.im_self is not None:
+            argslist = [(func.im_self, ) + args for args in argslist]
+
+        for args in argslist:
+            for arg in args:
+                # if there is an instance of a user deined class in the
+                # arguments add whole class to dependancies
+                # Checks for both classic or new class instances
+                if isinstance(arg, types.InstanceType) \
+                        or str(type(arg))[:6] == "<class":
+                    if arg.__class__ not in depfuncs:
+                        depfuncs += (arg.__class__, )
+                # if there is a function in the arguments add this
+                # function to dependancies
+                elif isinstance(arg, types.FunctionType):
+                    if arg not in depfuncs:
+                        depfuncs += (arg, )
+
+        return self.__dumpsfunc((func, ) + depfuncs, modules), argslist
+
+    def __submit_chunk(self, func, chunk, depfuncs, modules, callback,
+            callbackargs, group, globals, done_queue, key):
+        """Submits one chunk of map as a single job"""
+        tid = self.__gentid()
+        chunk_key = None
+        if key is not None:
+            chunk_key = key(chunk[0])
+        task = _Task(self, tid, callback, callbackargs, group, True,
+                done_queue, chunk_key)
+
+        self.__waittasks_lock.acquire()
+        self.__waittasks.append(task)
+        self.__waittasks_lock.release()
+
+        sfunc, chunk = self.__dumpsjob(func, chunk, depfuncs, modules,
+                globals)
+        # a list of argument tuples is run by ppworker as a chunk
+        sargs = pickle.dumps(chunk, self.__pickle_proto)
+
+        self.__queue_lock.acquire()
+        self.__queue.append((task, sfunc, sargs))
+        self.__queue_lock.release()
+
+        self.__logger.debug("Task %i submited, function='%s', chunk of %i" %
+                (tid, func.func_name, len(chunk)))
+        self.__scheduler()
+        return task
+
+    def __map_results(self, tasks, done_queue, ordered):
+        """Yields the results of the chunk tasks of map"""
+        if ordered:
+            for task in tasks:
+                for result in task() or ():
+                    yield result
+        else:
+            for i in xrange(len(tasks)):
+                task = done_queue.get()
+                for result in task() or ():
+                    yield result
+
+    def __dispatch(self, worker, function, args):
+        """Runs function(*args) in the dispatcher thread of the worker"""
+        if not hasattr(worker, "dispatcher"):
+            worker.dispatcher = _Dispatcher()
+        worker.dispatcher.put(function, args)
+
     def __scheduler(self):
         """Schedules jobs for execution"""
         self.__queue_lock.acquire()
+        for worker in self.__workers:
+            if worker.is_free and worker.pinned:
+                worker.is_free = False
+                self.__stats["local"].njobs += 1
+                self.__add_to_active_tasks(1)
+                self.__dispatch(worker, self.__run,
+                        worker.pinned.popleft()+(worker, ))
         while self.__queue:
-            if self.__active_tasks < self.__ncpus:
-                #TODO: select a job number on the basis of heuristic
-                task = self.__queue.pop(0)
-                for worker in self.__workers:
-                    if worker.is_free:
-                        worker.is_free = False
-                        break
-                else:
-                    self.__logger.error("There are no free workers left")
-                    raise RuntimeError("Error: No free workers")
+            candidates = self.__free_workers()
+            if not candidates:
+                break
+            worker, node = self.__policy.select_worker(candidates,
+                    self.__stats)
+            i = self.__policy.select_job(self.__queue, worker)
+            if i:
+                task = self.__queue[i]
+                del self.__queue[i]
+            else:
+                task = self.__queue.popleft()
+            worker.is_free = False
+            worker.last_key = task[0].key
+            self.__stats[node].njobs += 1
+            if node == "local":
                 self.__add_to_active_tasks(1)
-                try:
-                    self.__stats["local"].njobs += 1
-                    thread.start_new_thread(self.__run, task+(worker, ))
-                except:
-                    pass
+                self.__dispatch(worker, self.__run, task+(worker, ))
             else:
-                for rworker in self.__rworkers:
-                    if rworker.is_free:
-                        rworker.is_free = False
-                        task = self.__queue.pop(0)
-                        self.__stats[rworker.id].njobs += 1
-                        thread.start_new_thread(self.__rrun, task+(rworker, ))
-                        break
-                else:
-                    if len(self.__queue) > self.__ncpus:
-                        for rworker in self.__rworkers_reserved:
-                            if rworker.is_free:
-                                rworker.is_free = False
-                                task = self.__queue.pop(0)
-                                self.__stats[rworker.id].njobs += 1
-                                thread.start_new_thread(self.__rrun,
-                                        task+(rworker, ))
-                                break
-                        else:
-                            break
-                            # this code will not be executed
-                            # and is left for further releases
-                            if len(self.__queue) > self.__ncpus*0:
-                                for rworker in self.__rworkers_reserved4:
-                                    if rworker.is_free:
-                                        rworker.is_free = False
-                                        task = self.__queue.pop(0)
-                                        self.__stats[rworker.id].njobs += 1
-                                        thread.start_new_thread(self.__rrun,
-                                                task+(rworker, ))
-                                        break
-                    else:
-                        break
+                self.__dispatch(worker, self.__rrun, task+(worker, ))
 
         self.__queue_lock.release()
 
+    def __free_workers(self):
+        """Returns the (worker, node) that may take a job, in the order of
+           FIFOPolicy"""
+        candidates = []
+        if self.__active_tasks < self.__ncpus:
+            for worker in self.__workers:
+                if worker.is_free:
+                    candidates.append((worker, "local"))
+                    break
+            else:
+                self.__logger.error("There are no free workers left")
+                raise RuntimeError("Error: No free workers")
+        for rworker in self.__rworkers:
+            if rworker.is_free:
+                candidates.append((rworker, rworker.id))
+        if len(self.__queue) > self.__ncpus:
+            for rworker in self.__rworkers_reserved:
+                if rworker.is_free:
+                    candidates.append((rworker, rworker.id))
+        return candidates
+
     def __get_source(self, func):
         """Fetches source of the function"""
         hashf = hash(func)
@@ -745,10 +1126,12 @@ class Server(object):
         """Runs a job remotelly"""
         self.__logger.debug("Task (remote) %i started" % (job.tid, ))
 
+        start_time = time.time()
         try:
             rworker.csend(sfunc)
             rworker.send(sargs)
             sresult = rworker.receive()
+            self.__stat_add_jobtime(rworker.id, time.time()-start_time)
             rworker.is_free = True
         except:
             self.__logger.debug("Task %i failed due to broken network " \
@@ -813,6 +1196,7 @@ class Server(object):
         self.__add_to_active_tasks(-1)
         if not self.__exiting:
             self.__stat_add_time("local", time.time()-start_time)
+            self.__stat_add_jobtime("local", time.time()-start_time)
         self.__logger.debug("Task %i ended" % (job.tid, ))
         self.__scheduler()
 
@@ -828,6 +1212,13 @@ class Server(object):
         self.__stats[node].time += time_add
         self.__stats_lock.release()
 
+    def __stat_add_jobtime(self, node, time_add):
+        """Adds the wall time of a finished job on the node"""
+        self.__stats_lock.acquire()
+        self.__stats[node].jobtime += time_add
+        self.__stats[node].jobsdone += 1
+        self.__stats_lock.release()
+
     def __stat_add_job(self, node):
         """Increments job count on the node"""
         self.__stats_lock.acquire()
@@ -853,9 +1244,14 @@ class Server(object):
         """Kills ppworkers and closes open files"""
         self.__exiting = True
         self.__queue_lock.acquire()
-        self.__queue = []
+        self.__queue = collections.deque()
         self.__queue_lock.release()
 
+        for worker in self.__workers + self.__rworkers \
+                + self.__rworkers_reserved:
+            if hasattr(worker, "dispatcher"):
+                worker.dispatcher.stop()
+
         for worker in self.__workers:
             worker.t.exiting = True
             if sys.platform.startswith("win"):
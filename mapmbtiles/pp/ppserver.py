@@ -40,6 +40,7 @@ import random
 import string
 import time
 import os
+import cPickle as pickle
 
 import pptransport
 import ppauto
@@ -151,6 +152,10 @@ class _NetworkServer(Server):
             mysocket.send("OK")
 
         ctype = mysocket.receive()
+        if ctype.startswith("COMPRESS"):
+            # sent by clients which can compress their messages
+            mysocket.accept_compression(ctype)
+            ctype = mysocket.receive()
         logging.debug("Control message received: " + ctype)
         self.ncon_add(1)
         try:
@@ -166,8 +171,17 @@ class _NetworkServer(Server):
                     sfunc = mysocket.creceive()
                     sargs = mysocket.receive()
                     fun = self.insert(sfunc, sargs)
-                    sresult = fun(True)
+                    sresult = fun(raw_result=True)
                     mysocket.send(sresult)
+            elif ctype=="EACH":
+                # one job for each local worker (Server.each)
+                sfunc = mysocket.receive()
+                sargs = mysocket.receive()
+                tasks = self.insert_each(sfunc, sargs)
+                mysocket.send(pickle.dumps([task(raw_result=True)
+                        for task in tasks], 2))
+                csocket.close()
+                self.ncon_add(-1)
         except:
             #print sys.excepthook(*sys.exc_info())
             logging.debug("Closing client socket")
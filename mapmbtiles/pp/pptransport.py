@@ -33,6 +33,7 @@ import os
 import struct
 import socket
 import logging
+import zlib
 
 copyright = "Copyright (c) 2005-2009 Vitalii Vanovschi. All rights reserved"
 version = "1.5.7"
@@ -109,6 +110,28 @@ class CTransport(Transport):
         return self.rcache[hash1]
 
 
+# length prefix of each message
+_HEADER = struct.Struct("!Q")
+# messages up to this size are sent together with their length prefix
+_SMALL_MESSAGE = 64 * 1024
+# bit of the length prefix of a compressed message
+_COMPRESSED = 1 << 63
+
+# compressions of SocketTransport: (name, compress, decompress),
+# in the order of preference
+compressions = []
+try:
+    import lz4.block
+    compressions.append(("lz4", lz4.block.compress, lz4.block.decompress))
+except ImportError:
+    pass
+compressions.append(("zlib", lambda data: zlib.compress(data, 1),
+        zlib.decompress))
+
+# messages smaller than this are always sent uncompressed
+COMPRESS_THRESHOLD = 16 * 1024
+
+
 class PipeTransport(Transport):
 
     def __init__(self, r, w):
@@ -122,15 +145,20 @@ class PipeTransport(Transport):
                     "must be file objects")
 
     def send(self, msg):
-        self.w.write(struct.pack("!Q", len(msg)))
-        self.w.flush()
+        # one flush for the prefix and the message
+        self.w.write(_HEADER.pack(len(msg)))
         self.w.write(msg)
         self.w.flush()
 
     def receive(self, preprocess=None):
-        size_packed = self.r.read(struct.calcsize("!Q"))
-        msg_len = struct.unpack("!Q", size_packed)[0]
+        size_packed = self.r.read(_HEADER.size)
+        if len(size_packed) < _HEADER.size:
+            raise RuntimeError("Pipe is broken")
+        msg_len = _HEADER.unpack(size_packed)[0]
+        # file.read allocates the message once and reads until it is complete
         msg = self.r.read(msg_len)
+        if len(msg) < msg_len:
+            raise RuntimeError("Pipe is broken")
         return map(preprocess, (msg, ))[0]
 
     def close(self):
@@ -146,45 +174,79 @@ class SocketTransport(Transport):
         else:
             self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.scache = {}
+        # (name, compress, decompress) agreed by negotiate_compression
+        self.compression = None
+        # bytes of the messages and bytes on the connection (with prefixes)
+        self.transfer = {"sent": 0, "sent_wire": 0,
+                "received": 0, "received_wire": 0}
+
+    def negotiate_compression(self):
+        """Offers the available compressions to the remote side (which
+           answers with accept_compression) and uses the one it chooses"""
+        offer = [compression[0] for compression in compressions]
+        self.send("COMPRESS " + ",".join(offer))
+        self.set_compression(self.receive())
+
+    def accept_compression(self, request):
+        """Answers the COMPRESS request of negotiate_compression with the
+           first of the local compressions that was offered"""
+        offer = request[len("COMPRESS "):].split(",")
+        name = "none"
+        for compression in compressions:
+            if compression[0] in offer:
+                name = compression[0]
+                break
+        self.send(name)
+        self.set_compression(name)
+
+    def set_compression(self, name):
+        self.compression = None
+        for compression in compressions:
+            if compression[0] == name:
+                self.compression = compression
 
     def send(self, data):
-        size = struct.pack("!Q", len(data))
-        t_size = struct.calcsize("!Q")
-        s_size = 0L
-        while s_size < t_size:
-            p_size = self.socket.send(size[s_size:])
-            if p_size == 0:
-                raise RuntimeError("Socket connection is broken")
-            s_size += p_size
-
-        t_size = len(data)
-        s_size = 0L
-        while s_size < t_size:
-            p_size = self.socket.send(data[s_size:])
-            if p_size == 0:
-                raise RuntimeError("Socket connection is broken")
-            s_size += p_size
+        self.transfer["sent"] += len(data)
+        size_flag = 0
+        if self.compression and len(data) >= COMPRESS_THRESHOLD:
+            packed = self.compression[1](data)
+            # tile images are compressed already
+            if len(packed) < len(data):
+                data = packed
+                size_flag = _COMPRESSED
+        self.transfer["sent_wire"] += _HEADER.size + len(data)
+        size = _HEADER.pack(len(data) | size_flag)
+        if len(data) <= _SMALL_MESSAGE:
+            self.socket.sendall(size + data)
+        else:
+            # sendall loops over partial sends without slicing the data
+            self.socket.sendall(size)
+            self.socket.sendall(data)
 
-    def receive(self, preprocess=None):
-        e_size = struct.calcsize("!Q")
+    def _receive_into(self, view):
+        # fill the memoryview view, each recv_into writes after the last one
         r_size = 0
-        data = ""
+        e_size = len(view)
         while r_size < e_size:
-            msg = self.socket.recv(e_size-r_size)
-            if msg == "":
+            p_size = self.socket.recv_into(view[r_size:], e_size - r_size)
+            if p_size == 0:
                 raise RuntimeError("Socket connection is broken")
-            r_size += len(msg)
-            data += msg
-        e_size = struct.unpack("!Q", data)[0]
+            r_size += p_size
 
-        r_size = 0
-        data = ""
-        while r_size < e_size:
-            msg = self.socket.recv(e_size-r_size)
-            if msg == "":
-                raise RuntimeError("Socket connection is broken")
-            r_size += len(msg)
-            data += msg
+    def receive(self, preprocess=None):
+        size = bytearray(_HEADER.size)
+        self._receive_into(memoryview(size))
+        e_size = _HEADER.unpack(str(size))[0]
+        b_compressed = e_size & _COMPRESSED
+        e_size = int(e_size & ~_COMPRESSED)
+        # the message is received into one preallocated buffer
+        data = bytearray(e_size)
+        self._receive_into(memoryview(data))
+        self.transfer["received_wire"] += _HEADER.size + e_size
+        data = str(data)
+        if b_compressed:
+            data = self.compression[2](data)
+        self.transfer["received"] += len(data)
         return data
 
     def close(self):
@@ -93,14 +93,28 @@ class _WorkerProcess(object):
                 __args = pickle.loads(__sargs)
 
                 __f = locals()[__fname]
-                try:
-                    __result = __f(*__args)
-                except:
-                    print "An error has occured during the function execution"
-                    sys.excepthook(*sys.exc_info())
+                if isinstance(__args, list):
+                    # a chunk of Server.map: a list of argument tuples
+                    __result = []
+                    for __a in __args:
+                        try:
+                            __result.append(__f(*__a))
+                        except:
+                            print "An error has occured during the " + \
+                                  "function execution"
+                            sys.excepthook(*sys.exc_info())
+                            __result.append(None)
                     sys.stderr.write("EXIT\n")
                     sys.stderr.flush()
-                    __result = None
+                else:
+                    try:
+                        __result = __f(*__args)
+                    except:
+                        print "An error has occured during the function execution"
+                        sys.excepthook(*sys.exc_info())
+                        sys.stderr.write("EXIT\n")
+                        sys.stderr.flush()
+                        __result = None
 
                 __sresult = pickle.dumps((__result, self.sout.getvalue()),
                         self.pickle_proto)
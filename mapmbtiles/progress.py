@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#******************************************************************************
+# Purpose:  Throttled progress of the tile generation
+#           - counters, tiles per second, bytes and ETA are aggregated
+#           - and reported at most every 'interval' seconds to the CLI, the GUI
+#              or, as one line on stderr, to the pp parent process
+###############################################################################
+import time
+
+""" seconds between two reports """
+PROGRESS_INTERVAL = 0.25
+""" first word of a progress line written by a subprocess """
+PROGRESS_TAG = "PROGRESS"
+
+
+class Progress(object):
+
+ """Counters of a running task, reported through `report' at a fixed rate.
+
+ `report' is called with a state dict: complete (0..1), done, total, tiles_per_second,
+ bytes and eta (seconds, None while unknown). The first and the last update are always
+ reported, the others only when `interval' seconds have passed since the last report.
+ """
+
+ def __init__(self, report, interval=PROGRESS_INTERVAL):
+  self.report = report
+  self.interval = interval
+  self.start(0)
+
+ def start(self, total, done=0):
+  """Begin a task of total units, of which done are already done."""
+  self.total = total
+  self.done = done
+  self.bytes = 0
+  self.started = time.time()
+  self.last_report = None
+
+ def update(self, done=1, bytes=0):
+  """Add done units and bytes, report if the interval has passed."""
+  self.done += done
+  self.bytes += bytes
+  f_now = time.time()
+  if self.last_report is None or f_now - self.last_report >= self.interval or self.done >= self.total:
+   self.last_report = f_now
+   self.report(self.state(f_now))
+
+ def finish(self):
+  """Report the final state."""
+  self.done = max(self.done, self.total)
+  self.last_report = time.time()
+  self.report(self.state(self.last_report))
+
+ def state(self, f_now=None):
+  if f_now is None:
+   f_now = time.time()
+  f_elapsed = f_now - self.started
+  f_rate = 0.0
+  if f_elapsed > 0:
+   f_rate = self.done / f_elapsed
+  f_eta = None
+  if f_rate > 0:
+   f_eta = max(0, self.total - self.done) / f_rate
+  f_complete = 1.0
+  if self.total:
+   f_complete = min(1.0, self.done / float(self.total))
+  return {'complete': f_complete, 'done': self.done, 'total': self.total,
+   'tiles_per_second': f_rate, 'bytes': self.bytes, 'eta': f_eta}
+
+
+def format_state(state):
+ """One line for a progress state, read back with parse_state."""
+ f_eta = state['eta']
+ if f_eta is None:
+  f_eta = -1
+ return "%s %f %d %d %f %d %f" % (PROGRESS_TAG, state['complete'], state['done'], state['total'],
+  state['tiles_per_second'], state['bytes'], f_eta)
+
+
+def parse_state(line):
+ """Return the progress state of a line of format_state (or a plain float), None for other lines."""
+ values = line.split()
+ try:
+  if len(values) == 1:
+   return {'complete': float(values[0]), 'done': None, 'total': None,
+    'tiles_per_second': None, 'bytes': None, 'eta': None}
+  if len(values) == 7 and values[0] == PROGRESS_TAG:
+   f_eta = float(values[6])
+   if f_eta < 0:
+    f_eta = None
+   return {'complete': float(values[1]), 'done': int(values[2]), 'total': int(values[3]),
+    'tiles_per_second': float(values[4]), 'bytes': int(values[5]), 'eta': f_eta}
+ except ValueError:
+  pass
+ return None
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#******************************************************************************
+# Purpose:  Wall and cpu time of the stages of the tile generation
+#           - ReadRaster, resampling, encoding, tile files, SQLite inserts ...
+#           - a count, totals and a histogram for each stage
+#           - only recorded after timings.enable() [gdal2mbtiles --timings]
+###############################################################################
+import json
+import math
+import time
+
+
+class Timings(object):
+
+ """Wall and cpu time of named stages, recorded between start() and stop().
+
+ When not enabled, start() returns None and stop() returns at once, so that the calls
+ can stay in the tiling code:
+  started = timings.start()
+  ...
+  timings.stop('read', started)
+ Stages may be nested, each stage includes the time of the stages within it.
+ The histogram counts the calls by wall time, in powers of two microseconds.
+ """
+
+ def __init__(self):
+  self.enabled = False
+  self.stages = {}
+
+ def enable(self, b_enabled=True):
+  self.enabled = b_enabled
+
+ def start(self):
+  if not self.enabled:
+   return None
+  return (time.time(), time.clock())
+
+ def stop(self, s_stage, started):
+  if started is None:
+   return
+  f_wall = time.time() - started[0]
+  f_cpu = time.clock() - started[1]
+  stage = self.stages.get(s_stage)
+  if stage is None:
+   stage = self.stages[s_stage] = {'count': 0, 'wall': 0.0, 'cpu': 0.0, 'max': 0.0, 'histogram': {}}
+  stage['count'] += 1
+  stage['wall'] += f_wall
+  stage['cpu'] += f_cpu
+  stage['max'] = max(stage['max'], f_wall)
+  # upper limit of the bucket: 2**i_bucket microseconds
+  i_bucket = math.frexp(f_wall * 1000000.0)[1]
+  stage['histogram'][i_bucket] = stage['histogram'].get(i_bucket, 0) + 1
+
+ def reset(self):
+  self.stages = {}
+
+ def summary(self):
+  """Return {stage: {count, wall, cpu, max, mean, histogram: [[upper limit in us, count], ...]}}"""
+  result = {}
+  for s_stage, stage in self.stages.items():
+   result[s_stage] = {'count': stage['count'], 'wall': stage['wall'], 'cpu': stage['cpu'], 'max': stage['max'],
+    'mean': stage['wall'] / stage['count'],
+    'histogram': [[2 ** i_bucket, i_count] for i_bucket, i_count in sorted(stage['histogram'].items())]}
+  return result
+
+ def text(self):
+  """Return the summary as a table, the stage with the most wall time first."""
+  lines = ["%-20s %10s %12s %12s %12s %12s" % ("stage", "count", "wall s", "cpu s", "mean ms", "max ms")]
+  for s_stage, stage in sorted(self.stages.items(), key=lambda item: -item[1]['wall']):
+   lines.append("%-20s %10d %12.3f %12.3f %12.3f %12.3f" % (s_stage, stage['count'], stage['wall'], stage['cpu'],
+    stage['wall'] * 1000.0 / stage['count'], stage['max'] * 1000.0))
+  return "\n".join(lines)
+
+ def write(self, filename):
+  """Write the summary as json to filename."""
+  output_file = open(filename, 'w')
+  try:
+   json.dump(self.summary(), output_file, indent=1, sort_keys=True)
+  finally:
+   output_file.close()
+
+""" the Timings of this process """
+timings = Timings()
+
+
+def profile_start():
+ """Return a running cProfile.Profile [gdal2mbtiles --cprofile_zoom]"""
+ import cProfile
+ profiler = cProfile.Profile()
+ profiler.enable()
+ return profiler
+
+
+def profile_stop(profiler, filename):
+ """Stop a profile_start profiler and write its stats to filename (read with pstats)."""
+ profiler.disable()
+ profiler.dump_stats(filename)
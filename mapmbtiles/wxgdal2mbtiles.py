@@ -6,6 +6,7 @@ from thread import allocate_lock
 from Queue import Empty
 
 from gdal2mbtiles import GDAL2MbTiles
+from progress import parse_state
 
 # TODO: GetText
 from config import _
@@ -23,18 +24,22 @@ class UpdateProgressEvent(wx.PyEvent):
 
 def process_tiles(args, method):
 
- """Process base or overview tiles."""
+ """Process base or overview tiles, or close the opened input with "shutdown"."""
 
  try:
-  g2t = mapmbtiles.gdal2mbtiles.GDAL2MbTiles(args, is_subprocess=True)
   print "UpdateProgressEvent :process_tiles(",method,")"
-  g2t.open_input()
-
-  if method == "base":
-   g2t.generate_base_tiles()
-  elif method == "overview":
-   g2t.generate_overview_tiles()
+  if method == "shutdown":
+   mapmbtiles.gdal2mbtiles.worker_shutdown(args)
+  else:
+   # opened by the first task, kept open in the worker for the next one
+   g2t = mapmbtiles.gdal2mbtiles.worker_context(args)
+
+   if method == "base":
+    g2t.generate_base_tiles()
+   elif method == "overview":
+    g2t.generate_overview_tiles()
  except Exception, e:
+  mapmbtiles.gdal2mbtiles.worker_shutdown(args)
   error = e
  else:
   error = None
@@ -58,6 +63,9 @@ class PPGDAL2MbTiles(GDAL2MbTiles):
 
  def generate_overview_tiles(self):
   self.__pp_run("overview")
+  if not self.stopped:
+   # the base and overview tasks shared the input and the mbtiles of the worker
+   self.__pp_run("shutdown")
 
  def stop(self):
   GDAL2MbTiles.stop(self)
@@ -76,10 +84,10 @@ class PPGDAL2MbTiles(GDAL2MbTiles):
    try:
     for i in xrange(self.__pp_job_server.msg_que.qsize()):
      msg = self.__pp_job_server.msg_que.get_nowait()
-     try:
-      progress = float(msg)
-     except ValueError:
-      pass
+     # the last of the throttled states of GDAL2MbTiles.progress_report
+     state = parse_state(msg)
+     if state is not None:
+      progress = state['complete']
    except Empty:
     pass
 
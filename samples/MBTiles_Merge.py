@@ -0,0 +1,31 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import logging,os
+from mapmbtiles import MbTiles
+# .bashrc
+# export PYTHONPATH=/usr/lib/mapmbtiles:$PYTHONPATH
+
+logging.basicConfig(level=logging.INFO)
+input_directory="output"
+output_directory="output"
+#----------------------------------------------------------------------------------
+# the mbtiles created by 1861_Mercator.py are merged into one mbtiles
+# - the tiles are copied with SQL, no image is decoded
+# - policy 'first' : when a tile exists in more than one file, the first one is kept
+# - policy 'newest' : the tile of the most recently modified file is kept
+# - policy 'priority' : the file list contains (file,priority) pairs, the highest priority is kept
+#----------------------------------------------------------------------------------
+source_list=[]
+for s_name in ("1861_Mercator_Europe","1861_Mercator_Europe_Africa","1861_Mercator_World"):
+ Source_filepath="%s/%s.mbtiles" % (input_directory,s_name)
+ if os.path.exists(Source_filepath):
+  source_list.append(Source_filepath)
+Output_filepath="%s/1861_Mercator_Merged.mbtiles" % output_directory
+if source_list:
+ print "Sources: ",source_list," \nOutput: ",Output_filepath
+ mb_merge=MbTiles()
+ # 'bulk': one writer, the file is locked until close_db
+ mb_merge.open_db(Output_filepath,output_directory,"jpg","tms",True,'bulk')
+ i_tiles=mb_merge.mbtiles_merge(source_list,'first')
+ print "Tiles added: ",i_tiles
+ mb_merge.close_db()
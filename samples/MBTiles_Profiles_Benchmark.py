@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import logging,os,random,sys,time
+from mapmbtiles import MbTiles, MBTILES_PROFILES
+# .bashrc
+# export PYTHONPATH=/usr/lib/mapmbtiles:$PYTHONPATH
+
+logging.basicConfig(level=logging.WARNING)
+input_directory="source"
+output_directory="output"
+# amount of tiles written and read with each SQLite connection profile
+i_tiles=2000
+if len(sys.argv) > 1:
+ i_tiles=int(sys.argv[1])
+#----------------------------------------------------------------------------------
+# the tiles of an existing mbtiles are used as image data
+# - written with each profile to a new mbtiles [a commit for each tile, as gdal2mbtiles does]
+# - then read in random order with each profile
+#----------------------------------------------------------------------------------
+Source_filepath="%s/1861_Mercator_World.mbtiles" % input_directory
+if not os.path.exists(output_directory):
+ os.makedirs(output_directory)
+mb_source=MbTiles()
+mb_source.open_db(Source_filepath,input_directory,"png","tms",False,'read')
+images=[row[0] for row in mb_source.mbtiles_cursor.execute("SELECT tile_data FROM tiles;").fetchall()]
+mb_source.close_db()
+s_format=mb_source.mbtiles_format
+# zoom_level 14: enough tiles for i_tiles
+i_zoom=14
+i_width=int(i_tiles**0.5)+1
+tiles_list=[(i_zoom,i_x,i_y) for i_x in range(i_width) for i_y in range(i_width)][:i_tiles]
+print "Source: ",Source_filepath," images[",len(images),"] tiles[",len(tiles_list),"]"
+print "%-10s %12s %12s %12s" % ("profile","write tiles/s","read tiles/s","file MB")
+results={}
+for s_profile in sorted(MBTILES_PROFILES.keys()):
+ if s_profile == 'read':
+  # not possible to write
+  continue
+ Output_filepath="%s/profile_%s.mbtiles" % (output_directory,s_profile)
+ if os.path.exists(Output_filepath):
+  os.remove(Output_filepath)
+ mb_output=MbTiles()
+ mb_output.open_db(Output_filepath,output_directory,s_format,"tms",False,s_profile)
+ f_start=time.time()
+ for i_tile in range(len(tiles_list)):
+  z,x,y=tiles_list[i_tile]
+  mb_output.insert_image(z,x,y,str(images[i_tile % len(images)]))
+ mb_output.save_bounds()
+ mb_output.close_db()
+ f_write=time.time()-f_start
+ results[s_profile]=(f_write,os.path.getsize(Output_filepath))
+read_list=list(tiles_list)
+random.seed(0)
+random.shuffle(read_list)
+for s_profile in sorted(MBTILES_PROFILES.keys()):
+ # read the file written with the 'default' profile
+ Output_filepath="%s/profile_%s.mbtiles" % (output_directory,'default')
+ mb_input=MbTiles()
+ mb_input.open_db(Output_filepath,output_directory,s_format,"tms",False,s_profile)
+ f_start=time.time()
+ for z,x,y in read_list:
+  mb_input.retrieve_image(z,x,y)
+ f_read=time.time()-f_start
+ mb_input.close_db()
+ if s_profile in results:
+  f_write,i_size=results[s_profile]
+  print "%-10s %12.1f %12.1f %12.2f" % (s_profile,len(tiles_list)/f_write,len(read_list)/f_read,i_size/1048576.0)
+ else:
+  print "%-10s %12s %12.1f %12s" % (s_profile,"-",len(read_list)/f_read,"-")